@@ -0,0 +1,443 @@
+#!/usr/bin/env python3
+# coding=UTF-8
+"""Module to communicate with GRBL from an asyncio event loop
+
+AsyncSender does what Sender does, but on an event loop instead of an I/O
+thread, so one loop can drive several controllers (and anything else, like
+a status server) without any extra threads:
+
+    grbl = AsyncSender()
+    await grbl.open("/dev/ttyAMA0")
+    await grbl.send("G0X10Y10")
+    await grbl.stream(GcodeFile(path, lazy=True).wire_buffer())
+
+Flow control, job handling and overrides come from Sender. Needs Python 3.5
+or later."""
+
+__author__ = "Dylan Armitage"
+__email__ = "d.armitage89@gmail.com"
+
+####---- Import ----####
+from collections import deque
+
+import sys
+import time
+import asyncio
+import logging
+import argparse
+import serial
+
+from Sender import CharCounter, JobSource, LatencyStats, GrblError, \
+                   CommandCancelled, to_wire, override_target, override_step, \
+                   SPLITPOS, SERIAL_POLL, RESET_TIMEOUT, OVERRIDE_INTERVAL, \
+                   OVERRIDE_SETTLE
+
+logger = logging.getLogger(__name__) #pylint: disable=invalid-name
+
+# Global variables
+READY_TIMEOUT = 5.0 # seconds to wait for Grbl to answer after opening
+
+
+class AsyncSender(object):
+    """GRBL on an asyncio event loop
+
+    Like Sender, everything goes out in three lanes: realtime bytes first,
+    then commands from send(), then the job being streamed. Every method
+    must be called from the loop's thread."""
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, loop=None):
+        self.loop = loop or asyncio.get_event_loop()
+        self.serial = None
+        self.state = None # Last reported state, e.g. "Idle" or "Hold:0"
+        self.pos = None # Will be (x,y,z) of machine position
+        self.buffer_state = None # Will be (planner blocks, RX bytes) free
+        self.overrides = dict(feed=100, rapid=100, spindle=100) # %
+        self.latency = LatencyStats()
+        self.listeners = [] # Called with every status report dict
+        self._fd = None
+        self._tx = bytearray() # Waiting for the serial port to take it
+        self._rx = bytearray()
+        self._flow = CharCounter()
+        self._commands = deque() # (command, future) waiting to be sent
+        self._job = None # JobSource being streamed
+        self._pending = None # (line, source) of the job waiting for room
+        self._job_done = None # Future resolved once the job is answered
+        self._job_errors = []
+        self._held = False # Send nothing but realtime bytes while True
+        self._release = None # Timer handle ending the hold after a reset
+        self._polls = 0 # Status polls sent
+        self._reports = 0 # Status reports received
+        self._status_waiters = [] # (poll, future)
+        self._t_override = 0.0
+        self._poller = None
+
+    async def open(self, url, baudrate=115200):
+        """Open the serial port and wait until Grbl answers a status poll,
+        for at most READY_TIMEOUT
+
+        Lines sent meanwhile wait until Grbl shows it is up, with its
+        banner, or a status report if the port didn't reset it."""
+        logger.info("Opening serial device")
+        self.serial = serial.serial_for_url(url,
+                                            baudrate=baudrate,
+                                            bytesize=serial.EIGHTBITS,
+                                            parity=serial.PARITY_NONE,
+                                            stopbits=serial.STOPBITS_ONE,
+                                            timeout=0,
+                                            write_timeout=0,
+                                            xonxoff=False,
+                                            rtscts=False)
+        # Toggle DTR to reset the arduino
+        try:
+            self.serial.dtr = False
+            self.serial.dtr = True
+        except IOError:
+            logger.debug("IOError on setting DTR, but not important")
+        self._flow = CharCounter()
+        self._held = True # Until the banner
+        self._fd = self.serial.fileno()
+        self.loop.add_reader(self._fd, self._on_readable)
+        self._write(b"\n\n")
+        self._poller = asyncio.ensure_future(self._poll(), loop=self.loop)
+        await asyncio.wait_for(self.status(), READY_TIMEOUT)
+        self._end_hold() # Up without a reset, e.g. no DTR on the port
+        logger.info("Grbl ready on %s", url)
+
+    async def close(self):
+        """Throw away anything not yet answered and close the serial port"""
+        if self.serial is None:
+            return
+        logger.info("Closing serial device")
+        self._poller.cancel()
+        self.loop.remove_reader(self._fd)
+        self.loop.remove_writer(self._fd)
+        self._cancel_all(CommandCancelled("Serial closed"))
+        self.serial.close()
+        self.serial = None
+        self._fd = None
+
+    ####---- Coroutines ----####
+    async def send(self, command):
+        """Send a line, return "ok" or raise GrblError once Grbl answers"""
+        future = self.loop.create_future()
+        if self.serial is None:
+            raise CommandCancelled(command)
+        self._commands.append((command, future))
+        self._fill()
+        return await future
+
+    async def stream(self, lines):
+        """Stream a job and return once all of it has been answered
+
+        lines is a GcodeParser.WireBuffer or any iterable of gcode lines.
+        Errors don't stop the job, they are logged and returned with the
+        round-trip times as a dict."""
+        if self._job is not None:
+            raise RuntimeError("Already streaming a job")
+        if self.serial is None:
+            raise CommandCancelled("Job")
+        job = JobSource(lines)
+        logger.info("Lines to send: %s", job.total or "unknown")
+        self.latency.reset()
+        self._job_errors = []
+        self._job_done = self.loop.create_future()
+        self._job = job
+        try:
+            self._fill()
+            await self._job_done
+        finally:
+            self._job = self._job_done = self._pending = None
+        return dict(lines=job.sent,
+                    errors=list(self._job_errors),
+                    latency=self.latency.summary())
+
+    def progress(self):
+        """Return the fraction of the current job sent, 0.0 if none"""
+        return self._job.progress() if self._job else 0.0
+
+    async def status(self):
+        """Poll Grbl right away and return the report as a dict"""
+        future = self.loop.create_future()
+        self._poll_now()
+        self._status_waiters.append((self._polls, future))
+        return await future
+
+    async def wait_idle(self):
+        """Wait for everything sent so far to be answered and Grbl to
+        report that it is Idle"""
+        while True:
+            busy = self._commands or len(self._flow) or self._job
+            report = await self.status()
+            if report["state"] == "Alarm":
+                raise CommandCancelled(report["state"])
+            if not busy and report["state"] == "Idle":
+                return report
+            await asyncio.sleep(SERIAL_POLL)
+
+    async def set_override(self, override, percent):
+        """Step the feed, rapid or spindle (laser power) override to percent
+
+        Returns the percentage set, see Sender.override_target()."""
+        target = override_target(override, percent)
+        logger.info("Setting %s override to %d%%", override, target)
+        current = self.overrides[override]
+        while current != target:
+            command, current = override_step(override, current, target)
+            self.overrides[override] = current
+            self._t_override = time.time()
+            self.realtime(command)
+            # Grbl merges repeats that arrive between its realtime checks
+            await asyncio.sleep(OVERRIDE_INTERVAL)
+        return target
+
+    ####---- Realtime commands ----####
+    def realtime(self, command):
+        """Send realtime command bytes ahead of everything else"""
+        logger.debug("Realtime %r", command)
+        self._tx[0:0] = command # Grbl picks these out of any line
+        self._flush()
+
+    def pause(self):
+        """Feed hold"""
+        self.realtime(b"!")
+
+    def resume(self):
+        """Cycle start after a feed hold"""
+        self.realtime(b"~")
+
+    def jog_cancel(self):
+        """Cancel jog command"""
+        self.realtime(b"\x85")
+
+    def reset(self):
+        """Soft reset Grbl, throwing away everything in flight"""
+        logger.info("Soft reset")
+        self._cancel_all(CommandCancelled("Soft reset"))
+        del self._tx[:] # Grbl would throw away any partial line anyway
+        self.realtime(b"\x18")
+        self._held = True
+        self._release = self.loop.call_later(RESET_TIMEOUT, self._end_hold)
+
+    ####---- Sending ----####
+    def _fill(self):
+        """Send as many commands, then job lines, as Grbl has room for"""
+        if self.serial is None or self._held:
+            return
+        flow = self._flow
+        t_curr = time.time()
+        batch = bytearray()
+        job = self._job
+        while True:
+            if self._commands:
+                command, future = self._commands[0]
+                line, source = to_wire(command), None
+            elif job is not None:
+                if self._pending is None:
+                    self._pending = job.next_line()
+                    if self._pending is None:
+                        break
+                (line, source), future = self._pending, None
+            else:
+                break
+            if not flow.fits(len(line)):
+                break
+            if future is None:
+                self._pending = None
+            else:
+                self._commands.popleft()
+            flow.push(line, t_curr, source, future)
+            batch += line
+        if batch:
+            self._write(batch)
+        if job is not None and job.exhausted and len(flow) == 0:
+            if not self._job_done.done():
+                self._job_done.set_result(None)
+
+    def _write(self, data):
+        """Queue data behind everything else and send what the port takes"""
+        self._tx += data
+        self._flush()
+
+    def _flush(self):
+        """Write as much as the serial port takes without blocking"""
+        if self.serial is None or not self._tx:
+            return
+        written = self.serial.write(bytes(self._tx)) or 0
+        del self._tx[:written]
+        if self._tx:
+            self.loop.add_writer(self._fd, self._flush)
+        else:
+            self.loop.remove_writer(self._fd)
+
+    def _poll_now(self):
+        """Ask for a status report"""
+        self._polls += 1
+        self.realtime(b"?")
+
+    async def _poll(self):
+        """Ask for a status report every SERIAL_POLL"""
+        while True:
+            self._poll_now()
+            await asyncio.sleep(SERIAL_POLL)
+
+    def _end_hold(self):
+        """Start sending lines again after a reset or boot"""
+        if self._release is not None:
+            self._release.cancel()
+            self._release = None
+        self._held = False
+        self._fill()
+
+    def _cancel_all(self, exception):
+        """Fail everything that will never be answered"""
+        self._pending = None
+        for entry in self._flow.clear():
+            if entry[3] is not None and not entry[3].done():
+                entry[3].set_exception(exception)
+        while self._commands:
+            future = self._commands.popleft()[1]
+            if not future.done():
+                future.set_exception(exception)
+        if self._job_done is not None and not self._job_done.done():
+            self._job_done.set_exception(exception)
+        waiters, self._status_waiters = self._status_waiters, []
+        for _, future in waiters:
+            if not future.done():
+                future.set_exception(exception)
+
+    ####---- Receiving ----####
+    def _on_readable(self):
+        """Read what Grbl sent and act on every complete line"""
+        try:
+            data = self.serial.read(self.serial.in_waiting or 1)
+        except serial.SerialException:
+            logger.exception("Serial I/O failed")
+            self.loop.remove_reader(self._fd)
+            self._cancel_all(CommandCancelled("Serial failed"))
+            return
+        self._rx += data
+        t_curr = time.time()
+        while True:
+            newline = self._rx.find(b"\n")
+            if newline < 0:
+                break
+            message = bytes(self._rx[:newline]).decode("ascii", "replace")
+            del self._rx[:newline+1]
+            message = message.strip()
+            if message:
+                self._on_message(message, t_curr)
+        self._fill()
+
+    def _on_message(self, message, t_curr):
+        """Act on one line from Grbl"""
+        if message == "ok" or message.startswith("error:"):
+            self._acknowledge(self._flow.pop(), t_curr, message)
+        elif message.startswith("<"):
+            self._on_status(message[1:-1])
+        elif message.startswith("ALARM:"):
+            logger.error("Grbl %s", message)
+        elif message.startswith("Grbl "):
+            logger.info("Grbl started: %s", message)
+            self.overrides = dict(feed=100, rapid=100, spindle=100)
+            self._reports = self._polls # Polls lost to the reset
+            if self._held:
+                self._end_hold()
+        else:
+            logger.info("Grbl %s", message)
+
+    def _acknowledge(self, entry, t_curr, response):
+        """Record the round trip of a line and resolve its future"""
+        if entry is None:
+            logger.debug("No line waiting on a response")
+            return
+        line, t_sent, source, future = entry
+        self.latency.record(t_curr-t_sent, source, line)
+        if response == "ok":
+            if future is not None and not future.done():
+                future.set_result(response)
+            return
+        try:
+            code = int(response.split(":")[1])
+        except (IndexError, ValueError):
+            code = None
+        command = bytes(line).decode("ascii", "replace").strip()
+        if future is not None:
+            if not future.done():
+                future.set_exception(GrblError(code, command=command))
+        else:
+            error = GrblError(code, command=command)
+            logger.error("Line %s: %s", source, error)
+            self._job_errors.append((source, code))
+
+    def _on_status(self, report):
+        """Parse a status report and hand it to whoever is waiting"""
+        fields = report.split("|")
+        status = dict(state=fields[0])
+        self.state = fields[0]
+        for field in fields[1:]:
+            name, _, values = field.partition(":")
+            if name == "MPos":
+                self.pos = tuple(float(f) for f in SPLITPOS.split(values))
+                status["mpos"] = self.pos
+            elif name == "Bf":
+                blocks, rx_free = (int(f) for f in SPLITPOS.split(values))
+                self.buffer_state = (blocks, rx_free)
+                status["buffer"] = self.buffer_state
+                self._flow.learn(rx_free)
+                self._flow.throttle(blocks == 0)
+            elif name == "Ov":
+                feed, rapid, spindle = (int(f) for f in SPLITPOS.split(values))
+                if time.time()-self._t_override >= OVERRIDE_SETTLE:
+                    self.overrides = dict(feed=feed, rapid=rapid,
+                                          spindle=spindle)
+                status["overrides"] = dict(self.overrides)
+            elif name == "FS":
+                status["feed"], status["spindle"] = \
+                    (float(f) for f in SPLITPOS.split(values))
+        self._reports += 1
+        waiting = []
+        for poll, future in self._status_waiters:
+            if self._reports >= poll:
+                if not future.done():
+                    future.set_result(status)
+            else:
+                waiting.append((poll, future))
+        self._status_waiters = waiting
+        for listener in self.listeners:
+            try:
+                listener(status)
+            except Exception: # pylint: disable=broad-except
+                logger.exception("Status listener failed")
+
+
+####---- MAIN ----####
+async def stream_file(url, path):
+    """Stream the gcode file path to the Grbl at url"""
+    from GcodeParser import GcodeFile
+    grbl = AsyncSender()
+    await grbl.open(url)
+    gcodefile = GcodeFile(path, lazy=True)
+    try:
+        result = await grbl.stream(gcodefile.wire_buffer())
+        await grbl.wait_idle()
+    finally:
+        await grbl.close()
+        gcodefile.close()
+    return result
+
+def main():
+    """Stream a file from the command line"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("url", help="serial port or pyserial URL")
+    parser.add_argument("path", help="gcode file to stream")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    result = loop.run_until_complete(stream_file(args.url, args.path))
+    print("Sent {} lines, {} errors".format(result["lines"],
+                                            len(result["errors"])))
+    return 1 if result["errors"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,182 @@
+#!/usr/bin/env python2
+# coding=UTF-8
+"""Drive several GRBL controllers from one process
+
+ControllerManager owns a Sender per machine, keyed by name, and a JobCache
+that every machine loads its files from, so a job shared between lasers is
+only parsed and held in memory once:
+
+    manager = ControllerManager()
+    manager.add("left", "/dev/ttyUSB0")
+    manager.add("right", "/dev/ttyUSB1")
+    manager.connect_all()
+    manager.run("left", "/home/users/Public/sign.gcode")
+    manager.statuses()"""
+
+__author__ = "Dylan Armitage"
+__email__ = "d.armitage89@gmail.com"
+
+####---- Imports ----####
+from collections import OrderedDict
+from threading import Lock
+
+import os
+import logging
+
+from GcodeParser import GcodeLoader
+from Sender import Sender
+
+logger = logging.getLogger(__name__) #pylint: disable=invalid-name
+
+####---- Variables ----####
+JOB_CACHE_SIZE = 8 # Parsed jobs to keep around
+
+
+####---- Classes ----####
+class JobCache(object):
+    """Parsed GcodeFiles, shared by everything in the process
+
+    Files are loaded in the background by a GcodeLoader each. Entries are
+    keyed by (path, mtime, size), so a file that changes on disk is parsed
+    again, and the least recently used are dropped once there are more than
+    max_jobs. A dropped GcodeFile is not closed, as a machine may still be
+    running it; it goes away with its last reference.
+
+    Given a ParseCache as parse_cache, compiled files are also kept on disk
+    between runs, and given a GcodeParser.parse_pool() as parse_pool, big
+    files are compiled across its workers."""
+    def __init__(self, max_jobs=JOB_CACHE_SIZE, parse_cache=None,
+                 parse_pool=None):
+        self.max_jobs = max_jobs
+        self.parse_cache = parse_cache
+        self.parse_pool = parse_pool
+        self._lock = Lock()
+        self._jobs = OrderedDict() # path : (key, GcodeLoader)
+
+    @staticmethod
+    def key(path):
+        """Return the cache key of the file at path"""
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        return path, stat.st_mtime, stat.st_size
+
+    def load(self, path):
+        """Return the GcodeLoader for path, starting one if need be
+
+        A load that was cancelled or failed is started again."""
+        key = self.key(path)
+        with self._lock:
+            entry = self._jobs.pop(key[0], None)
+            if entry is not None and entry[0] == key and \
+               not entry[1].failed():
+                logger.debug("Job cache hit: %s", path)
+                self._jobs[key[0]] = entry # Now the most recently used
+                return entry[1]
+            logger.info("Parsing %s", path)
+            loader = GcodeLoader(key[0], cache=self.parse_cache,
+                                 pool=self.parse_pool)
+            self._jobs[key[0]] = (key, loader)
+            while len(self._jobs) > self.max_jobs:
+                dropped, _ = self._jobs.popitem(last=False)
+                logger.debug("Job cache dropped %s", dropped)
+        return loader.start()
+
+    def get(self, path):
+        """Return the GcodeFile for path, once it is completely loaded"""
+        return self.load(path).result()
+
+    def forget(self, path):
+        """Drop path from the cache"""
+        with self._lock:
+            self._jobs.pop(os.path.abspath(path), None)
+
+    def __len__(self):
+        return len(self._jobs)
+
+
+class ControllerManager(object):
+    """Several machines, each a Sender on its own serial URL, sharing one
+    JobCache"""
+    def __init__(self, jobs=None):
+        self.jobs = jobs if jobs is not None else JobCache()
+        self.machines = OrderedDict() # name : Sender
+        self.urls = {} # name : serial URL
+
+    def add(self, name, url, sender=None):
+        """Add a machine, return its Sender
+
+        sender defaults to a new Sender, but anything built on one (like
+        lasercontrol2.MainWindow) can be given instead."""
+        if name in self.machines:
+            raise KeyError("Machine {} already added".format(name))
+        if sender is None:
+            sender = Sender()
+        self.machines[name] = sender
+        self.urls[name] = url
+        logger.info("Added machine %s on %s", name, url)
+        return sender
+
+    def remove(self, name):
+        """Disconnect and forget a machine"""
+        self.disconnect(name)
+        del self.machines[name]
+        del self.urls[name]
+        logger.info("Removed machine %s", name)
+
+    def connect(self, name):
+        """Open the serial port of a machine"""
+        sender = self.machines[name]
+        if sender.serial is None:
+            sender._open_serial(self.urls[name]) # pylint: disable=protected-access
+
+    def disconnect(self, name):
+        """Close the serial port of a machine"""
+        sender = self.machines[name]
+        if sender.serial is not None:
+            sender._close_serial() # pylint: disable=protected-access
+
+    def connect_all(self):
+        """Open the serial port of every machine"""
+        for name in self.machines:
+            self.connect(name)
+
+    def disconnect_all(self):
+        """Close the serial port of every machine"""
+        for name in self.machines:
+            self.disconnect(name)
+
+    def run(self, name, path):
+        """Start streaming the file at path to a machine, return its
+        GcodeFile
+
+        Streaming starts as soon as the first chunk of the file is loaded."""
+        gcodefile = self.jobs.load(path).streamable()
+        sender = self.machines[name]
+        logger.info("Running %s on %s", path, name)
+        sender._init_run() # pylint: disable=protected-access
+        sender._start_file(gcodefile) # pylint: disable=protected-access
+        return gcodefile
+
+    def status(self, name):
+        """Return a dict with the state of a machine"""
+        sender = self.machines[name]
+        state = sender.state
+        return dict(url=self.urls[name],
+                    connected=sender.serial is not None,
+                    status=state.status,
+                    pos=state.mpos,
+                    wpos=state.wpos,
+                    feed=state.feed,
+                    power=state.power,
+                    line=state.line,
+                    running=sender.max_size > 0,
+                    progress=sender.progress,
+                    buffer=sender.buffer_state,
+                    overrides=dict(sender.overrides),
+                    starved=sender.starved,
+                    errors=sender.error.qsize(),
+                   )
+
+    def statuses(self):
+        """Return the status of every machine, keyed by name"""
+        return OrderedDict((name, self.status(name)) for name in self.machines)
@@ -17,6 +17,7 @@ logger = logging.getLogger(__name__) #pylint: disable=invalid-name
 OUT_PINS = dict(laser=20, psu=21, grbl=27)
 ## Sensors and other inputs
 IN_PINS = dict() # None currently
+TOGGLE_TIME = 0.25 # seconds a toggled pin stays switched
 
 
 ####---- Functions ----####
@@ -72,9 +73,11 @@ def switch_pin(pin):
     GPIO.digitalWrite(pin, new_state)
 
 def toggle_pin(pin):
-    """Take pinn, switch pin states for short period of time"""
+    """Take pinn, switch pin states for short period of time
+
+    Blocks for TOGGLE_TIME, so the GUI runs the same steps in a Sequence"""
     logger.info("Toggling pin %d", pin)
     switch_pin(pin)
-    time.sleep(0.25)
+    time.sleep(TOGGLE_TIME)
     switch_pin(pin)
     logger.debug("Pin %d toggled", pin)
@@ -0,0 +1,342 @@
+#!/usr/bin/env python2
+# coding=UTF-8
+"""Local stand-in for Grbl's check mode ($C)
+
+With $C on, Grbl parses every block it is sent without moving, so checking
+a job that way takes as long as streaming it over 115200 baud. GcodeChecker
+runs each block through the checks of Grbl 1.1's parser (gc_execute_line()
+in gcode.c), in the same order, and gives the error:N code of
+GrblCodes.ERROR_CODES that Grbl would: unsupported words and commands,
+modal group violations, bad number formats, missing axis and value words,
+unused words, arcs that don't meet up and lines that overflow its line
+buffer. As in Grbl, a block with an error changes nothing.
+
+The offsets of G54-G59, G10 L2 and the positions stored by G28.1/G30.1
+live in Grbl's EEPROM, so here they are taken to be 0."""
+
+__author__ = "Dylan Armitage"
+__email__ = "d.armitage89@gmail.com"
+
+####---- Imports ----####
+import re
+import math
+import logging
+
+logger = logging.getLogger(__name__) #pylint: disable=invalid-name
+
+####---- Variables ----####
+# What Grbl's serial protocol drops before the parser sees the line
+STRIP = re.compile(r"\s|\(.*?\)|\(.*|;.*|[/%]")
+WORD = re.compile(r"([A-Z])([-+]?(?:\d+\.?\d*|\.\d+))")
+SYSTEM = re.compile(r"^\$(\$|#|[CGHINX]|SLP|RST=[$#*]|N\d=.*|\d+=.*)?$")
+LINE_BUFFER_SIZE = 80 # bytes, Grbl rejects lines that don't fit
+MAX_LINE_NUMBER = 10000000
+MAX_TOOL_NUMBER = 255
+COORDINATE_SYSTEMS = 6 # G54 to G59
+VALUE_WORDS = "FIJKLNPRSTXYZ"
+AXES = "XYZ"
+OFFSETS = "IJK"
+# Plane : the two axes it is in
+PLANES = {17: (0, 1), 18: (2, 0), 19: (1, 2)}
+ARC_TOLERANCE = 0.005 # mm the end of an arc can be off its radius
+ARC_ERROR = 0.5 # mm it can never be off by
+ARC_ERROR_RATIO = 0.001 # of the radius it can't be off by either
+
+
+def _split(value):
+    """Return the integer and hundredths of a G or M value, as Grbl does"""
+    number = int(value)
+    return number, int(round(100 * (value - number)))
+
+
+####---- Classes ----####
+class GcodeChecker(object):
+    """The modal state of Grbl's parser, for checking a job block by block
+
+    Feed is in mm/min, and position in mm, in work coordinates."""
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self):
+        self.motion = 0 # G0, G1, G2, G3, G38, or None for G80
+        self.plane = 17
+        self.absolute = True
+        self.inches = False
+        self.inverse_time = False
+        self.coordinate_system = 1 # G54
+        self.feed = 0.0
+        self.position = [0.0, 0.0, 0.0]
+
+    def check(self, line):
+        """Return the error code Grbl would give line, 0 for ok, and change
+        the state the way Grbl would"""
+        if isinstance(line, memoryview):
+            line = line.tobytes()
+        if isinstance(line, bytes):
+            line = line.decode("ascii", "replace")
+        line = STRIP.sub("", line).upper()
+        if not line:
+            return 0
+        if len(line) >= LINE_BUFFER_SIZE:
+            return 11
+        if line[0] == "$":
+            if line.startswith("$J="):
+                return self._block(line[3:], jog=True)
+            return 0 if SYSTEM.match(line) else 3
+        return self._block(line)
+
+    def _block(self, line, jog=False):
+        """Check a block of gcode, return its error code"""
+        # pylint: disable=too-many-locals,too-many-branches,too-many-statements
+        # pylint: disable=too-many-return-statements
+        words = {}
+        groups = set()
+        motion, plane = self.motion, self.plane
+        absolute, inches = self.absolute, self.inches
+        inverse_time = self.inverse_time
+        coordinate_system = self.coordinate_system
+        non_modal = None # (G number, hundredths)
+        axis_command = None # motion, non_modal or tool_offset
+        dynamic_offset = False # G43.1
+        program_end = False
+        pos = 0
+        ## Parse the words, failing on the first bad one
+        for match in WORD.finditer(line):
+            if match.start() != pos:
+                break
+            pos = match.end()
+            letter, value = match.group(1), float(match.group(2))
+            if letter == "G":
+                number, mantissa = _split(value)
+                if number in (0, 1, 2, 3, 38, 80):
+                    if number != 80:
+                        if axis_command:
+                            return 24
+                        axis_command = "motion"
+                    if number == 38:
+                        if mantissa not in (20, 30, 40, 50):
+                            return 20
+                        mantissa = 0
+                    group, motion = 1, None if number == 80 else number
+                elif number in (4, 10, 28, 30, 53, 92):
+                    if number in (10, 28, 30, 92) and mantissa == 0:
+                        if axis_command:
+                            return 24
+                        axis_command = "non_modal"
+                    non_modal = (number, 0)
+                    if number in (28, 30, 92):
+                        if mantissa not in (0, 10):
+                            return 20
+                        non_modal = (number, mantissa)
+                        mantissa = 0
+                    group = 0
+                elif number in PLANES:
+                    group, plane = 2, number
+                elif number in (90, 91):
+                    if mantissa == 0:
+                        group, absolute = 3, number == 90
+                    elif mantissa != 10 or number == 90:
+                        return 20
+                    else: # G91.1, which is how Grbl always takes IJK
+                        group, mantissa = 4, 0
+                elif number in (93, 94):
+                    group, inverse_time = 5, number == 93
+                elif number in (20, 21):
+                    group, inches = 6, number == 20
+                elif number == 40:
+                    group = 7
+                elif number in (43, 49):
+                    if axis_command:
+                        return 24
+                    axis_command = "tool_offset"
+                    if number == 43:
+                        if mantissa != 10:
+                            return 20
+                        dynamic_offset = True
+                    group, mantissa = 8, 0 # G49 takes any .x
+                elif 54 <= number <= 59:
+                    group, coordinate_system = 12, number - 53
+                elif number == 61:
+                    if mantissa != 0:
+                        return 20
+                    group = 13
+                else:
+                    return 20
+                if mantissa > 0:
+                    return 23
+                if ("G", group) in groups:
+                    return 21
+                groups.add(("G", group))
+            elif letter == "M":
+                number, mantissa = _split(value)
+                if mantissa > 0:
+                    return 23
+                if number in (0, 1, 2, 30):
+                    group = 4
+                    program_end = number in (2, 30)
+                elif number in (3, 4, 5):
+                    group = 7
+                elif number in (8, 9):
+                    group = 8
+                else:
+                    return 20
+                if ("M", group) in groups:
+                    return 21
+                groups.add(("M", group))
+            else:
+                if letter not in VALUE_WORDS:
+                    return 20
+                if letter == "T" and value > MAX_TOOL_NUMBER:
+                    return 38
+                if letter in words:
+                    return 25
+                if letter in "FNPST" and value < 0:
+                    return 4
+                words[letter] = value
+        if pos != len(line):
+            # A letter without a proper number, or no letter at all
+            return 2 if line[pos].isalpha() else 1
+        ## Check the block as a whole
+        axis_words = [letter for letter in AXES if letter in words]
+        if axis_words and not axis_command:
+            axis_command = "motion"
+        used = set("NFST")
+        if jog:
+            if groups - set((("G", 0), ("G", 3), ("G", 6))) or \
+               non_modal not in (None, (53, 0)):
+                return 16
+            if "F" not in words:
+                return 22
+            used = set("NF")
+            motion = 1
+        if "N" in words and words["N"] > MAX_LINE_NUMBER:
+            return 27
+        scale = 25.4 if inches else 1.0
+        if inverse_time:
+            if axis_command == "motion" and motion not in (None, 0) and \
+               "F" not in words:
+                return 22
+            feed = words.get("F", 0.0)
+        elif "F" in words:
+            feed = words["F"] * scale
+        else:
+            feed = 0.0 if self.inverse_time else self.feed
+        if non_modal == (4, 0):
+            if "P" not in words:
+                return 28
+            used.add("P")
+        if dynamic_offset and axis_words != ["Z"]:
+            return 37
+        if non_modal == (10, 0):
+            if not axis_words:
+                return 26
+            if "P" not in words and "L" not in words:
+                return 28
+            # Grbl takes a missing P or L as 0
+            if int(words.get("P", 0)) > COORDINATE_SYSTEMS:
+                return 29
+            if words.get("L") not in (2, 20) or \
+               (words["L"] == 2 and "R" in words):
+                return 20
+            used.update("LP")
+        elif non_modal == (92, 0) and not axis_words:
+            return 26
+        elif non_modal == (53, 0) and motion not in (0, 1):
+            return 30
+        target = list(self.position)
+        for axis, letter in enumerate(AXES):
+            if letter in words:
+                value = words[letter] * scale
+                if absolute or non_modal == (53, 0):
+                    target[axis] = value
+                else:
+                    target[axis] += value
+        if motion is None:
+            if axis_words: # Even for G10/G28/G30/G92, as in Grbl
+                return 31
+        elif axis_command == "motion":
+            if motion != 0 and feed == 0.0:
+                return 22
+            if motion in (0, 1):
+                if not axis_words:
+                    axis_command = None
+            elif motion == 38:
+                if not axis_words:
+                    return 26
+                if target == self.position:
+                    return 33
+            else:
+                code = self._arc(words, axis_words, plane, target, scale, used)
+                if code:
+                    return code
+        if axis_command:
+            used.update(AXES)
+        if set(words) - used:
+            return 36
+        ## It's good, so it happens
+        if jog:
+            return 0
+        self.motion, self.plane = motion, plane
+        self.absolute, self.inches = absolute, inches
+        self.inverse_time, self.feed = inverse_time, feed
+        self.coordinate_system = coordinate_system
+        if program_end:
+            self.motion, self.plane = 1, 17
+            self.absolute, self.inverse_time = True, False
+            self.coordinate_system = 1
+        if non_modal == (92, 0) or (non_modal == (10, 0) and
+                                    words["L"] == 20 and
+                                    int(words.get("P", 0)) in
+                                    (0, coordinate_system)):
+            # The current position is now the given one
+            for axis, letter in enumerate(AXES):
+                if letter in words:
+                    self.position[axis] = words[letter] * scale
+        elif non_modal in ((28, 0), (30, 0)):
+            self.position = [0.0, 0.0, 0.0]
+        elif axis_command == "motion":
+            self.position = target
+        return 0
+
+    def _arc(self, words, axis_words, plane, target, scale, used):
+        """Check the arc of a G2/G3 block, return its error code"""
+        # pylint: disable=too-many-arguments
+        if not axis_words:
+            return 26
+        first, second = PLANES[plane]
+        if AXES[first] not in words and AXES[second] not in words:
+            return 32
+        d_x = target[first] - self.position[first]
+        d_y = target[second] - self.position[second]
+        if "R" in words:
+            used.add("R")
+            if target == self.position:
+                return 33
+            radius = words["R"] * scale
+            if 4.0*radius*radius - d_x*d_x - d_y*d_y < 0:
+                return 34
+            return 0
+        if OFFSETS[first] not in words and OFFSETS[second] not in words:
+            return 35
+        used.update(OFFSETS)
+        offset_i = words.get(OFFSETS[first], 0.0) * scale
+        offset_j = words.get(OFFSETS[second], 0.0) * scale
+        radius = math.hypot(offset_i, offset_j)
+        delta = abs(math.hypot(d_x-offset_i, d_y-offset_j) - radius)
+        if delta > ARC_TOLERANCE and (delta > ARC_ERROR or
+                                      delta > ARC_ERROR_RATIO*radius):
+            return 33
+        return 0
+
+
+def check_lines(lines, sources=None):
+    """Check a job, lines of gcode from its start as str, bytes or
+    memoryviews, return the (line number, error code) of every line Grbl
+    would reject; line numbers come from sources, or count from 1"""
+    checker = GcodeChecker()
+    errors = []
+    for index, line in enumerate(lines):
+        code = checker.check(line)
+        if code:
+            errors.append((sources[index] if sources is not None else index+1,
+                           code))
+    logger.debug("Check found %d errors", len(errors))
+    return errors
@@ -8,8 +8,18 @@ __email__ = "d.armitage89@gmail.com"
 
 
 ####---- Imports ----####
+from array import array
+from collections import deque
+from itertools import islice
+from threading import Thread, Event
+
 import re
+import mmap
 import logging
+import multiprocessing
+
+from MoveTable import MoveTable, tokenize
+from GrblCodes import LIMITS
 
 logger = logging.getLogger(__name__) #pylint: disable=invalid-name
 
@@ -18,24 +28,270 @@ WHITESPACE = re.compile(r"""
                         \s       # whitespace
                         |\(.*?\) # or anything inside parentheses
                         """, (re.VERBOSE | re.IGNORECASE))
-RAPID = re.compile(r"""
-                   G0?1        # G1 or G01
-                   ([X|Y]      # X or Y...
-                   \d+\.?\d+)  # followed by a number...
-                   ([X|Y]      # and another X or Y...
-                    \d+\.?\d+) # followed by a number...
-                   """, (re.VERBOSE | re.IGNORECASE))
+LOAD_CHUNK = 4096 # Lines GcodeLoader compiles between progress updates
+PARALLEL_BYTES = 4 * 2**20 # Files GcodeLoader parses in parallel, if bigger
+PARSE_CHUNK_BYTES = 2**20 # Size of the byte ranges parsed in parallel
+PARSE_TIMEOUT = 60 # seconds a worker may take over a range before giving up
+
+class MappedLines(object):
+    """Lazy, memory-mapped sequence of the (whitespace-stripped) lines of a
+    file
+
+    Only the offsets of the line endings are kept, and only as far as they
+    have been needed, so iteration can start before the whole file has been
+    scanned and memory use stays at about the size of the file."""
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        except ValueError: # Empty files can't be mapped
+            self._map = b""
+        self.size = len(self._map)
+        # Offset one past the end of each line found so far
+        self._ends = array("I" if self.size < 2**32 else "L")
+        self._complete = self.size == 0
+
+    def _scan(self, count):
+        """Find the ends of up to count more lines"""
+        ends = self._ends
+        pos = ends[-1] if ends else 0
+        for _ in range(count):
+            newline = self._map.find(b"\n", pos)
+            if newline < 0:
+                if pos < self.size:
+                    ends.append(self.size)
+                self._complete = True
+                return
+            pos = newline + 1
+            ends.append(pos)
+        self._complete = pos >= self.size
+
+    @property
+    def scanned(self):
+        """Bytes of the file scanned for line endings so far"""
+        return self._ends[-1] if self._ends else 0
+
+    def raw_line(self, index):
+        """Return the bytes of line index, newline included"""
+        if index < 0:
+            index += len(self)
+        while index >= len(self._ends) and not self._complete:
+            self._scan(index - len(self._ends) + 1)
+        if not 0 <= index < len(self._ends):
+            raise IndexError("line index out of range")
+        start = self._ends[index-1] if index else 0
+        return self._map[start:self._ends[index]]
+
+    def __getitem__(self, index):
+        return WHITESPACE.sub("", self.raw_line(index).decode("ascii",
+                                                              "replace"))
+
+    def __iter__(self):
+        index = 0
+        while True:
+            if index >= len(self._ends):
+                if self._complete:
+                    return
+                self._scan(1024)
+                continue
+            yield self[index]
+            index += 1
+
+    def __len__(self):
+        while not self._complete:
+            self._scan(4096)
+        return len(self._ends)
+
+    def __bool__(self):
+        return self.size > 0
+    __nonzero__ = __bool__
+
+    def ranges(self, size):
+        """Return (start, end) byte ranges of about size bytes that cover
+        the file, each ending at the end of a line"""
+        ranges = []
+        start = 0
+        while start < self.size:
+            newline = self._map.find(b"\n", start+size-1)
+            end = self.size if newline < 0 else newline+1
+            ranges.append((start, end))
+            start = end
+        return ranges
+
+    def close(self):
+        """Release the map and the underlying file"""
+        if not isinstance(self._map, bytes):
+            self._map.close()
+        self._file.close()
+
+
+class WireBuffer(object):
+    """Wire-ready form of a file of gcode
+
+    Every non-empty line, upper-cased and terminated with a newline, is
+    packed into the single buffer data; line i is the slice
+    data[offsets[i]:offsets[i]+lengths[i]] and came from line sources[i]
+    (counting from 1) of the file. Lines are expected to have had their
+    whitespace and comments removed already.
+
+    Given lines, it is compiled at once. Otherwise lines are added with
+    extend() until finish(), and can be streamed while that goes on: size
+    then has to be at least the bytes that will be added (the file size
+    plus one will do), so the buffer never moves."""
+    def __init__(self, lines=None, size=None):
+        self.offsets = array("I")
+        self.lengths = array("I")
+        self.sources = array("I")
+        self.complete = False # Whether every line is in
+        self._used = 0
+        if size is None:
+            self.data = bytearray()
+            self._view = None
+        else:
+            self.data = bytearray(size)
+            self._view = memoryview(self.data)
+        if lines is not None:
+            self.extend(lines)
+            self.finish()
+
+    def extend(self, lines, first=1):
+        """Add lines, the first of them being line first of the file"""
+        data, used = self.data, self._used
+        for number, line in enumerate(lines, first):
+            if not line:
+                continue
+            if isinstance(line, bytes):
+                block = line.upper() + b"\n"
+            else:
+                block = line.upper().encode("ascii", "replace") + b"\n"
+            end = used + len(block)
+            if self._view is None:
+                data += block
+            elif end > len(data):
+                raise ValueError("WireBuffer is full")
+            else:
+                data[used:end] = block
+            self.sources.append(number)
+            self.lengths.append(len(block))
+            self.offsets.append(used) # Last, as len() goes by offsets
+            used = end
+            self._used = used
+
+    def add_compiled(self, data, lengths, sources, first=1):
+        """Add the data, lengths and sources of a WireBuffer compiled
+        elsewhere, its line 1 being line first of the file"""
+        used = self._used
+        end = used + len(data)
+        if self._view is None:
+            self.data += data
+        elif end > len(self.data):
+            raise ValueError("WireBuffer is full")
+        else:
+            self.data[used:end] = data
+        offsets = array("I")
+        for length in lengths:
+            offsets.append(used)
+            used += length
+        self.sources.extend(array("I", (number + first - 1
+                                        for number in sources)))
+        self.lengths.extend(lengths)
+        self.offsets.extend(offsets) # Last, as len() goes by offsets
+        self._used = end
+
+    def finish(self):
+        """Mark the buffer complete, return self"""
+        if self._view is None:
+            self.data = bytes(self.data)
+            self._view = memoryview(self.data)
+        else:
+            self.data = self._view[:self._used]
+        self.complete = True
+        logger.debug("Wire buffer: %d lines, %d bytes",
+                     len(self.offsets), self._used)
+        return self
+
+    @classmethod
+    def from_arrays(cls, data, offsets, lengths, sources):
+        """Return a complete WireBuffer from parts compiled before"""
+        wire = cls()
+        wire.data = data
+        wire.offsets, wire.lengths, wire.sources = offsets, lengths, sources
+        wire._used = len(data)
+        wire._view = memoryview(data)
+        wire.complete = True
+        return wire
+
+    def line(self, index):
+        """Return a zero-copy view of line index, newline included"""
+        offset = self.offsets[index]
+        return self._view[offset:offset+self.lengths[index]]
+
+    def __iter__(self):
+        for index in range(len(self.offsets)):
+            yield self.line(index)
+
+    def __len__(self):
+        return len(self.offsets)
+
+
+def _parse_range(job):
+    """Compile and tokenize the lines in a byte range of a file, in a
+    worker process of GcodeFile.parse_parallel()"""
+    path, start, end = job
+    with open(path, "rb") as gcode_file:
+        gcode_file.seek(start)
+        raw = gcode_file.read(end-start)
+    lines = raw.split(b"\n")
+    if not lines[-1]:
+        lines.pop() # The newline ends the last line, it doesn't start one
+    wire = WireBuffer(WHITESPACE.sub("", line.decode("ascii", "replace"))
+                      for line in lines)
+    return (len(lines), wire.data, wire.lengths, wire.sources,
+            tokenize(wire, wire.sources))
+
+def _parse_ranges(pool, path, ranges, timeout):
+    """Yield _parse_range() of each of ranges of the file at path, in order,
+    handing pool only a few more than it has workers at a time, so a load
+    that stops early leaves it little to finish"""
+    ahead = 2 * multiprocessing.cpu_count()
+    queued = deque()
+    for start, end in ranges:
+        queued.append(pool.apply_async(_parse_range, [(path, start, end)]))
+        if len(queued) > ahead:
+            yield queued.popleft().get(timeout)
+    while queued:
+        yield queued.popleft().get(timeout)
+
+def parse_pool(processes=None):
+    """Return a multiprocessing.Pool of processes workers for
+    GcodeFile.parse_parallel(), all the cores by default, or None if there
+    is only the one
+
+    Forking while another thread holds a lock can leave the child stuck on
+    it, so make the pool at startup, before any threads, and keep it."""
+    if (processes or multiprocessing.cpu_count()) < 2:
+        return None
+    return multiprocessing.Pool(processes)
+
 
 class GcodeFile(object):
-    """A file of gcode"""
-    def __init__(self, gcode_file=None):
+    """A file of gcode
+
+    With lazy=True the file is memory-mapped (see MappedLines) and the
+    bounding box is only worked out when first needed."""
+    def __init__(self, gcode_file=None, lazy=False):
         self.file = gcode_file
-        self.flat_xy_gen = None
+        self.lazy = lazy
         self.gcode = None
+        self.wire = None
+        self.moves = None # See move_table()
         self.extrema = dict(X=[float("inf"), 0], Y=[float("inf"), 0],
                             UL=(None, None), DR=(None, None),
                            )
         self.mids = dict(X=None, Y=None)
+        self.stats = None # See statistics()
         if self.file and not self.gcode:
             logger.debug("Converting file to gcode on init")
             self.add_file(gcode_file)
@@ -44,56 +300,106 @@ class GcodeFile(object):
     def add_file(self, gcode_file):
         """Read in a file of Gcode"""
         logger.info("File added")
+        self.close()
         self.file = gcode_file
+        self.wire = None
+        self.moves = None
         self.gcode = self.__convert_gcode_internal()
 
+    def close(self):
+        """Release the memory map of a lazily loaded file"""
+        if isinstance(self.gcode, MappedLines):
+            self.gcode.close()
+
     def __convert_gcode_internal(self):
         """Convert gcode into format that can be easily manipulated"""
         logger.info("Converting file to internal format")
-        with open(self.file, "rU") as gcode_file:
-            logger.info("Reading %s", self.file)
-            gcode = [WHITESPACE.sub("", line) for line in gcode_file]
-            groups = (RAPID.match(line).groups()
-                      for line in gcode
-                      if bool(RAPID.match(line))
-                     )
-            self.flat_xy_gen = (xory for tup in groups for xory in tup)
-            logger.debug("Generators created")
-            self._calc_extrema_coords()
-            self._calc_mid_coords()
-            return gcode
-
-
-    def _calc_extrema_coords(self):
-        """Calculate min/max bounding values"""
-        logger.info("Calculating extrema coordinates")
-        for item in self.flat_xy_gen:
-            num = float(item[1:])
-            coord = item[0]
-            if coord == "X":
-                if num < self.extrema["X"][0]:
-                    self.extrema["X"][0] = num
-                if num > self.extrema["X"][1]:
-                    self.extrema["X"][1] = num
-            elif coord == "Y":
-                if num < self.extrema["Y"][0]:
-                    self.extrema["Y"][0] = num
-                if num > self.extrema["Y"][1]:
-                    self.extrema["Y"][1] = num
-            else:
-                logger.warning("Coordinate not for X or Y")
+        if self.lazy:
+            logger.info("Mapping %s", self.file)
+            self.gcode = MappedLines(self.file)
+        else:
+            with open(self.file, "rU") as gcode_file:
+                logger.info("Reading %s", self.file)
+                self.gcode = [WHITESPACE.sub("", line) for line in gcode_file]
+            self._analyze()
+        return self.gcode
+
+    def wire_buffer(self):
+        """Return the WireBuffer of the file, compiling it on first use"""
+        if self.wire is None:
+            logger.info("Compiling wire buffer")
+            self.wire = WireBuffer(self.gcode)
+        return self.wire
+
+    def parse_parallel(self, pool, progress=None, timeout=PARSE_TIMEOUT):
+        """Compile the wire buffer and move table of a lazy file across the
+        worker processes of pool (see parse_pool())
+
+        The file is split into byte ranges of PARSE_CHUNK_BYTES, which the
+        workers compile and tokenize with no idea of the modal state. The
+        results are stitched together in order, the wire buffer growing so
+        it can be streamed already, and MoveTable.from_tokens() carries the
+        position, G90/G91, units, feed and power across the chunks, so
+        everything comes out the same as from one process. progress(bytes)
+        is called after every chunk, and may raise to stop. A range that
+        takes longer than timeout seconds raises RuntimeError."""
+        lines = self.gcode
+        ranges = lines.ranges(PARSE_CHUNK_BYTES)
+        wire = self.wire = WireBuffer(size=lines.size+1)
+        self.moves = None
+        chunks = []
+        number = 1
+        try:
+            parsed = _parse_ranges(pool, self.file, ranges, timeout)
+            for (_, end), (count, data, lengths, sources, tokens) in \
+                    zip(ranges, parsed):
+                wire.add_compiled(data, lengths, sources, number)
+                tokens["line"] += number - 1
+                chunks.append(tokens)
+                number += count
+                if progress is not None:
+                    progress(end)
+        except multiprocessing.TimeoutError:
+            self.wire = None
+            raise RuntimeError("A parse worker took over {} s".format(timeout))
+        except BaseException:
+            self.wire = None # Start again next time
+            raise
+        finally:
+            wire.finish() # Ends whatever is streaming from it
+        self.moves = MoveTable.from_tokens(chunks)
+        logger.info("Parsed %s in %d chunks", self.file, len(ranges))
+        return wire
+
+    def move_table(self):
+        """Return the MoveTable of the file, interpreting it on first use"""
+        if self.moves is None:
+            logger.info("Building move table")
+            self.moves = MoveTable.from_wire(self.wire_buffer())
+        return self.moves
+
+    def _analyze(self):
+        """Work out the extrema and mid point from the move table"""
+        bounds = self.move_table().bounds()
+        if bounds is None: # No cuts, so frame the rapids instead
+            bounds = self.moves.bounds(cuts_only=False)
+        if bounds is not None:
+            x_min, y_min, x_max, y_max = bounds
+            self.extrema["X"] = [x_min, x_max]
+            self.extrema["Y"] = [y_min, y_max]
         self.extrema["UL"] = (self.extrema["X"][0],
                               self.extrema["Y"][0])
         self.extrema["DR"] = (self.extrema["X"][1],
                               self.extrema["Y"][1])
         logger.debug("Extrema: %s", self.extrema)
+        self._calc_mid_coords()
 
     def bounding_box_coords(self):
         """Take in file of gcode, return tuples of min/max bounding values"""
         if not self.file:
             logger.error("Load file first")
         if (None, None) in self.extrema.values():
-            self.__convert_gcode_internal()
+            self._analyze()
         logger.info("Corner extrema: %s & %s",
                     self.extrema["UL"], self.extrema["DR"])
         return (self.extrema["UL"], self.extrema["DR"])
@@ -127,18 +433,43 @@ class GcodeFile(object):
         logger.debug("gcode: %s", gcode)
         return gcode
 
+    def statistics(self):
+        """Return a dict of the moves in the file and how long it will take
+
+        rapids and cuts count the G0 and G1/G2/G3 moves, rapid_mm and cut_mm
+        are how far they go, along the arc for arcs, and seconds is an
+        estimate of the time to run it, with no acceleration and rapids at
+        RAPID_RATE."""
+        if self.stats is None:
+            self.stats = self.move_table().statistics()
+            logger.debug("Statistics: %s", self.stats)
+        return self.stats
+
+    def off_limits(self, limits=LIMITS, offset=(0.0, 0.0)):
+        """Return the lines of the file, counting from 1, whose moves go
+        outside limits, a dict of X and Y (min, max) machine positions
+        like LIMITS, with the work coordinates offset by offset (see
+        MoveTable.outside())"""
+        table = self.move_table()
+        rows = table.outside(limits["X"], limits["Y"], offset)
+        lines = sorted(set(table.line[rows].tolist()))
+        if lines:
+            logger.warning("%d lines go outside %s, first line %d",
+                           len(lines), limits, lines[0])
+        return lines
+
     def _calc_mid_coords(self):
         """Calculate coordinates for middle of workpiece"""
         logger.info("Calculating mid values")
         if (None, None) in self.extrema.values():
-            self.__convert_gcode_internal()
+            self._analyze()
         self.mids["X"] = sum(self.extrema["X"]) / 2.0
         self.mids["Y"] = sum(self.extrema["Y"]) / 2.0
 
     def mid_coords(self):
         """Return (x,y) of coordinates of middle of file"""
         if (None, None) in self.extrema.values():
-            self.__convert_gcode_internal()
+            self._analyze()
         if None in self.mids.values():
             self._calc_mid_coords()
         return (self.mids["X"], self.mids["Y"])
@@ -166,6 +497,157 @@ class GcodeFile(object):
         return gcode
 
 
+class LoadCancelled(Exception):
+    """GcodeLoader.cancel() was called before the file was loaded"""
+
+
+class GcodeLoader(object):
+    """Loads a GcodeFile on a worker thread, so the GUI doesn't freeze
+
+    The wire buffer is compiled first, LOAD_CHUNK lines at a time, and can
+    be streamed as soon as the first chunk is in (see streamable()), long
+    before the bounding box has been worked out. size, bytes_read, lines
+    and stage say how far it has got. Given a pool from parse_pool(), files
+    of PARALLEL_BYTES or more are compiled across its workers instead (see
+    GcodeFile.parse_parallel()).
+
+    Given a ParseCache as cache, a file found in it is loaded from there,
+    and anything else is saved to it once loaded.
+
+    A job streamed from a load that is then cancelled, or fails, ends where
+    the loading stopped, so stop the run as well."""
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, path, gcodefile=None, cache=None, pool=None):
+        self.path = path
+        self.gcodefile = gcodefile
+        self.cache = cache
+        self.pool = pool
+        self.size = 0 # bytes
+        self.bytes_read = 0
+        self.lines = 0 # Wire lines compiled
+        self.stage = "waiting" # then compiling, analyzing, done
+        self.error = None
+        self.wire_ready = Event() # Set once there is something to stream
+        self.done = Event()
+        self._cancel = Event()
+        self._thread = None
+
+    def start(self):
+        """Start loading on a new thread, return self"""
+        self._thread = Thread(target=self.run, name="GcodeLoader")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def cancel(self):
+        """Stop loading as soon as possible"""
+        self._cancel.set()
+
+    def failed(self):
+        """Whether loading was cancelled or went wrong"""
+        return self.done.is_set() and self.error is not None
+
+    def progress(self):
+        """Return the fraction of the file compiled so far"""
+        if self.done.is_set():
+            return 1.0
+        return self.bytes_read / float(self.size) if self.size else 0.0
+
+    def streamable(self, timeout=None):
+        """Wait for the first chunk, return the GcodeFile to stream"""
+        self.wire_ready.wait(timeout)
+        if self.error is not None:
+            raise self.error
+        return self.gcodefile
+
+    def result(self, timeout=None):
+        """Wait for the whole file, return its GcodeFile"""
+        self.done.wait(timeout)
+        if self.error is not None:
+            raise self.error
+        return self.gcodefile
+
+    def _check(self):
+        """Raise LoadCancelled if cancel() was called"""
+        if self._cancel.is_set():
+            raise LoadCancelled(self.path)
+
+    def _parsed(self, bytes_read):
+        """Note a chunk parsed by GcodeFile.parse_parallel()"""
+        self.lines = len(self.gcodefile.wire)
+        self.bytes_read = bytes_read
+        self.wire_ready.set()
+        self._check()
+
+    def run(self):
+        """Load in the calling thread"""
+        try:
+            self._load()
+        except LoadCancelled as ex:
+            logger.info("Loading %s cancelled", self.path)
+            self.error = ex
+        except Exception as ex: # pylint: disable=broad-except
+            logger.exception("Loading %s failed", self.path)
+            self.error = ex
+        finally:
+            self.wire_ready.set()
+            self.done.set()
+
+    def _load(self):
+        """Compile the wire buffer, then find the bounding box"""
+        if self.gcodefile is None:
+            self.gcodefile = GcodeFile(self.path, lazy=True)
+        gcodefile = self.gcodefile
+        lines = gcodefile.gcode
+        self.size = getattr(lines, "size", 0)
+        cached = self.cache is not None and gcodefile.wire is None and \
+                 self.cache.load(gcodefile)
+        if gcodefile.wire is None and isinstance(lines, MappedLines) and \
+                self.size >= PARALLEL_BYTES and self.pool is not None:
+            self.stage = "compiling"
+            gcodefile.parse_parallel(self.pool, progress=self._parsed)
+        if gcodefile.wire is None:
+            self.stage = "compiling"
+            # Sized up front, the buffer can be streamed while it grows
+            presized = isinstance(lines, MappedLines)
+            wire = gcodefile.wire = WireBuffer(
+                size=self.size+1 if presized else None)
+            source = iter(lines)
+            number = 1
+            try:
+                while True:
+                    self._check()
+                    chunk = list(islice(source, LOAD_CHUNK))
+                    if not chunk:
+                        break
+                    wire.extend(chunk, number)
+                    number += len(chunk)
+                    self.lines = len(wire)
+                    self.bytes_read = getattr(lines, "scanned", 0)
+                    if presized:
+                        self.wire_ready.set()
+            except BaseException:
+                gcodefile.wire = None # Start again next time
+                raise
+            finally:
+                wire.finish() # Ends whatever is streaming from it
+        self.lines = len(gcodefile.wire)
+        self.bytes_read = self.size
+        self.wire_ready.set()
+        self._check()
+        self.stage = "analyzing"
+        gcodefile.bounding_box_coords()
+        gcodefile.statistics()
+        if self.cache is not None and not cached:
+            try:
+                self.cache.store(gcodefile)
+            except (IOError, OSError):
+                logger.exception("Couldn't save %s to the parse cache",
+                                 self.path)
+        self.stage = "done"
+        logger.info("Loaded %s: %d lines", self.path, self.lines)
+
+
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
     stress = GcodeFile("serial_stress_test.gcode") # pylint: disable=invalid-name
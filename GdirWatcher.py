@@ -0,0 +1,286 @@
+#!/usr/bin/env python2
+# coding=UTF-8
+"""Watch GDIR, and get new jobs ready before anybody asks for them
+
+Visicut saves jobs into GDIR. GdirWatcher notices new and changed gcode
+files there, with inotify where there is one and by polling otherwise, and
+loads each one through a ParseCache in a low-priority worker process (see
+watch_pool()), so a running job doesn't notice. By the time somebody picks
+the job at the machine it opens in milliseconds, and jobs
+holds the lines, time estimate and any problem of every file for the file
+picker to show."""
+
+__author__ = "Dylan Armitage"
+__email__ = "d.armitage89@gmail.com"
+
+####---- Imports ----####
+from threading import Thread, Lock, Event
+
+import os
+import time
+import errno
+import ctypes
+import ctypes.util
+import select
+import struct
+import logging
+import multiprocessing
+
+from GcodeParser import GcodeLoader
+from ParseCache import ParseCache
+
+logger = logging.getLogger(__name__) #pylint: disable=invalid-name
+
+####---- Variables ----####
+WATCH_POLL = 2.0 # seconds between scans when polling
+SETTLE = 1.0 # seconds a polled file has to stay the same before loading
+NICENESS = 10 # How much less important the loading is
+WATCH_WORKERS = 1 # Processes of watch_pool()
+GCODE_EXT = (".gcode", ".gc", ".nc", ".cnc", ".ncg", ".txt")
+## inotify
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_DELETE = 0x200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+IN_EVENT = struct.Struct("iIII") # wd, mask, cookie, len, then the name
+
+
+def _lower_priority():
+    """Make the calling process, or thread on Linux, give way to the rest"""
+    try:
+        os.nice(NICENESS)
+    except OSError:
+        pass
+
+def watch_pool(processes=WATCH_WORKERS):
+    """Return a multiprocessing.Pool of low-priority processes for
+    GdirWatcher to load in, apart from the GcodeParser.parse_pool() of the
+    jobs being run; like that one, make it before any threads"""
+    return multiprocessing.Pool(processes, initializer=_lower_priority)
+
+def _preload(path, cache):
+    """Load path into cache, return the fields of its entry in jobs"""
+    loader = GcodeLoader(path, cache=cache)
+    loader.run()
+    if loader.error is not None:
+        return dict(status="error", error=str(loader.error))
+    gcodefile = loader.gcodefile
+    stats = gcodefile.statistics()
+    fields = dict(status="ready" if stats["cuts"] else "empty",
+                  lines=loader.lines, seconds=stats["seconds"],
+                  cut_mm=stats["cut_mm"],
+                  extrema=(gcodefile.extrema["UL"], gcodefile.extrema["DR"]),
+                  error=None if stats["cuts"] else "No cutting moves")
+    gcodefile.close()
+    return fields
+
+def _preload_worker(job):
+    """_preload() in a worker of watch_pool(), job being the path and the
+    directory and max_bytes of the ParseCache, if there is one"""
+    path, directory, max_bytes = job
+    cache = ParseCache(directory, max_bytes) if directory else None
+    return _preload(path, cache)
+
+
+####---- Classes ----####
+class Inotify(object):
+    """The inotify events of one directory, through libc by ctypes"""
+    MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE
+
+    def __init__(self, directory):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                           use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError(errno.ENOSYS, "No inotify")
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if not isinstance(directory, bytes):
+            directory = directory.encode("utf-8")
+        if libc.inotify_add_watch(self.fd, directory, self.MASK) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, "inotify_add_watch failed")
+
+    def wait(self, timeout):
+        """Wait up to timeout seconds, return the names of the files that
+        were written, moved or deleted, as (name, gone) pairs"""
+        try:
+            if not select.select([self.fd], [], [], timeout)[0]:
+                return []
+            data = os.read(self.fd, 65536)
+        except (OSError, select.error):
+            return []
+        events = []
+        offset = 0
+        while offset + IN_EVENT.size <= len(data):
+            mask, length = IN_EVENT.unpack_from(data, offset)[1::2]
+            offset += IN_EVENT.size
+            name = data[offset:offset+length].rstrip(b"\0")
+            offset += length
+            events.append((name.decode("utf-8", "replace"),
+                           bool(mask & (IN_MOVED_FROM | IN_DELETE))))
+        return events
+
+    def close(self):
+        """Stop watching"""
+        os.close(self.fd)
+
+
+class GdirWatcher(object):
+    """Loads the gcode files of directory into cache as they arrive
+
+    jobs maps each file name to a dict of path, size, mtime, status
+    (waiting, loading, ready, empty or error), and once loaded lines,
+    seconds, cut_mm, extrema and error. seq goes up with every change.
+    Files are loaded in the workers of pool, from watch_pool(), or without
+    one on the watching thread, which holds the GIL while it does."""
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, directory, cache, extensions=GCODE_EXT, poll=False,
+                 pool=None):
+        # pylint: disable=too-many-arguments
+        self.directory = directory
+        self.cache = cache
+        self.pool = pool
+        self.extensions = tuple(ext.lower() for ext in extensions)
+        self.jobs = {}
+        self.seq = 0
+        self._lock = Lock()
+        self._pending = {} # name : (size, mtime) when last seen
+        self._stop = Event()
+        self._thread = None
+        self._inotify = None
+        if not poll:
+            try:
+                self._inotify = Inotify(directory)
+            except (OSError, AttributeError):
+                logger.info("No inotify, polling %s", directory)
+
+    def start(self):
+        """Start watching, return self"""
+        self._thread = Thread(target=self._watch, name="GdirWatcher")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop watching, once a file being loaded on the thread is done"""
+        self._stop.set()
+
+    def snapshot(self):
+        """Return a copy of jobs, sorted newest first"""
+        with self._lock:
+            jobs = [dict(job) for job in self.jobs.values()]
+        return sorted(jobs, key=lambda job: job["mtime"], reverse=True)
+
+    def _wanted(self, name):
+        """Whether name looks like a gcode file"""
+        return name.lower().endswith(self.extensions) and \
+               not name.startswith(".")
+
+    def _update(self, name, **fields):
+        """Change, or add, the entry of name in jobs"""
+        with self._lock:
+            self.jobs.setdefault(name, dict(name=name)).update(fields)
+            self.seq += 1
+
+    def _forget(self, name):
+        """Drop name from jobs"""
+        self._pending.pop(name, None)
+        with self._lock:
+            if self.jobs.pop(name, None) is not None:
+                self.seq += 1
+
+    def _stat(self, name):
+        """Return (size, mtime) of name, or None if it is gone"""
+        try:
+            stat = os.stat(os.path.join(self.directory, name))
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime
+
+    def _scan(self):
+        """Queue up every file that is new or changed since it was seen"""
+        try:
+            names = set(name for name in os.listdir(self.directory)
+                        if self._wanted(name))
+        except OSError:
+            logger.exception("Can't list %s", self.directory)
+            return
+        for name in set(self.jobs) - names:
+            self._forget(name)
+        for name in names:
+            seen = self._stat(name)
+            job = self.jobs.get(name)
+            if seen is not None and (job is None or
+                                     (job["size"], job["mtime"]) != seen):
+                self._pending.setdefault(name, None)
+
+    def _watch(self):
+        """Wait for files and load them, one at a time"""
+        _lower_priority()
+        self._scan()
+        loaded = False
+        while not self._stop.is_set():
+            if self._inotify is not None:
+                timeout = 0.0 if self._pending else WATCH_POLL
+                for name, gone in self._inotify.wait(timeout):
+                    if not self._wanted(name):
+                        continue
+                    if gone:
+                        self._forget(name)
+                    else:
+                        self._pending[name] = None # Written and closed
+            else:
+                if not loaded:
+                    self._stop.wait(SETTLE if self._pending else WATCH_POLL)
+                self._scan()
+            loaded = self._load_settled()
+        if self._inotify is not None:
+            self._inotify.close()
+
+    def _load_settled(self):
+        """Load the first pending file that has stopped changing, return
+        whether there was one"""
+        for name, last_seen in list(self._pending.items()):
+            seen = self._stat(name)
+            if seen is None:
+                self._forget(name)
+                continue
+            if self._inotify is None and seen != last_seen:
+                # Polled, and maybe still being written
+                self._pending[name] = seen
+                self._update(name, path=os.path.join(self.directory, name),
+                             size=seen[0], mtime=seen[1], status="waiting")
+                continue
+            del self._pending[name]
+            self._load(name, seen)
+            return True
+        return False
+
+    def _load(self, name, seen):
+        """Load name into the cache, and note how it went"""
+        path = os.path.join(self.directory, name)
+        self._update(name, path=path, size=seen[0], mtime=seen[1],
+                     status="loading")
+        t_start = time.time()
+        if self.pool is None:
+            fields = _preload(path, self.cache)
+        else:
+            cache = self.cache
+            result = self.pool.apply_async(_preload_worker, [(
+                path, cache and cache.directory, cache and cache.max_bytes)])
+            while not result.ready():
+                result.wait(WATCH_POLL)
+                if self._stop.is_set():
+                    return
+            try:
+                fields = result.get()
+            except Exception as ex: # pylint: disable=broad-except
+                logger.exception("Loading %s failed", path)
+                fields = dict(status="error", error=str(ex))
+        self._update(name, **fields)
+        if fields["status"] != "error":
+            logger.info("Got %s ready in %.2fs", name, time.time()-t_start)
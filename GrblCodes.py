@@ -140,3 +140,26 @@ ERROR_CODES = {1:("Expected command letter",
                    " to configured tool length axis."),
                38:("Invalid gcode ID:38",
                    "Tool number greater than max supported value.")}
+
+## Realtime override commands
+## dict(override : dict(action : command byte))
+OVERRIDE_CODES = dict(feed=dict(reset=b"\x90",
+                                coarse_plus=b"\x91",
+                                coarse_minus=b"\x92",
+                                fine_plus=b"\x93",
+                                fine_minus=b"\x94"),
+                      rapid=dict(reset=b"\x95",
+                                 medium=b"\x96",
+                                 low=b"\x97"),
+                      spindle=dict(reset=b"\x99",
+                                   coarse_plus=b"\x9A",
+                                   coarse_minus=b"\x9B",
+                                   fine_plus=b"\x9C",
+                                   fine_minus=b"\x9D"))
+
+## dict(override : (min %, max %, coarse step %, fine step %))
+OVERRIDE_LIMITS = dict(feed=(10, 200, 10, 1),
+                       spindle=(10, 200, 10, 1))
+
+## dict(rapid override % : action)
+RAPID_OVERRIDES = {100:"reset", 50:"medium", 25:"low"}
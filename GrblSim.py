@@ -0,0 +1,628 @@
+#!/usr/bin/env python2
+# coding=UTF-8
+"""Simulated GRBL 1.1 controller on a pseudo-terminal
+
+Sender opens serial ports through serial.serial_for_url(), so anything with
+a device path will do. GrblSim creates a pty, listens on the master side and
+behaves like Grbl on it:
+
+    sim = GrblSim()
+    sim.start()
+    sender._open_serial(sim.port)
+
+It models the serial RX buffer, the planner block queue (blocks take as long
+as their feed and acceleration say they should), ok/error:N/ALARM:N
+responses, the realtime commands (overrides included) and the throughput of
+the serial link.
+Run it on its own to get a port any sender can connect to."""
+from __future__ import print_function, division
+
+__author__ = "Dylan Armitage"
+__email__ = "d.armitage89@gmail.com"
+__license__ = "MIT"
+
+####---- Imports ----####
+from collections import deque
+
+import os
+import re
+import pty
+import tty
+import math
+import time
+import select
+import logging
+import argparse
+import threading
+
+from GrblCodes import LIMITS, OVERRIDE_CODES, OVERRIDE_LIMITS, \
+                      RAPID_OVERRIDES
+
+logger = logging.getLogger(__name__) #pylint: disable=invalid-name
+
+####---- Variables ----####
+BANNER = b"\r\nGrbl 1.1f ['$' for help]\r\n"
+RX_BUFFER_SIZE = 128 # bytes
+PLANNER_BLOCKS = 15 # Blocks reported free when the planner is empty
+LINE_BUFFER_SIZE = 80 # bytes, including the newline
+BAUDRATE = 115200
+ACCELERATION = 500.0 # mm/s^2
+MAX_RATE = 8000.0 # mm/min, also the rate of G0
+WCO_EVERY = 10 # Include WCO: in every this many status reports
+
+WORD = re.compile(r"([A-Z])([-+]?(?:\d+\.?\d*|\.\d+))")
+MOTION_WORDS = "XYZIJKR"
+# dict(override command byte : (override, action))
+OVERRIDE_ACTIONS = dict((bytearray(code)[0], (override, action))
+                        for override, codes in OVERRIDE_CODES.items()
+                        for action, code in codes.items())
+
+####---- Classes ----####
+class Link(object):
+    """Token bucket limiting bytes to what the baud rate can carry
+
+    8N1 framing takes 10 bits on the wire for every byte. A baudrate of None
+    means the link is infinitely fast."""
+    def __init__(self, baudrate):
+        self.rate = baudrate / 10.0 if baudrate else None
+        self.tokens = 0.0
+        self.t_last = time.time()
+
+    def allowance(self, t_curr):
+        """Return the number of bytes that may be moved right now"""
+        if self.rate is None:
+            return 4096
+        self.tokens = min(self.tokens+(t_curr-self.t_last)*self.rate,
+                          RX_BUFFER_SIZE)
+        self.t_last = t_curr
+        return int(self.tokens)
+
+    def spend(self, count):
+        """Take count bytes worth of tokens"""
+        if self.rate is not None:
+            self.tokens -= count
+
+    def wait(self):
+        """Return the seconds until another byte can be moved"""
+        if self.rate is None:
+            return 0.0
+        return max(0.0, (1-self.tokens)/self.rate)
+
+
+class Block(object):
+    """A planned motion, or a dwell when target is None"""
+    # pylint: disable=too-few-public-methods
+    __slots__ = ("start", "target", "length", "rate", "rapid", "jog",
+                 "unit", "duration", "t_start", "v_exit")
+
+    def __init__(self, start, target, length, rate, rapid=False, jog=False):
+        # pylint: disable=too-many-arguments
+        self.start = start
+        self.target = target
+        self.length = length # mm, or seconds for a dwell
+        self.rate = rate # mm/s
+        self.rapid = rapid
+        self.jog = jog
+        if target is None or length <= 0:
+            self.unit = (0.0, 0.0, 0.0)
+        else:
+            self.unit = tuple((t-s)/length for s, t in zip(start, target))
+        self.duration = None
+        self.t_start = None
+        self.v_exit = 0.0
+
+
+def move_time(length, rate, accel, v_entry, v_exit):
+    """Return seconds to move length mm at up to rate mm/s
+
+    The move accelerates at accel mm/s^2 from v_entry and ends at v_exit,
+    as far as the length of the move allows."""
+    if length <= 0:
+        return 0.0
+    v_entry = min(v_entry, rate, math.sqrt(v_exit**2 + 2*accel*length))
+    v_exit = min(v_exit, rate, math.sqrt(v_entry**2 + 2*accel*length))
+    v_peak = math.sqrt((2*accel*length + v_entry**2 + v_exit**2) / 2)
+    if v_peak >= rate:
+        ramp = (2*rate**2 - v_entry**2 - v_exit**2) / (2*accel)
+        return (2*rate - v_entry - v_exit)/accel + (length-ramp)/rate
+    return (2*v_peak - v_entry - v_exit) / accel
+
+
+def junction_speed(first, second):
+    """Return how fast the machine may go from block first into second"""
+    if first.target is None or second.target is None:
+        return 0.0
+    cos = sum(a*b for a, b in zip(first.unit, second.unit))
+    return min(first.rate, second.rate) * max(0.0, cos)
+
+
+class GrblSim(object):
+    """Simulated Grbl on the master side of a pty, see module docstring"""
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, rx_size=RX_BUFFER_SIZE, planner_blocks=PLANNER_BLOCKS,
+                 baudrate=BAUDRATE, accel=ACCELERATION, max_rate=MAX_RATE,
+                 speed=1.0, soft_limits=False):
+        # pylint: disable=too-many-arguments
+        self.rx_size = rx_size
+        self.planner_blocks = planner_blocks
+        self.baudrate = baudrate
+        self.accel = accel
+        self.max_rate = max_rate / 60.0
+        self.speed = speed # > 1 runs motion faster than real time
+        self.soft_limits = soft_limits
+        self.port = None
+        self._master = None
+        self._slave = None
+        self.thread = None
+        self._running = False
+        self._rx = bytearray() # Grbl's serial RX buffer
+        self._out = bytearray() # Waiting to go back to the host
+        self._in_link = Link(baudrate)
+        self._out_link = Link(baudrate)
+        self.planner = deque()
+        self.stats = {}
+        self.jog_times = [] # When each jog line was received
+        self.state = "Idle"
+        self.pos = [0.0, 0.0, 0.0]
+        self._reset(banner=False)
+
+    def _reset(self, banner=True):
+        """Soft reset: throw away everything in flight"""
+        moving = self.state in ("Run", "Jog")
+        self._rx = bytearray()
+        self.planner.clear()
+        self.state = "Alarm" if moving else "Idle"
+        self._v_exit = 0.0
+        self.absolute = True
+        self.inches = False
+        self.motion = 0
+        self.feed = 0.0
+        self.spindle = 0.0
+        self.check = False
+        self.overrides = dict(feed=100, rapid=100, spindle=100)
+        self._ov_changed = False
+        self._reports = 0
+        self._t_empty = None
+        self.reset_stats()
+        if moving:
+            self._send(b"ALARM:3\r\n")
+        if banner:
+            self._send(BANNER)
+            if self.state == "Alarm":
+                self._send(b"[MSG:'$H'|'$X' to unlock]\r\n")
+
+    def reset_stats(self):
+        """Zero the counters in self.stats"""
+        self.stats = dict(lines=0, bytes=0, blocks=0, starved=0.0,
+                          overflows=0)
+        self.jog_times = []
+
+    ####---- pty handling ----####
+    def start(self):
+        """Create the pty and start simulating on it, return its path"""
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._running = True
+        self.thread = threading.Thread(target=self._run, name="GrblSim")
+        self.thread.daemon = True
+        self.thread.start()
+        logger.info("Simulated Grbl on %s", self.port)
+        return self.port
+
+    def stop(self):
+        """Stop simulating and close the pty"""
+        self._running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        for pty_fd in (self._master, self._slave):
+            if pty_fd is not None:
+                os.close(pty_fd)
+        self._master = self._slave = None
+
+    def _send(self, data):
+        """Queue data to go back to the host"""
+        self._out += data
+
+    def _run(self):
+        """Simulation loop"""
+        while self._running:
+            t_curr = time.time()
+            self._execute(t_curr)
+            self._parse_lines(t_curr)
+            timeout = 0.05
+            self._execute(t_curr) # Start anything just planned
+            if self.state in ("Run", "Jog") and self.planner:
+                block = self.planner[0]
+                timeout = min(timeout, max(0.0, block.t_start +
+                                           block.duration - t_curr))
+            want_read = [self._master]
+            if self._in_link.allowance(t_curr) < 1:
+                want_read = []
+                timeout = min(timeout, self._in_link.wait())
+            want_write = []
+            if self._out:
+                if self._out_link.allowance(t_curr) < 1:
+                    timeout = min(timeout, self._out_link.wait())
+                else:
+                    want_write = [self._master]
+            readable, writable = select.select(want_read, want_write, [],
+                                               timeout)[:2]
+            t_curr = time.time()
+            if readable:
+                self._read(t_curr)
+            if writable:
+                count = self._out_link.allowance(t_curr)
+                if count > 0:
+                    written = os.write(self._master, bytes(self._out[:count]))
+                    self._out_link.spend(written)
+                    del self._out[:written]
+
+    def _read(self, t_curr):
+        """Take bytes off the link, handling realtime commands at once"""
+        try:
+            data = os.read(self._master, self._in_link.allowance(t_curr))
+        except OSError: # Nobody has the other end open
+            time.sleep(0.05)
+            return
+        self._in_link.spend(len(data))
+        for byte in bytearray(data):
+            if byte in (0x3f, 0x21, 0x7e, 0x18) or byte >= 0x80:
+                self._realtime(byte, t_curr)
+            elif len(self._rx) < self.rx_size - 1:
+                self._rx.append(byte)
+            else:
+                self.stats["overflows"] += 1
+                logger.warning("RX buffer overflow")
+        self.stats["bytes"] += len(data)
+
+    ####---- Realtime commands ----####
+    def _realtime(self, byte, t_curr):
+        """Act on a realtime command byte"""
+        if byte == 0x3f: # ?
+            self._send(self._status(t_curr))
+        elif byte == 0x21: # ! feed hold
+            if self.state == "Jog":
+                self._cancel_jog(t_curr)
+            elif self.state == "Run":
+                self._hold(t_curr)
+        elif byte == 0x7e: # ~ cycle start
+            if self.state.startswith("Hold"):
+                self._resume(t_curr)
+        elif byte == 0x18: # ctrl-x soft reset
+            self.pos = self._position(t_curr)
+            self._reset()
+        elif byte == 0x85: # jog cancel
+            if self.state == "Jog":
+                self._cancel_jog(t_curr)
+        elif byte in OVERRIDE_ACTIONS:
+            self._override(*OVERRIDE_ACTIONS[byte])
+
+    def _override(self, override, action):
+        """Apply a feed, rapid or spindle override command"""
+        if override == "rapid":
+            value = dict((action, rate) for rate, action
+                         in RAPID_OVERRIDES.items())[action]
+        elif action == "reset":
+            value = 100
+        else:
+            low, high, coarse, fine = OVERRIDE_LIMITS[override]
+            step = coarse if action.startswith("coarse") else fine
+            value = self.overrides[override] + \
+                    (step if action.endswith("plus") else -step)
+            value = min(max(value, low), high)
+        if value != self.overrides[override]:
+            self.overrides[override] = value
+            self._ov_changed = True
+
+    def _hold(self, t_curr):
+        """Freeze the running block where it is"""
+        if self.planner and self.planner[0].t_start is not None:
+            block = self.planner[0]
+            done = min(1.0, (t_curr-block.t_start) / block.duration) \
+                   if block.duration else 1.0
+            if block.target is not None:
+                self.pos = self._position(t_curr)
+                block.start = tuple(self.pos)
+            block.length *= 1 - done
+            block.t_start = None
+        self._v_exit = 0.0
+        self.state = "Hold:0"
+
+    def _resume(self, t_curr):
+        """Carry on after a feed hold"""
+        self.state = "Run" if self.planner else "Idle"
+        self._execute(t_curr)
+
+    def _cancel_jog(self, t_curr):
+        """Stop jogging and drop every queued jog"""
+        self.pos = self._position(t_curr)
+        self.planner.clear()
+        self._v_exit = 0.0
+        self.state = "Idle"
+
+    def _position(self, t_curr):
+        """Return the current machine position"""
+        if self.state in ("Run", "Jog") and self.planner:
+            block = self.planner[0]
+            if block.t_start is not None and block.target is not None:
+                done = min(1.0, (t_curr-block.t_start) / block.duration) \
+                       if block.duration else 1.0
+                return [s + (t-s)*done
+                        for s, t in zip(block.start, block.target)]
+        return list(self.pos)
+
+    def _status(self, t_curr):
+        """Return a status report"""
+        self._reports += 1
+        fields = [self.state,
+                  "MPos:{:.3f},{:.3f},{:.3f}".format(*self._position(t_curr)),
+                  "Bf:{},{}".format(self.planner_blocks-len(self.planner),
+                                    self.rx_size-1-len(self._rx)),
+                  "FS:{:.0f},{:.0f}".format(self.feed, self.spindle)]
+        if self._reports % WCO_EVERY == 1:
+            fields.append("WCO:0.000,0.000,0.000")
+        elif self._ov_changed or self._reports % WCO_EVERY == 2:
+            fields.append("Ov:{feed},{rapid},{spindle}"
+                          .format(**self.overrides))
+            self._ov_changed = False
+        return "<{}>\r\n".format("|".join(fields)).encode("ascii")
+
+    ####---- Planner ----####
+    def _execute(self, t_curr):
+        """Run the planner forward to t_curr"""
+        if self.state not in ("Run", "Jog"):
+            return
+        while self.planner:
+            block = self.planner[0]
+            if block.t_start is None:
+                self._start_block(block, t_curr)
+            if t_curr < block.t_start + block.duration:
+                return
+            if block.target is not None:
+                self.pos = list(block.target)
+            self._v_exit = block.v_exit
+            self.planner.popleft()
+            if self.planner:
+                self._start_block(self.planner[0],
+                                  block.t_start+block.duration)
+        self.state = "Idle"
+        self._v_exit = 0.0
+        self._t_empty = t_curr
+
+    def _start_block(self, block, t_start):
+        """Work out how long block will take now that it is starting"""
+        block.t_start = t_start
+        if block.target is None:
+            block.duration = block.length / self.speed
+            block.v_exit = 0.0
+            return
+        if len(self.planner) > 1:
+            block.v_exit = junction_speed(block, self.planner[1])
+        else:
+            block.v_exit = 0.0 # Nothing after it yet, so plan to stop
+        rate = block.rate
+        if block.rapid:
+            rate *= self.overrides["rapid"] / 100.0
+        elif not block.jog:
+            rate = min(rate*self.overrides["feed"] / 100.0, self.max_rate)
+        block.duration = move_time(block.length, rate, self.accel,
+                                   self._v_exit, block.v_exit) / self.speed
+
+    def _plan(self, block, t_curr):
+        """Add block to the planner, starting a cycle if need be"""
+        if self._t_empty is not None and self.stats["blocks"]:
+            self.stats["starved"] += t_curr - self._t_empty
+        self._t_empty = None
+        self.planner.append(block)
+        self.stats["blocks"] += 1
+        if self.state == "Idle":
+            self.state = "Jog" if block.jog else "Run"
+
+    ####---- Line parsing ----####
+    def _parse_lines(self, t_curr):
+        """Execute lines from the RX buffer while the planner has room"""
+        while len(self.planner) < self.planner_blocks:
+            newline = self._rx.find(b"\n")
+            if newline < 0:
+                return
+            line = bytes(self._rx[:newline]).decode("ascii", "replace")
+            del self._rx[:newline+1]
+            self.stats["lines"] += 1
+            if len(line) >= LINE_BUFFER_SIZE:
+                code = 11
+            else:
+                code = self._execute_line(line.strip().upper(), t_curr)
+            if code:
+                self._send("error:{}\r\n".format(code).encode("ascii"))
+            else:
+                self._send(b"ok\r\n")
+
+    def _execute_line(self, line, t_curr):
+        """Execute a line, return an error code or 0"""
+        line = re.sub(r"\s|\(.*?\)", "", line)
+        if not line:
+            return 0
+        if line[0] == "$":
+            return self._system_command(line, t_curr)
+        if self.state == "Alarm" or self.state == "Jog":
+            return 9
+        return self._gcode(line, t_curr)
+
+    def _system_command(self, line, t_curr):
+        """Execute a $ command, return an error code or 0"""
+        if line == "$X":
+            if self.state == "Alarm":
+                self._send(b"[MSG:Caution: Unlocked]\r\n")
+                self.state = "Idle"
+        elif line == "$H":
+            self.pos = [0.0, 0.0, 0.0]
+            self.state = "Idle"
+        elif line == "$C":
+            self.check = not self.check
+            if self.check:
+                self.state = "Check"
+                self._send(b"[MSG:Enabled]\r\n")
+            else:
+                self._send(b"[MSG:Disabled]\r\n")
+                self._reset()
+        elif line == "$I":
+            self._send("[VER:1.1f.20170801:]\r\n[OPT:V,{},{}]\r\n"
+                       .format(self.planner_blocks+1, self.rx_size)
+                       .encode("ascii"))
+        elif line == "$G":
+            self._send("[GC:G{} G54 G17 {} {} G94 M5 M9 T0 F{:g} S{:g}]\r\n"
+                       .format(self.motion, "G20" if self.inches else "G21",
+                               "G90" if self.absolute else "G91",
+                               self.feed, self.spindle).encode("ascii"))
+        elif line.startswith("$J"):
+            self.jog_times.append(t_curr)
+            if not line.startswith("$J="):
+                return 16
+            if self.state not in ("Idle", "Jog"):
+                return 8
+            return self._gcode(line[3:], t_curr, jog=True)
+        elif not re.match(r"^\$(\$|#|N\d*|\d+=.*)?$", line):
+            return 3
+        return 0
+
+    def _gcode(self, line, t_curr, jog=False):
+        """Execute a block of gcode, return an error code or 0"""
+        # pylint: disable=too-many-return-statements,too-many-branches
+        words = {}
+        commands = []
+        pos = 0
+        for match in WORD.finditer(line):
+            if match.start() != pos:
+                break
+            pos = match.end()
+            letter, value = match.group(1), float(match.group(2))
+            if letter in "GM":
+                commands.append(letter+"{:g}".format(value))
+            elif letter in words:
+                return 25
+            else:
+                words[letter] = value
+        if pos != len(line):
+            # A letter without a proper number, or no letter at all
+            return 2 if line[pos].isalpha() else 1
+        absolute, inches, motion = self.absolute, self.inches, self.motion
+        for command in commands:
+            if command in ("G0", "G1", "G2", "G3"):
+                motion = int(command[1:])
+            elif command in ("G90", "G91"):
+                absolute = command == "G90"
+            elif command in ("G20", "G21"):
+                inches = command == "G20"
+            elif command == "G4":
+                if "P" not in words:
+                    return 28
+                if not self.check:
+                    self._plan(Block(None, None, words["P"], 0), t_curr)
+            elif command in ("M3", "M4"):
+                self.spindle = words.get("S", self.spindle)
+            elif command == "M5":
+                self.spindle = 0.0
+            elif command in ("M2", "M30"):
+                self._send(b"[MSG:Pgm End]\r\n")
+            elif command not in ("G17", "G94", "G54", "M8", "M9"):
+                return 20
+        if jog and "F" not in words:
+            return 22
+        scale = 25.4 if inches else 1.0
+        if jog:
+            rate = words["F"] * scale / 60.0
+        elif "F" in words:
+            self.feed = words["F"] * scale
+        if "S" in words:
+            self.spindle = words["S"]
+        if not jog:
+            self.absolute, self.inches, self.motion = absolute, inches, motion
+        if not any(letter in words for letter in MOTION_WORDS):
+            return 0
+        if jog:
+            motion = 1
+        elif motion != 0 and self.feed <= 0:
+            return 22
+        else:
+            rate = self.max_rate if motion == 0 else self.feed / 60.0
+        start = self.planner[-1].target if self.planner and \
+                self.planner[-1].target is not None else self._position(t_curr)
+        target = list(start)
+        for axis, letter in enumerate("XYZ"):
+            if letter in words:
+                value = words[letter] * scale
+                target[axis] = value if absolute else target[axis] + value
+        if self.soft_limits and self._outside_limits(target):
+            if jog:
+                return 15
+            self.planner.clear()
+            self.state = "Alarm"
+            self._send(b"ALARM:2\r\n")
+            return 0
+        length = self._length(start, target, words, motion, scale)
+        if length is None:
+            return 26
+        if self.check:
+            return 0
+        self._plan(Block(tuple(start), tuple(target), length,
+                         min(rate, self.max_rate), rapid=motion == 0,
+                         jog=jog), t_curr)
+        return 0
+
+    @staticmethod
+    def _length(start, target, words, motion, scale):
+        """Return the path length of a move, None if an arc is invalid"""
+        chord = math.sqrt(sum((t-s)**2 for s, t in zip(start, target)))
+        if motion in (0, 1):
+            return chord
+        if "R" in words:
+            radius = abs(words["R"] * scale)
+            if chord > 2*radius:
+                return None
+        elif "I" in words or "J" in words:
+            radius = math.hypot(words.get("I", 0.0) * scale,
+                                words.get("J", 0.0) * scale)
+        else:
+            return None
+        if radius == 0:
+            return chord
+        angle = 2*math.asin(min(1.0, chord / (2*radius)))
+        return max(chord, radius*angle)
+
+    @staticmethod
+    def _outside_limits(target):
+        """Whether target is outside of the travel in GrblCodes.LIMITS"""
+        for axis, letter in enumerate("XY"):
+            low, high = LIMITS[letter]
+            if not low <= target[axis] <= high:
+                return True
+        return False
+
+
+####---- MAIN ----####
+def main():
+    """Run a simulator until interrupted"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--baud", type=int, default=BAUDRATE,
+                        help="serial link speed, 0 for unlimited")
+    parser.add_argument("--rx-size", type=int, default=RX_BUFFER_SIZE)
+    parser.add_argument("--blocks", type=int, default=PLANNER_BLOCKS)
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="motion speed-up over real time")
+    parser.add_argument("--soft-limits", action="store_true")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    sim = GrblSim(rx_size=args.rx_size, planner_blocks=args.blocks,
+                  baudrate=args.baud or None, speed=args.speed,
+                  soft_limits=args.soft_limits)
+    print(sim.start())
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        sim.stop()
+
+if __name__ == "__main__":
+    main()
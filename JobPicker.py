@@ -0,0 +1,123 @@
+#!/usr/bin/env python2
+# coding=UTF-8
+"""File picker for the jobs in GDIR, with what GdirWatcher found out about
+each of them"""
+
+__author__ = "Dylan Armitage"
+__email__ = "d.armitage89@gmail.com"
+
+####---- Imports ----####
+try:
+    import Tkinter as tk
+    import ttk
+except ImportError:
+    import tkinter as tk
+    from tkinter import ttk
+
+import time
+import logging
+
+logger = logging.getLogger(__name__) #pylint: disable=invalid-name
+
+####---- Variables ----####
+REFRESH_MS = 500 # How often to look for changes from the watcher
+COLUMNS = (("lines", "Lines", 70),
+           ("time", "Time", 70),
+           ("size", "Size", 70),
+           ("modified", "Modified", 110),
+           ("status", "Status", 150),
+          )
+
+
+def duration(seconds):
+    """Return seconds as h:mm:ss"""
+    seconds = int(seconds)
+    return "{}:{:02d}:{:02d}".format(seconds // 3600, seconds // 60 % 60,
+                                     seconds % 60)
+
+
+####---- Classes ----####
+class JobPicker(object):
+    """Dialog listing the jobs of a GdirWatcher, newest first
+
+    Calls on_pick(path) with the job opened, or browse() if the user would
+    rather use the usual file dialog."""
+    def __init__(self, master, watcher, on_pick, browse=None):
+        self.watcher = watcher
+        self.on_pick = on_pick
+        self.browse = browse
+        self._seq = None
+        self.window = window = tk.Toplevel(master)
+        window.title("Open job")
+        window.transient(master)
+        tree = self.tree = ttk.Treeview(window, columns=[c[0] for c in COLUMNS],
+                                        selectmode="browse", height=15)
+        tree.heading("#0", text="File")
+        tree.column("#0", width=260)
+        for column, heading, width in COLUMNS:
+            tree.heading(column, text=heading)
+            tree.column(column, width=width, anchor="e")
+        tree.column("status", anchor="w")
+        tree.bind("<Double-1>", lambda _: self._open())
+        tree.bind("<Return>", lambda _: self._open())
+        scroll = ttk.Scrollbar(window, orient="vertical", command=tree.yview)
+        tree.configure(yscrollcommand=scroll.set)
+        tree.grid(row=0, column=0, columnspan=3, sticky="nsew")
+        scroll.grid(row=0, column=3, sticky="ns")
+        ttk.Button(window, text="Open", command=self._open).grid(
+            row=1, column=0, sticky="w")
+        if browse is not None:
+            ttk.Button(window, text="Browse...", command=self._browse).grid(
+                row=1, column=1, sticky="w")
+        ttk.Button(window, text="Cancel", command=window.destroy).grid(
+            row=1, column=2, sticky="e")
+        window.columnconfigure(0, weight=1)
+        window.rowconfigure(0, weight=1)
+        self._refresh()
+        tree.focus_set()
+
+    def _refresh(self):
+        """Show the jobs again if the watcher has news"""
+        if not self.window.winfo_exists():
+            return
+        if self.watcher.seq != self._seq:
+            self._seq = self.watcher.seq
+            self._fill(self.watcher.snapshot())
+        self.window.after(REFRESH_MS, self._refresh)
+
+    def _fill(self, jobs):
+        """Replace the rows with jobs, keeping the selection"""
+        tree = self.tree
+        selected = tree.selection()
+        tree.delete(*tree.get_children())
+        for job in jobs:
+            status = job.get("status", "")
+            if job.get("error"):
+                status = "{}: {}".format(status, job["error"])
+            lines = job.get("lines")
+            seconds = job.get("seconds")
+            tree.insert("", "end", iid=job["path"], text=job["name"],
+                        values=("" if lines is None else lines,
+                                "" if seconds is None else duration(seconds),
+                                "{:.0f} kB".format(job["size"] / 1024.0),
+                                time.strftime("%d/%m %H:%M",
+                                              time.localtime(job["mtime"])),
+                                status))
+        kept = [iid for iid in selected if tree.exists(iid)]
+        if kept:
+            tree.selection_set(kept)
+        elif jobs:
+            tree.selection_set(jobs[0]["path"])
+
+    def _open(self):
+        """Open the selected job"""
+        selected = self.tree.selection()
+        if not selected:
+            return
+        self.window.destroy()
+        self.on_pick(selected[0])
+
+    def _browse(self):
+        """Use the usual file dialog instead"""
+        self.window.destroy()
+        self.browse()
@@ -0,0 +1,209 @@
+#!/usr/bin/env python2
+# coding=UTF-8
+"""Snapshots of the state of Grbl, and a history of where it has been
+
+The I/O thread of Sender builds a new MachineState from every status report
+and swaps it in whole, so anything that reads Sender.state once gets fields
+that all belong to the same report, without any locking. The positions also
+go into a PositionHistory, a fixed-size ring buffer the GUI can draw the
+live toolpath from, and changes are pushed into a ChangeQueue that the GUI
+drains once a frame."""
+
+__author__ = "Dylan Armitage"
+__email__ = "d.armitage89@gmail.com"
+
+####---- Imports ----####
+from array import array
+from threading import Lock
+
+import re
+import logging
+
+logger = logging.getLogger(__name__) #pylint: disable=invalid-name
+
+####---- Variables ----####
+SPLITFIELD = re.compile(r"[:,]")
+ZERO = (0.0, 0.0, 0.0)
+HISTORY_SIZE = 4096 # Positions kept by a PositionHistory
+
+
+####---- Classes ----####
+class MachineState(object):
+    """What one status report of Grbl said, never changed once published
+
+    Positions are (x, y, z) tuples. Grbl reports either MPos or WPos, and
+    WCO only now and then, so the other position is worked out from the
+    last WCO seen. planner_free and rx_free are the Bf: field, and line is
+    the Ln: field, when Grbl is built to report them."""
+    # pylint: disable=too-many-instance-attributes,too-few-public-methods
+    __slots__ = ("seq",
+                 "time",
+                 "status",
+                 "mpos",
+                 "wpos",
+                 "wco",
+                 "feed",
+                 "power",
+                 "planner_free",
+                 "rx_free",
+                 "line",
+                 "progress",
+                )
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name))
+        if self.seq is None:
+            self.seq = 0
+        if self.status is None:
+            self.status = ""
+        if self.wco is None:
+            self.wco = ZERO
+
+    def __repr__(self):
+        return "MachineState({})".format(", ".join(
+            "{}={!r}".format(name, getattr(self, name))
+            for name in self.__slots__))
+
+    def as_dict(self):
+        """Return the fields as a dict, e.g. to send as JSON"""
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    @classmethod
+    def from_dict(cls, fields):
+        """Return a MachineState from as_dict(), lists back to tuples"""
+        return cls(**dict((str(name), tuple(value)
+                           if isinstance(value, list) else value)
+                          for name, value in fields.items()))
+
+    @classmethod
+    def from_report(cls, fields, previous, t_report, progress=None):
+        """Return the state after the status report split into fields,
+        carrying over from previous what the report leaves out"""
+        state = cls(seq=previous.seq+1,
+                    time=t_report,
+                    status=fields[0],
+                    wco=previous.wco,
+                    feed=previous.feed,
+                    power=previous.power,
+                    planner_free=previous.planner_free,
+                    rx_free=previous.rx_free,
+                    line=previous.line,
+                    progress=progress)
+        mpos = wpos = None
+        for field in fields[1:]:
+            values = SPLITFIELD.split(field)
+            name = values[0]
+            try:
+                if name == "MPos":
+                    mpos = tuple(float(value) for value in values[1:4])
+                elif name == "WPos":
+                    wpos = tuple(float(value) for value in values[1:4])
+                elif name == "WCO":
+                    state.wco = tuple(float(value) for value in values[1:4])
+                elif name == "FS":
+                    state.feed, state.power = (float(value)
+                                               for value in values[1:3])
+                elif name == "F":
+                    state.feed = float(values[1])
+                elif name == "Bf":
+                    state.planner_free, state.rx_free = (int(value)
+                                                         for value in values[1:3])
+                elif name == "Ln":
+                    state.line = int(values[1])
+            except (IndexError, ValueError):
+                logger.warning("Bad status field: %s", field)
+        wco = state.wco
+        if mpos is not None:
+            state.mpos = mpos
+            state.wpos = tuple(m-o for m, o in zip(mpos, wco))
+        elif wpos is not None:
+            state.wpos = wpos
+            state.mpos = tuple(w+o for w, o in zip(wpos, wco))
+        else:
+            state.mpos, state.wpos = previous.mpos, previous.wpos
+        return state
+
+
+class PositionHistory(object):
+    """The last size positions, as (time, x, y, z), in a ring buffer
+
+    Everything lives in one array of doubles allocated up front, so adding a
+    position allocates nothing. seq counts every position ever added, so a
+    reader can tell whether there is anything new since it last looked."""
+    WIDTH = 4 # Doubles per position
+
+    def __init__(self, size=HISTORY_SIZE):
+        self.size = size
+        self._data = array("d", [0.0]) * (size*self.WIDTH)
+        self._next = 0 # Slot the next position goes in
+        self._count = 0
+        self._lock = Lock()
+        self.seq = 0
+
+    def append(self, t_pos, position):
+        """Add the (x, y, z) position seen at t_pos"""
+        with self._lock:
+            index = self._next*self.WIDTH
+            data = self._data
+            data[index] = t_pos
+            data[index+1], data[index+2], data[index+3] = position
+            self._next = (self._next+1) % self.size
+            self._count = min(self._count+1, self.size)
+            self.seq += 1
+
+    def clear(self):
+        """Forget every position"""
+        with self._lock:
+            self._next = 0
+            self._count = 0
+            self.seq += 1
+
+    def last(self):
+        """Return the latest (time, x, y, z), or None"""
+        with self._lock:
+            if not self._count:
+                return None
+            index = (self._next-1) % self.size * self.WIDTH
+            return tuple(self._data[index:index+self.WIDTH])
+
+    def xy(self):
+        """Return x0, y0, x1, y1... oldest first, as an array
+
+        That is what Tk's Canvas.coords() takes for a line."""
+        with self._lock:
+            count, first = self._count, (self._next-self._count) % self.size
+            out = array("d", [0.0]) * (count*2)
+            data, width = self._data, self.WIDTH
+            for i in range(count):
+                index = (first+i) % self.size * width
+                out[2*i] = data[index+1]
+                out[2*i+1] = data[index+2]
+        return out
+
+    def __len__(self):
+        return self._count
+
+
+class ChangeQueue(object):
+    """The latest value of everything that changed since the last drain()
+
+    put() replaces whatever was waiting under the same key, so however fast
+    the I/O thread pushes, the reader only ever sees one value per key."""
+    def __init__(self):
+        self._lock = Lock()
+        self._changes = {}
+
+    def put(self, key, value):
+        """Record that key is now value"""
+        with self._lock:
+            self._changes[key] = value
+
+    def drain(self):
+        """Return and forget everything that changed, as a dict"""
+        with self._lock:
+            changes, self._changes = self._changes, {}
+        return changes
+
+    def __len__(self):
+        return len(self._changes)
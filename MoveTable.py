@@ -0,0 +1,423 @@
+#!/usr/bin/env python2
+# coding=UTF-8
+"""Every move of a job as columns of numpy arrays
+
+A job is interpreted in two steps. tokenize() splits each line into its
+words, with no idea of what came before, so the lines can be tokenized in
+any order, in chunks, in other processes. MoveTable.from_tokens() then
+stitches the tokens together and works out the modal state, G0/G1/G2/G3,
+G90/G91, G20/G21, F, S and M3/M4/M5 the way Grbl does, with whole-column
+numpy operations, and makes a row for every move that changes X or Y:
+
+    x0, y0, x1, y1  where the move starts and ends, mm, absolute
+    cx, cy          centre of an arc, NaN for straight moves
+    motion          MOTION_RAPID, MOTION_LINE, MOTION_CW or MOTION_CCW
+    feed            mm/min
+    power           S while the laser is on (M3/M4), else 0
+    line            line of the file it came from, counting from 1
+    frame           what x1 and y1 are in, see below
+
+Positions are in the work coordinates the job starts in, G92 shifting the
+values of the lines after it back into them (FRAME_WORK), except for G53
+moves, in machine coordinates (FRAME_MACHINE). G28/G30 are a rapid to the
+intermediate point, then one to the position stored in Grbl, which isn't
+known, so is taken to be machine 0 (FRAME_STORED). G10 and G92 don't move.
+The work offset isn't known either, so moves from one frame into another
+are as long as if it were 0.
+
+The bounding box, mid point, time estimate, preview and limit checks are
+then quick queries on whole columns instead of more passes over the file."""
+
+__author__ = "Dylan Armitage"
+__email__ = "d.armitage89@gmail.com"
+
+####---- Imports ----####
+from array import array
+
+import re
+import math
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__) #pylint: disable=invalid-name
+
+####---- Variables ----####
+WORDS = re.compile(br"([A-Z])(-?(?:\d+\.?\d*|\.\d+))")
+MOTION_RAPID, MOTION_LINE, MOTION_CW, MOTION_CCW = 0, 1, 2, 3
+FRAME_WORK, FRAME_MACHINE, FRAME_STORED = 0, 1, 2
+RAPID_RATE = 5000.0 # mm/min that G0 moves are assumed to go at
+STAT_FIELDS = ("rapids", "cuts", "rapid_mm", "cut_mm", "seconds")
+# Column name, numpy dtype
+COLUMNS = (("x0", np.float64),
+           ("y0", np.float64),
+           ("x1", np.float64),
+           ("y1", np.float64),
+           ("cx", np.float64),
+           ("cy", np.float64),
+           ("motion", np.int8),
+           ("feed", np.float32),
+           ("power", np.float32),
+           ("line", np.uint32),
+           ("frame", np.int8),
+          )
+# What tokenize() makes of each line, and the array typecode while it does;
+# NaN, or -1, where the line doesn't say
+TOKENS = (("line", np.uint32, "I"),
+          ("x", np.float64, "d"),
+          ("y", np.float64, "d"),
+          ("i", np.float64, "d"),
+          ("j", np.float64, "d"),
+          ("r", np.float64, "d"),
+          ("feed", np.float64, "d"),
+          ("power", np.float64, "d"),
+          ("motion", np.int8, "b"), # G0 to G3
+          ("absolute", np.int8, "b"), # G90 1, G91 0
+          ("inches", np.int8, "b"), # G20 1, G21 0
+          ("laser", np.int8, "b"), # M3/M4 1, M2/M5/M30 0
+          ("non_modal", np.int8, "b"), # One of NON_MODAL
+         )
+TOKEN_WORDS = dict((word, index) for index, word in
+                   enumerate((b"X", b"Y", b"I", b"J", b"R", b"F", b"S"), 1))
+MODAL_G = {0: (8, 0), 1: (8, 1), 2: (8, 2), 3: (8, 3),
+           90: (9, 1), 91: (9, 0), 20: (10, 1), 21: (10, 0)}
+MODAL_M = {3: 1, 4: 1, 2: 0, 5: 0, 30: 0}
+# The non-modal commands that say how a line moves, or that it doesn't
+SET_OFFSETS, INTERMEDIATE, STORED, MACHINE, SET_ORIGIN, CLEAR_ORIGIN, \
+    STORE = range(1, 8)
+NON_MODAL = {10: SET_OFFSETS, 28: INTERMEDIATE, 30: INTERMEDIATE,
+             53: MACHINE, 92: SET_ORIGIN, 92.1: CLEAR_ORIGIN,
+             28.1: STORE, 30.1: STORE}
+
+
+def tokenize(lines, sources=None):
+    """Return the TOKENS of lines of gcode, str, bytes or memoryviews, from
+    the start of the file or with their line numbers in sources, as a dict
+    of numpy arrays; lines without any of those words are left out, and
+    G28/G30 get a second row (STORED) for the move from the intermediate
+    point"""
+    columns = [array(typecode) for _, _, typecode in TOKENS]
+    adds = [column.append for column in columns]
+    nan = float("nan")
+    blank = [0, nan, nan, nan, nan, nan, nan, nan, -1, -1, -1, -1, -1]
+    for index, line in enumerate(lines):
+        if isinstance(line, memoryview):
+            line = line.tobytes()
+        elif not isinstance(line, bytes):
+            line = line.encode("ascii", "replace")
+        row = None
+        for letter, value in WORDS.findall(line.upper()):
+            number = float(value)
+            if letter == b"G":
+                place = MODAL_G.get(number)
+                if place is None:
+                    if number not in NON_MODAL:
+                        continue
+                    place = 12, NON_MODAL[number]
+                place, number = place
+            elif letter == b"M":
+                if number not in MODAL_M:
+                    continue
+                place, number = 11, MODAL_M[number]
+            else:
+                place = TOKEN_WORDS.get(letter)
+                if place is None:
+                    continue
+            if row is None:
+                row = list(blank)
+            row[place] = number
+        if row is None:
+            continue
+        row[0] = sources[index] if sources is not None else index+1
+        for add, value in zip(adds, row):
+            add(value)
+        if row[12] == INTERMEDIATE:
+            stored = list(blank)
+            stored[0], stored[1], stored[2], stored[12] = row[0], 0, 0, STORED
+            for add, value in zip(adds, stored):
+                add(value)
+    return dict((name, np.frombuffer(column, dtype=dtype).copy()
+                       if len(column) else np.zeros(0, dtype=dtype))
+                for (name, dtype, _), column in zip(TOKENS, columns))
+
+
+def _fill(values, given, initial):
+    """Return values with every element not given replaced by the last
+    one that was, or initial before the first"""
+    index = np.where(given, np.arange(len(values)), -1)
+    np.maximum.accumulate(index, out=index)
+    return np.where(index >= 0, values[np.maximum(index, 0)], initial)
+
+
+def _run(values, steps, fixed):
+    """Return the positions of an axis from its values and relative steps,
+    every fixed value starting the running total again from there"""
+    base = _fill(values - steps, fixed, 0.0)
+    return np.where(fixed, values, base + steps)
+
+
+def _positions(values, absolute, shifted=None, origins=None, resets=None):
+    """Return where an axis is after each line, from the values the lines
+    give it, in mm, and whether they were absolute
+
+    Given them, origins are the values G92 gives the axis, NaN on other
+    lines, and resets the lines with G92.1. The values of the shifted lines
+    after one are moved by the origin it sets."""
+    given = ~np.isnan(values)
+    fixed = given & absolute
+    steps = np.cumsum(np.where(given & ~absolute, values, 0.0))
+    positions = _run(values, steps, fixed)
+    if origins is None:
+        return positions
+    shift = np.zeros(len(values))
+    # Where each origin is depends on the ones before it, so they are done
+    # one at a time; there are only ever a few
+    for row in np.flatnonzero(~np.isnan(origins) | resets):
+        shift[row+1:] = 0.0 if resets[row] else positions[row] - origins[row]
+        positions = _run(values + np.where(shifted, shift, 0.0), steps, fixed)
+    return positions
+
+
+def _arc_centre(x_pos, y_pos, end_x, end_y, radius, clockwise):
+    """Return the centre of an arc given by R, as Grbl works it out"""
+    d_x, d_y = end_x-x_pos, end_y-y_pos
+    h_x2_div_d = 4.0*radius*radius - d_x*d_x - d_y*d_y
+    if h_x2_div_d < 0 or (d_x == 0 and d_y == 0):
+        return None
+    h_x2_div_d = -math.sqrt(h_x2_div_d) / math.hypot(d_x, d_y)
+    if not clockwise:
+        h_x2_div_d = -h_x2_div_d
+    if radius < 0:
+        h_x2_div_d = -h_x2_div_d
+    return (x_pos + 0.5*(d_x - d_y*h_x2_div_d),
+            y_pos + 0.5*(d_y + d_x*h_x2_div_d))
+
+
+####---- Classes ----####
+class MoveTable(object):
+    """The moves of a job, one numpy array per column (see COLUMNS)"""
+    def __init__(self, **columns):
+        for name, dtype in COLUMNS:
+            setattr(self, name, np.asarray(columns.get(name, ()), dtype=dtype))
+        self._lengths = None
+
+    @classmethod
+    def from_tokens(cls, chunks):
+        """Interpret the tokenize() output of consecutive chunks of a file,
+        line numbers already counting from the start of the file"""
+        # pylint: disable=too-many-locals
+        tokens = dict((name, np.concatenate([chunk[name] for chunk in chunks])
+                             if chunks else np.zeros(0, dtype=dtype))
+                      for name, dtype, _ in TOKENS)
+        scale = np.where(_fill(tokens["inches"], tokens["inches"] >= 0, 0),
+                         25.4, 1.0)
+        non_modal = tokens["non_modal"]
+        machine = (non_modal == MACHINE) | (non_modal == STORED)
+        # G53 and the stored positions are absolute, whatever G90/G91 say
+        absolute = _fill(tokens["absolute"], tokens["absolute"] >= 0,
+                         1).astype(bool) | machine
+        motion = _fill(tokens["motion"], tokens["motion"] >= 0, MOTION_RAPID)
+        feed = _fill(tokens["feed"]*scale, ~np.isnan(tokens["feed"]), 0.0)
+        power = _fill(tokens["power"], ~np.isnan(tokens["power"]), 0.0)
+        laser = _fill(tokens["laser"], tokens["laser"] >= 0, 0).astype(bool)
+        # The axis words of G10, G92 and G28.1/G30.1 aren't where to go
+        settings = (non_modal == SET_OFFSETS) | (non_modal == SET_ORIGIN) | \
+                   (non_modal == STORE)
+        origin = non_modal == SET_ORIGIN
+        resets = non_modal == CLEAR_ORIGIN
+        positions = []
+        for axis in ("x", "y"):
+            values = np.where(settings, np.nan, tokens[axis]*scale)
+            positions.append(_positions(
+                values, absolute, ~machine,
+                np.where(origin, tokens[axis]*scale, np.nan), resets))
+        x_pos, y_pos = positions
+        moved = ~(np.isnan(tokens["x"]) & np.isnan(tokens["y"])) & ~settings
+        # Each move starts where the line before left off
+        x_start = np.concatenate(([0.0], x_pos[:-1]))[moved]
+        y_start = np.concatenate(([0.0], y_pos[:-1]))[moved]
+        x_pos, y_pos, scale = x_pos[moved], y_pos[moved], scale[moved]
+        # G28/G30 move at rapid rate, and leave the motion mode as it was
+        kind = np.where((non_modal == INTERMEDIATE) | (non_modal == STORED),
+                        MOTION_RAPID, motion)[moved].astype(np.int8)
+        frame = np.where(non_modal == MACHINE, FRAME_MACHINE,
+                         np.where(non_modal == STORED, FRAME_STORED,
+                                  FRAME_WORK))[moved]
+        offset_i, offset_j = tokens["i"][moved], tokens["j"][moved]
+        offsets = ~(np.isnan(offset_i) & np.isnan(offset_j))
+        arcs = kind >= MOTION_CW
+        centre_x = np.where(arcs & offsets,
+                            x_start + np.nan_to_num(offset_i)*scale, np.nan)
+        centre_y = np.where(arcs & offsets,
+                            y_start + np.nan_to_num(offset_j)*scale, np.nan)
+        radius = tokens["r"][moved]*scale
+        for row in np.flatnonzero(arcs & ~offsets):
+            centre = None
+            if not np.isnan(radius[row]):
+                centre = _arc_centre(x_start[row], y_start[row], x_pos[row],
+                                     y_pos[row], radius[row],
+                                     kind[row] == MOTION_CW)
+            if centre is None:
+                kind[row] = MOTION_LINE # Grbl would reject it
+            else:
+                centre_x[row], centre_y[row] = centre
+        table = cls(x0=x_start, y0=y_start, x1=x_pos, y1=y_pos,
+                    cx=centre_x, cy=centre_y, motion=kind,
+                    feed=feed[moved],
+                    power=np.where(laser[moved] & (kind != MOTION_RAPID),
+                                   power[moved], 0.0),
+                    line=tokens["line"][moved], frame=frame)
+        logger.debug("Move table: %d moves", len(table))
+        return table
+
+    @classmethod
+    def from_lines(cls, lines, sources=None):
+        """Interpret lines of gcode, see tokenize()"""
+        return cls.from_tokens([tokenize(lines, sources)])
+
+    @classmethod
+    def from_wire(cls, wire):
+        """Interpret a GcodeParser.WireBuffer"""
+        return cls.from_lines(wire, wire.sources)
+
+    @classmethod
+    def read(cls, in_file, count):
+        """Return the table of count moves written by write()"""
+        return cls(**dict((name, np.fromfile(in_file, dtype=dtype,
+                                             count=count))
+                          for name, dtype in COLUMNS))
+
+    def write(self, out_file):
+        """Write the columns to out_file, one after the other"""
+        for name, _ in COLUMNS:
+            getattr(self, name).tofile(out_file)
+
+    def __len__(self):
+        return len(self.motion)
+
+    ####---- Queries ----####
+    def cuts(self):
+        """Return a mask of the moves that aren't rapids"""
+        return self.motion != MOTION_RAPID
+
+    def arcs(self):
+        """Return a mask of the arcs"""
+        return self.motion >= MOTION_CW
+
+    def _arc_angles(self):
+        """Return the radius, start angle and signed sweep of each arc"""
+        mask = self.arcs()
+        c_x, c_y = self.cx[mask], self.cy[mask]
+        start = np.arctan2(self.y0[mask]-c_y, self.x0[mask]-c_x)
+        end = np.arctan2(self.y1[mask]-c_y, self.x1[mask]-c_x)
+        radius = np.hypot(self.x0[mask]-c_x, self.y0[mask]-c_y)
+        sweep = end - start
+        clockwise = self.motion[mask] == MOTION_CW
+        # A whole circle when it ends where it started
+        sweep = np.where(clockwise & (sweep >= 0), sweep-2*np.pi, sweep)
+        sweep = np.where(~clockwise & (sweep <= 0), sweep+2*np.pi, sweep)
+        return mask, radius, start, sweep
+
+    def _arc_extremes(self):
+        """Return the rows, x and y of the points where arcs cross the axes
+        through their centres, as far as they reach each way"""
+        mask, radius, start, sweep = self._arc_angles()
+        arcs = np.flatnonzero(mask)
+        c_x, c_y = self.cx[mask], self.cy[mask]
+        rows, x_all, y_all = [], [], []
+        for angle in (0.0, np.pi/2, np.pi, 3*np.pi/2):
+            passed = np.where(sweep >= 0,
+                              np.mod(angle-start, 2*np.pi) <= sweep,
+                              np.mod(start-angle, 2*np.pi) <= -sweep)
+            rows.append(arcs[passed])
+            x_all.append((c_x + radius*np.cos(angle))[passed])
+            y_all.append((c_y + radius*np.sin(angle))[passed])
+        return (np.concatenate(rows), np.concatenate(x_all),
+                np.concatenate(y_all))
+
+    def lengths(self):
+        """Return how far each move goes, along the arc for arcs"""
+        if self._lengths is None:
+            lengths = np.hypot(self.x1-self.x0, self.y1-self.y0)
+            if self.arcs().any():
+                mask, radius, _, sweep = self._arc_angles()
+                lengths[mask] = radius * np.abs(sweep)
+            self._lengths = lengths
+        return self._lengths
+
+    def bounds(self, cuts_only=True):
+        """Return (x min, y min, x max, y max) of the moves, or of only the
+        cuts, arcs included, or None if there aren't any
+
+        The job could start from anywhere, so where the first move starts
+        from doesn't count, and only moves in work coordinates do (see
+        FRAME_WORK)."""
+        work = self.frame == FRAME_WORK
+        mask = work & self.cuts() if cuts_only else work
+        if not mask.any():
+            return None
+        starts = mask.copy()
+        starts[0] = False
+        starts[1:] &= work[:-1]
+        x_all = [self.x0[starts], self.x1[mask]]
+        y_all = [self.y0[starts], self.y1[mask]]
+        if self.arcs().any():
+            # Arcs also reach out to wherever they cross an axis
+            rows, x_arcs, y_arcs = self._arc_extremes()
+            x_all.append(x_arcs[mask[rows]])
+            y_all.append(y_arcs[mask[rows]])
+        x_all, y_all = np.concatenate(x_all), np.concatenate(y_all)
+        return (float(x_all.min()), float(y_all.min()),
+                float(x_all.max()), float(y_all.max()))
+
+    def mid(self, cuts_only=True):
+        """Return the (x, y) middle of bounds(), or None"""
+        bounds = self.bounds(cuts_only)
+        if bounds is None:
+            return None
+        return ((bounds[0]+bounds[2]) / 2.0, (bounds[1]+bounds[3]) / 2.0)
+
+    def seconds(self, rapid_rate=RAPID_RATE):
+        """Return how long each move takes, ignoring acceleration"""
+        rates = np.where(self.cuts(), self.feed, rapid_rate)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            seconds = np.where(rates > 0, self.lengths() / rates * 60.0, 0.0)
+        return seconds
+
+    def statistics(self, rapid_rate=RAPID_RATE):
+        """Return the counts and lengths of rapids and cuts, and an estimate
+        of the seconds the job takes, as a dict of STAT_FIELDS"""
+        cuts, lengths = self.cuts(), self.lengths()
+        return dict(rapids=int((~cuts).sum()),
+                    cuts=int(cuts.sum()),
+                    rapid_mm=float(lengths[~cuts].sum()),
+                    cut_mm=float(lengths[cuts].sum()),
+                    seconds=float(self.seconds(rapid_rate).sum()))
+
+    def segments(self, cuts_only=True):
+        """Return the start and end of each move as an (n, 4) array of
+        x0, y0, x1, y1, for a preview; arcs are drawn as chords"""
+        mask = self.cuts() if cuts_only else slice(None)
+        return np.column_stack((self.x0[mask], self.y0[mask],
+                                self.x1[mask], self.y1[mask]))
+
+    def outside(self, x_range, y_range, offset=(0.0, 0.0)):
+        """Return the indices of the moves that go outside the (min, max)
+        ranges of x and y in machine coordinates, arcs included, with the
+        work coordinates offset by offset
+
+        Only where moves end is checked, as that is where the next one
+        starts; the start of the first move is wherever the job starts.
+        Nor are moves to the positions stored in Grbl, which it was at."""
+        work = self.frame == FRAME_WORK
+        x_end = self.x1 + np.where(work, offset[0], 0.0)
+        y_end = self.y1 + np.where(work, offset[1], 0.0)
+        outside = (x_end < x_range[0]) | (x_end > x_range[1]) | \
+                  (y_end < y_range[0]) | (y_end > y_range[1])
+        outside &= self.frame != FRAME_STORED
+        if self.arcs().any():
+            rows, x_arcs, y_arcs = self._arc_extremes()
+            x_arcs, y_arcs = x_arcs + offset[0], y_arcs + offset[1]
+            outside[rows[(x_arcs < x_range[0]) | (x_arcs > x_range[1]) |
+                         (y_arcs < y_range[0]) | (y_arcs > y_range[1])]] = True
+        return np.flatnonzero(outside)
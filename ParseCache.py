@@ -0,0 +1,197 @@
+#!/usr/bin/env python2
+# coding=UTF-8
+"""On-disk cache of compiled gcode files
+
+The same Visicut exports get opened again and again, and compiling one and
+working out its bounding box and statistics takes seconds for a big job.
+ParseCache keeps the result of that, the wire buffer, move table, extrema
+and statistics of a GcodeFile, in a binary file named after the SHA-1 of
+the gcode, so opening it again takes milliseconds:
+
+    header   MAGIC, VERSION, lines, data bytes, moves, extrema, STAT_FIELDS
+    offsets  lines uint32
+    lengths  lines uint32
+    sources  lines uint32
+    data     the wire-ready lines
+    moves    each column of the MoveTable in turn
+
+An index maps (path, size, mtime) to the hash, so a file that hasn't
+changed isn't even read to be hashed. The least recently used files are
+deleted once the cache is over max_bytes."""
+
+__author__ = "Dylan Armitage"
+__email__ = "d.armitage89@gmail.com"
+
+####---- Imports ----####
+from array import array
+from threading import Lock
+
+import os
+import json
+import struct
+import hashlib
+import logging
+
+from GcodeParser import WireBuffer
+from MoveTable import MoveTable, STAT_FIELDS
+
+logger = logging.getLogger(__name__) #pylint: disable=invalid-name
+
+####---- Variables ----####
+PARSE_CACHE_DIR = os.path.expanduser("~/.cache/lasercontrol")
+PARSE_CACHE_BYTES = 512 * 2**20 # Total size to evict down to
+MAGIC = b"K40W"
+VERSION = 3
+HEADER = struct.Struct("<4sIIQI4d{}d".format(len(STAT_FIELDS)))
+SUFFIX = ".k40w"
+INDEX = "index.json"
+HASH_CHUNK = 2**20 # bytes
+
+
+####---- Classes ----####
+class ParseCache(object):
+    """Compiled GcodeFiles, in directory, at most max_bytes of them"""
+    def __init__(self, directory=PARSE_CACHE_DIR, max_bytes=PARSE_CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    @staticmethod
+    def digest(path):
+        """Return the SHA-1 of the contents of path, in hex"""
+        sha1 = hashlib.sha1()
+        with open(path, "rb") as gcode_file:
+            while True:
+                chunk = gcode_file.read(HASH_CHUNK)
+                if not chunk:
+                    break
+                sha1.update(chunk)
+        return sha1.hexdigest()
+
+    @staticmethod
+    def _index_key(path):
+        """Return the index key of the file at path as it is now"""
+        stat = os.stat(path)
+        return "{}|{}|{!r}".format(os.path.abspath(path), stat.st_size,
+                                   stat.st_mtime)
+
+    def _entry(self, name):
+        """Return the path of the cache file for a hash"""
+        return os.path.join(self.directory, name + SUFFIX)
+
+    def _read_index(self):
+        """Return the index, empty if there isn't one yet"""
+        try:
+            with open(os.path.join(self.directory, INDEX)) as index_file:
+                return json.load(index_file)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _write_index(self, index):
+        """Replace the index in one go, as other processes may read it"""
+        path = os.path.join(self.directory, INDEX)
+        with open(path + ".tmp", "w") as index_file:
+            json.dump(index, index_file)
+        os.rename(path + ".tmp", path)
+
+    def _hash_of(self, path):
+        """Return the hash of path, from the index if it hasn't changed"""
+        key = self._index_key(path)
+        index = self._read_index()
+        if key in index:
+            return index[key]
+        name = self.digest(path)
+        with self._lock:
+            index = self._read_index()
+            index[key] = name
+            self._write_index(index)
+        return name
+
+    def load(self, gcodefile):
+        """Fill in the wire buffer, move table, extrema and statistics of
+        gcodefile from the cache, return whether they were there"""
+        try:
+            entry = self._entry(self._hash_of(gcodefile.file))
+            with open(entry, "rb") as cache_file:
+                header = HEADER.unpack(cache_file.read(HEADER.size))
+                magic, version, lines, data_bytes, moves = header[:5]
+                if magic != MAGIC or version != VERSION:
+                    logger.warning("Ignoring %s, wrong format", entry)
+                    return False
+                parts = []
+                for _ in range(3):
+                    part = array("I")
+                    part.fromfile(cache_file, lines)
+                    parts.append(part)
+                data = cache_file.read(data_bytes)
+                table = MoveTable.read(cache_file, moves)
+        except (IOError, OSError, EOFError, ValueError, struct.error):
+            return False
+        if len(data) != data_bytes or len(table) != moves:
+            logger.warning("Ignoring %s, truncated", entry)
+            return False
+        os.utime(entry, None) # Now the most recently used
+        gcodefile.wire = WireBuffer.from_arrays(data, *parts)
+        gcodefile.moves = table
+        x_min, x_max, y_min, y_max = header[5:9]
+        gcodefile.extrema.update(X=[x_min, x_max], Y=[y_min, y_max],
+                                 UL=(x_min, y_min), DR=(x_max, y_max))
+        gcodefile.stats = dict(zip(STAT_FIELDS, header[9:]))
+        for field in ("rapids", "cuts"):
+            gcodefile.stats[field] = int(gcodefile.stats[field])
+        logger.info("Loaded %s from the parse cache", gcodefile.file)
+        return True
+
+    def store(self, gcodefile):
+        """Save the wire buffer, move table, extrema and statistics of
+        gcodefile, which must have been worked out already"""
+        wire = gcodefile.wire
+        table = gcodefile.move_table()
+        entry = self._entry(self._hash_of(gcodefile.file))
+        extrema = gcodefile.extrema
+        stats = gcodefile.statistics()
+        header = HEADER.pack(MAGIC, VERSION, len(wire), len(wire.data),
+                             len(table), extrema["X"][0], extrema["X"][1],
+                             extrema["Y"][0], extrema["Y"][1],
+                             *[stats[field] for field in STAT_FIELDS])
+        with open(entry + ".tmp", "wb") as cache_file:
+            cache_file.write(header)
+            wire.offsets.tofile(cache_file)
+            wire.lengths.tofile(cache_file)
+            wire.sources.tofile(cache_file)
+            cache_file.write(wire.data)
+            table.write(cache_file)
+        os.rename(entry + ".tmp", entry)
+        logger.info("Saved %s to the parse cache", gcodefile.file)
+        self.evict()
+
+    def evict(self):
+        """Delete the least recently used files while over max_bytes, and
+        drop index entries for files that are gone"""
+        with self._lock:
+            entries = []
+            for name in os.listdir(self.directory):
+                if name.endswith(SUFFIX):
+                    stat = os.stat(os.path.join(self.directory, name))
+                    entries.append((stat.st_mtime, stat.st_size, name))
+            total = sum(size for _, size, _ in entries)
+            entries.sort()
+            while entries and total > self.max_bytes:
+                _, size, name = entries.pop(0)
+                logger.debug("Parse cache dropped %s", name)
+                os.remove(os.path.join(self.directory, name))
+                total -= size
+            kept = set(name[:-len(SUFFIX)] for _, _, name in entries)
+            index = self._read_index()
+            pruned = dict((key, name) for key, name in index.items()
+                          if name in kept)
+            if len(pruned) != len(index):
+                self._write_index(pruned)
+
+    def size(self):
+        """Return the bytes the cached files take up"""
+        return sum(os.path.getsize(os.path.join(self.directory, name))
+                   for name in os.listdir(self.directory)
+                   if name.endswith(SUFFIX))
@@ -11,10 +11,18 @@ __email__ = "d.armitage89@gmail.com"
 
 ####---- Import ----####
 from collections import deque
-from threading import Thread
-from Queue import Queue, Empty
+from threading import Thread, Lock, Event
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
 
+import os
 import re
+import math
+import heapq
+import fcntl
+import select
 import logging
 import time
 import datetime
@@ -22,32 +30,396 @@ import serial
 
 logger = logging.getLogger(__name__) #pylint: disable=invalid-name
 
-from GrblCodes import ALARM_CODES, ERROR_CODES
+from GrblCodes import ALARM_CODES, ERROR_CODES, OVERRIDE_CODES, \
+                      OVERRIDE_LIMITS, RAPID_OVERRIDES
+from MachineState import MachineState, PositionHistory, ChangeQueue
 
 # Global variables
 SERIAL_TIMEOUT = 0.1 # seconds
 SERIAL_POLL = 0.25 # seconds
 G_POLL = 10 # seconds
-RX_BUFFER_SIZE = 128 # bytes
+RX_BUFFER_SIZE = 128 # bytes, until a Bf: status field says otherwise
+FULL_PLANNER_LOOKAHEAD = 0.5 # Fraction of the RX buffer used while the
+                             # planner is full
+RESET_TIMEOUT = 1.0 # seconds to wait for the banner after a soft reset
+BOOT_TIMEOUT = 2.5 # seconds to wait for the banner after opening the port
+CLOSE_TIMEOUT = 1.0 # seconds to wait for a stop, and the I/O thread, on close
+LATENCY_BASE = 0.001 # seconds, upper bound of the first histogram bucket
+LATENCY_BUCKETS = 16 # Each bucket is twice as wide as the one before
+LATENCY_SLOWEST = 10 # How many of the slowest lines to keep
+OVERRIDE_INTERVAL = 0.01 # seconds between steps towards an override target,
+                         # so that Grbl doesn't merge them into one
+OVERRIDE_SETTLE = 2*SERIAL_POLL # seconds before trusting Ov: after a step
 OUTPUT_LOG_QUEUE = False # Whether to write the log queue to a file
 
 # RegEx
 SPLITPOS = re.compile(r"[:,]")
+WHITESPACE = re.compile(r"\s|\(.*?\)")
+
+def to_wire(line):
+    """Take a line of gcode, return it as the bytes to send to GRBL
+
+    Views of a GcodeParser.WireBuffer are already wire-ready and are
+    returned untouched."""
+    if isinstance(line, memoryview):
+        return line
+    # Reformat line to be ASCII and remove all spaces, comments and newline
+    # characters. We want each line to be as short as possible.
+    line = WHITESPACE.sub("", line).upper()
+    return line.encode("ascii", "replace") + b"\n"
+
+def override_target(override, percent):
+    """Return the override percentage Grbl can actually do closest to percent
+
+    Feed and spindle are clamped to what Grbl allows, rapid goes to the
+    nearest of 25, 50 and 100%."""
+    if override == "rapid":
+        return min(RAPID_OVERRIDES, key=lambda rate: abs(rate-percent))
+    low, high = OVERRIDE_LIMITS[override][:2]
+    return int(round(min(max(percent, low), high)))
+
+def override_step(override, current, target):
+    """Return (realtime command, new %) for one step of override from the
+    current towards the target percentage"""
+    codes = OVERRIDE_CODES[override]
+    if override == "rapid":
+        return codes[RAPID_OVERRIDES[target]], target
+    if target == 100:
+        return codes["reset"], target
+    coarse, fine = OVERRIDE_LIMITS[override][2:]
+    change = target - current
+    size = "coarse" if abs(change) >= coarse else "fine"
+    step = coarse if size == "coarse" else fine
+    if change > 0:
+        return codes[size+"_plus"], current+step
+    return codes[size+"_minus"], current-step
+
+class GrblError(Exception):
+    """An error:N, or ALARM:N, that Grbl answered a command with"""
+    def __init__(self, code, alarm=False, command=None):
+        codes = ALARM_CODES if alarm else ERROR_CODES
+        short_msg, self.description = codes.get(code, ("Unknown", ""))
+        Exception.__init__(self, "{}:{} {}".format(
+            "ALARM" if alarm else "error", code, short_msg))
+        self.code = code
+        self.alarm = alarm
+        self.command = command
+
+
+class CommandCancelled(Exception):
+    """A command was thrown away, by a reset or stop, before Grbl answered,
+    or Grbl went into Alarm while waiting for it to be Idle"""
+
+
+class CommandTimeout(Exception):
+    """CommandFuture.result() gave up waiting"""
+
+
+class CommandFuture(object):
+    """The eventual answer of Grbl to a command
+
+    Works like concurrent.futures.Future, which Python 2 doesn't have.
+    Callbacks run on the I/O thread, so they must be quick and must not
+    touch Tk."""
+    def __init__(self, command=None):
+        self.command = command
+        self._lock = Lock()
+        self._event = Event()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def done(self):
+        """Whether Grbl has answered, or the command was cancelled"""
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        """Wait for the answer, return "ok" or raise what went wrong"""
+        exception = self.exception(timeout)
+        if exception is not None:
+            raise exception
+        return self._result
+
+    def exception(self, timeout=None):
+        """Wait for the answer, return what went wrong or None"""
+        if not self._event.wait(timeout):
+            raise CommandTimeout(self.command)
+        return self._exception
+
+    def add_done_callback(self, callback):
+        """Call callback(future) once resolved, at once if it already is"""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        self._call(callback)
+
+    def set_result(self, result):
+        """Resolve with result, return False if already resolved"""
+        return self._resolve(result, None)
+
+    def set_exception(self, exception):
+        """Fail with exception, return False if already resolved"""
+        return self._resolve(None, exception)
+
+    def _resolve(self, result, exception):
+        with self._lock:
+            if self._event.is_set():
+                return False
+            self._result = result
+            self._exception = exception
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            self._call(callback)
+        return True
+
+    def _call(self, callback):
+        try:
+            callback(self)
+        except Exception: # pylint: disable=broad-except
+            logger.exception("Callback for %r failed", self.command)
+
+
+class CharCounter(object):
+    """Character-counting flow control for GRBL's serial RX buffer
+
+    Tracks the lines sent but not yet acknowledged along with a running
+    total of their lengths, so checking for room never walks the deque."""
+    def __init__(self, size=RX_BUFFER_SIZE):
+        self.size = size
+        self.limit = size # How much of the buffer to fill, at most size
+        self.used = 0
+        self.pushed = 0 # Lines sent, ever
+        self.popped = 0 # Lines answered or thrown away, ever
+        self.learned = False # Whether size came from Grbl yet
+        self._lines = deque()
+
+    def fits(self, length):
+        """Whether a line of length bytes can be sent right now"""
+        # A lone line always fits, so an overlong one can't stall the stream
+        return not self._lines or self.used + length < self.limit - 1
+
+    def resize(self, size):
+        """Change the size of the RX buffer being tracked"""
+        self.size = self.limit = size
+
+    def learn(self, rx_free):
+        """Size the buffer from the RX bytes free in a Bf: status field
+
+        The first report while nothing is in flight gives the real size of
+        the RX buffer. After that it can only be an underestimate, so the
+        size is only ever grown."""
+        if not self.learned and not self._lines:
+            self.learned = True
+            if rx_free+1 != self.size:
+                logger.info("Grbl RX buffer is %d bytes", rx_free+1)
+                self.resize(rx_free+1)
+        elif rx_free+1 > self.size:
+            logger.info("Grbl RX buffer is at least %d bytes", rx_free+1)
+            self.resize(rx_free+1)
+
+    def throttle(self, planner_full):
+        """Use less of the RX buffer while the planner is full
+
+        Grbl can't take another line until a block finishes, so there is no
+        point burying later commands under more of the job than that."""
+        if planner_full:
+            self.limit = max(int(self.size*FULL_PLANNER_LOOKAHEAD), 2)
+        else:
+            self.limit = self.size
+
+    def push(self, line, t_sent, source=None, future=None):
+        """Record that line (from source line number source) was sent"""
+        self._lines.append((line, t_sent, source, future))
+        self.used += len(line)
+        self.pushed += 1
+
+    def pop(self):
+        """Record an ok/error from GRBL
+
+        Returns the (line, t_sent, source, future) it acknowledges, or None"""
+        try:
+            entry = self._lines.popleft()
+        except IndexError:
+            # Mostly because sending "$H\n" (aka, homing) to Grbl triggers
+            # Grbl to send back two "ok".
+            logger.debug("No line waiting on a response")
+            return None
+        self.used -= len(entry[0])
+        self.popped += 1
+        return entry
+
+    def clear(self):
+        """Forget every outstanding line, return the entries forgotten"""
+        entries = list(self._lines)
+        self._lines.clear()
+        self.used = 0
+        self.popped = self.pushed
+        return entries
+
+    def __len__(self):
+        return len(self._lines)
+
+
+class JobSource(object):
+    """The lines of a job, handed out one at a time as GRBL has room
+
+    Takes a GcodeParser.WireBuffer, whose lines are sent as they are, or any
+    other iterable of gcode lines, which are run through to_wire() one at a
+    time. Nothing is copied or queued up front. A WireBuffer that is still
+    being compiled (see GcodeParser.GcodeLoader) is followed as it grows."""
+    def __init__(self, lines):
+        try:
+            self.total = len(lines)
+        except TypeError:
+            self.total = 0 # Unknown
+        self.sent = 0
+        self._wire = lines if hasattr(lines, "sources") else None
+        self._lines = None if self._wire else enumerate(lines, 1)
+        self.exhausted = False
+
+    def next_line(self):
+        """Return (wire-ready line, source line number), or None at the end"""
+        if self._wire is not None:
+            if self.sent >= self.total:
+                # complete is read first, so if it is set total is final
+                complete = getattr(self._wire, "complete", True)
+                self.total = len(self._wire)
+                if self.sent >= self.total:
+                    self.exhausted = complete
+                    return None # If not complete, more is on its way
+            index = self.sent
+            self.sent += 1
+            return self._wire.line(index), self._wire.sources[index]
+        for number, line in self._lines:
+            line = to_wire(line)
+            if len(line) > 1: # Skip what was only whitespace and comments
+                self.sent += 1
+                return line, number
+        self.exhausted = True
+        return None
+
+    def progress(self):
+        """Return the fraction of the job sent so far, 0.0 if unknown"""
+        return self.sent / float(self.total) if self.total else 0.0
+
+
+class LatencyStats(object):
+    """Round-trip times from sending a line to its ok/error
+
+    Keeps a histogram with power-of-two buckets starting at LATENCY_BASE and
+    the LATENCY_SLOWEST slowest lines. Written by the I/O thread, and safe to
+    read from any other thread while a job runs."""
+    def __init__(self):
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        """Forget everything recorded so far"""
+        with self._lock:
+            self.counts = [0] * LATENCY_BUCKETS
+            self.count = 0
+            self.total = 0.0
+            self.max = 0.0
+            self._slowest = [] # Min-heap of (rtt, source, line)
+
+    def record(self, rtt, source, line):
+        """Add a round-trip time for line from source line number source"""
+        bucket = min(max(math.frexp(rtt / LATENCY_BASE)[1], 0),
+                     LATENCY_BUCKETS-1)
+        with self._lock:
+            self.counts[bucket] += 1
+            self.count += 1
+            self.total += rtt
+            self.max = max(self.max, rtt)
+            if len(self._slowest) < LATENCY_SLOWEST:
+                heapq.heappush(self._slowest, (rtt, source, line))
+            elif rtt > self._slowest[0][0]:
+                heapq.heapreplace(self._slowest, (rtt, source, line))
+
+    def histogram(self):
+        """Return a list of (bucket upper bound in seconds, count)"""
+        with self._lock:
+            counts = list(self.counts)
+        return [(LATENCY_BASE * 2**bucket, count)
+                for bucket, count in enumerate(counts)]
+
+    def slowest(self):
+        """Return a list of (rtt, source line number, line), slowest first"""
+        with self._lock:
+            slowest = sorted(self._slowest, reverse=True)
+        return [(rtt, source,
+                 memoryview(line).tobytes().decode("ascii").strip())
+                for rtt, source, line in slowest]
+
+    def percentile(self, fraction):
+        """Return the bucket bound that fraction of round trips fall under"""
+        histogram = self.histogram()
+        wanted = fraction * sum(count for _, count in histogram)
+        seen = 0
+        for bound, count in histogram:
+            seen += count
+            if count and seen >= wanted:
+                return bound
+        return None
+
+    def summary(self):
+        """Return a dict summarizing the round-trip times"""
+        with self._lock:
+            count, total, longest = self.count, self.total, self.max
+        return dict(count=count,
+                    mean=total / count if count else None,
+                    max=longest,
+                    p50=self.percentile(0.5),
+                    p90=self.percentile(0.9),
+                    p99=self.percentile(0.99),
+                    slowest=self.slowest())
+
 
 class Sender(object):
-    """Class that controls access to GRBL"""
+    """Class that controls access to GRBL
+
+    Everything sent to GRBL goes through the I/O thread, in three lanes:
+    realtime bytes (self.realtime), then interactive commands (self.queue),
+    then the job being streamed (self._job). Interactive commands come with
+    a CommandFuture that resolves once Grbl answers them."""
     # pylint: disable=too-many-instance-attributes
     # If we get many more than 8 though...
+    stop_on_close = True # Whether closing the port stops the run
     def __init__(self):
         #self.log = Queue() # What is returned from GRBL
         self.log = ""
-        self.queue = Queue() # What to send to GRBL
+        self.realtime = deque() # Realtime bytes to send to GRBL
+        self.queue = Queue() # Commands to send to GRBL
+        self._job = None # JobSource being streamed
         self.error = Queue() # Lengthy error messages
         self.pos = None # Will be (x,y,z) of machine position
+        self.state = MachineState() # Latest status report, see MachineState
+        self.history = PositionHistory() # Recent machine positions
+        self.changes = ChangeQueue() # state and overrides, for the GUI
         self.serial = None
         self.thread = None
+        self._wake_r = None # Pipe used to wake up the I/O thread
+        self._wake_w = None
         self.progress = 0.0
         self.max_size = 0.0
+        self._flow = CharCounter()
+        self.buffer_state = None # Will be (planner blocks, RX bytes) free
+        self.planner_size = 0 # Most planner blocks ever reported free
+        self.starved = 0 # Number of times the planner ran dry mid-job
+        self.starved_time = 0.0 # seconds
+        self._hold_until = 0.0 # Send nothing but realtime bytes until then
+        self._grbl_ready = Event() # Set once Grbl answers after opening
+        self._t_status = None # When the planner was last seen starved
+        self._primed = False # Whether the planner has had work this run
+        self.latency = LatencyStats()
+        self.overrides = dict(feed=100, rapid=100, spindle=100) # %
+        self._override_targets = {} # Overrides still being stepped towards
+        self._t_override = 0.0 # When the last override step was sent
+        self._polls = 0 # Status polls sent
+        self._reports = 0 # Status reports received
+        self._idle_waiters = [] # [lines sent before, poll, future]
 
         self.running = False
         self._stop = False # Set to True to stop current run
@@ -64,7 +436,10 @@ class Sender(object):
         self._sum_command_lens = 0
 
     def _open_serial(self, device):
-        """Open serial port"""
+        """Open serial port
+
+        Returns at once. Lines sent before Grbl shows it is up, with its
+        banner or a status report, wait in the queue; see wait_ready()."""
         logger.info("Opening serial device")
         self.serial = serial.serial_for_url(device,
                                             baudrate=115200,
@@ -78,62 +453,87 @@ class Sender(object):
         # Toggle DTR to reset the arduino
         try:
             self.serial.setDTR(0)
-            time.sleep(1)
             self.serial.setDTR(1)
-            time.sleep(1)
         except IOError:
             logger.debug("IOError on setDTR(), but not important")
             pass
         self.serial.write(b"\n\n")
+        self._flow = CharCounter()
+        self._grbl_ready.clear()
+        self._hold_until = time.time() + BOOT_TIMEOUT
+        self.realtime.clear()
+        self._wake_r, self._wake_w = os.pipe()
+        for wake_fd in (self._wake_r, self._wake_w):
+            flags = fcntl.fcntl(wake_fd, fcntl.F_GETFL)
+            fcntl.fcntl(wake_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
         self.thread = Thread(target=self._serial_io, name="SerialIOThread")
         self.thread.start()
         logger.info("I/O thread started: %s", self.thread.name)
         return True
 
-    def _close_serial(self):
-        """Close serial port"""
+    def wait_ready(self, timeout=None):
+        """Wait for Grbl to answer after opening, return whether it did"""
+        return self._grbl_ready.wait(timeout)
+
+    def _close_serial(self, stop=True):
+        """Close serial port
+
+        Unless stop is False, the run is stopped first, waiting up to
+        CLOSE_TIMEOUT for Grbl to be reset and unlocked."""
         logger.info("Closing serial device")
         if self.serial is None:
             return
-        try:
-            self._stop_run()
-        except BaseException:
-            pass
-        logger.info("Stopping thread %s", self.thread.name)
+        if stop and self.stop_on_close:
+            try:
+                self._stop_run().result(CLOSE_TIMEOUT)
+            except BaseException:
+                pass
+        thread = self.thread
+        logger.info("Stopping thread %s", thread.name)
         self.thread = None
-        time.sleep(1)
+        self._wakeup()
+        thread.join(CLOSE_TIMEOUT)
         try:
             self.serial.close()
         except BaseException:
             logger.exception("Error closing serial")
         self.serial = None
+        wake_fds = (self._wake_r, self._wake_w)
+        self._wake_r = self._wake_w = None
+        for wake_fd in wake_fds:
+            os.close(wake_fd)
         if OUTPUT_LOG_QUEUE:
             self.__write_log_queue()
         return True
 
     def _stop_run(self):
-        """Stop the current run of Gcode"""
+        """Stop the current run of Gcode
+
+        Returns a CommandFuture resolved once Grbl is unlocked again"""
         logger.debug("Called Sender._stop_run()")
         logger.info("Stopping run")
         #self._stop = True
-        logger.debug("Purging Grbl")
-        self._purge_grbl()
-        logger.debug("Clearing queue")
-        self._empty_queue()
+        self._job = None
         self.progress = 0.0
         self.max_size = 0.0
+        logger.debug("Clearing queue")
+        self._empty_queue()
+        logger.debug("Purging Grbl")
+        unlocked = self._purge_grbl()
         logger.info("Run Stopped")
+        return unlocked
 
     def _purge_grbl(self):
-        """Purge the buffer of grbl"""
+        """Purge the buffer of grbl, return the CommandFuture of the unlock"""
         logger.debug("Called Sender._purge_grbl()")
         logger.debug("Calling self._soft_reset()")
         self._soft_reset()
         logger.debug("Calling self._unlock()")
-        self._unlock()
+        unlocked = self._unlock()
         logger.debug("Calling _run_ended()")
         self._run_ended()
         logger.info("Grbl purged")
+        return unlocked
 
     def _run_ended(self):
         """Called when run is finished"""
@@ -147,18 +547,20 @@ class Sender(object):
     def _soft_reset(self):
         """Send GRBL reset command"""
         logger.debug("Called Sender._soft_reset()")
-        if self.serial:
-            self.serial.write(b"\x18")
-            logger.debug("Sent b'\x18'")
+        self._send_realtime(b"\x18")
 
     def _unlock(self):
-        """Send GRBL unlock command"""
+        """Send GRBL unlock command, return the CommandFuture of its last line
+
+        Straight after a soft reset, the I/O thread holds the lines back
+        until Grbl has restarted."""
         logger.debug("Called Sender._unlock()")
         self._send_gcode("$X")
-        time.sleep(0.25)
-        self.serial.write(b"\n\n")
+        self._send_gcode("")
+        unlocked = self._send_gcode("")
         self.progress = 0.0
         self.max_size = 0.0
+        return unlocked
 
     def _home(self):
         """Send GRBL home command"""
@@ -175,23 +577,121 @@ class Sender(object):
         jog_list.append("F{}".format(speed))
         jog_cmd = "".join(jog_list)
         logger.info("Jogging X%s Y%s @ F%s", x, y, speed)
-        self._send_gcode(jog_cmd)
+        return self._send_gcode(jog_cmd)
 
     def jog_cancel(self):
         """Cancel jog command"""
         logger.info("Cancelling jog")
-        self.serial.write(b"\x85")
+        self._send_realtime(b"\x85")
 
-    def _send_gcode(self, command):
-        """Send GRBL a Gcode/command line"""
-        logger.debug("Called Sender._send_gcode() with %s", command)
+    def override(self, override, action):
+        """Send a single override command, see GrblCodes.OVERRIDE_CODES
+
+        override is "feed", "rapid" or "spindle" (the laser power), action
+        one of its keys, e.g. override("feed", "coarse_plus") for +10%."""
+        logger.info("Override %s %s", override, action)
+        self._override_targets.pop(override, None)
+        self._send_realtime(OVERRIDE_CODES[override][action])
+
+    def set_override(self, override, percent):
+        """Step the feed, rapid or spindle (laser power) override to percent
+
+        Returns the percentage aimed for, see override_target()."""
+        percent = override_target(override, percent)
+        logger.info("Setting %s override to %d%%", override, percent)
+        if self.serial:
+            self._override_targets[override] = percent
+            self._wakeup()
+        return percent
+
+    def send(self, command):
+        """Send GRBL a Gcode/command line
+
+        Returns a CommandFuture resolved with "ok", or failed with a
+        GrblError, once Grbl answers."""
+        logger.debug("Called Sender.send() with %s", command)
+        future = CommandFuture(command)
         # Do nothing if not actually up
-        logger.debug(("send_gcode", {"serial": self.serial,
-                                     "running": self.running
-                                    }))
+        logger.debug(("send", {"serial": self.serial,
+                               "running": self.running
+                              }))
         if self.serial: # and not self.running:
             logger.debug("self.serial == True")
-            self.queue.put(command+"\n")
+            self.queue.put((command, future))
+            self._wakeup()
+        else:
+            future.set_exception(CommandCancelled(command))
+        return future
+
+    def send_all(self, commands):
+        """Send several lines at once, return a CommandFuture for all of them
+
+        It resolves with the last "ok", or fails with the first error."""
+        combined = CommandFuture(commands)
+        futures = [self.send(command) for command in commands]
+        def answered(future):
+            """Pass on the first error, or the answer to the last line"""
+            if future.exception() is not None:
+                combined.set_exception(future.exception())
+            elif future is futures[-1]:
+                combined.set_result(future.result())
+        for future in futures:
+            future.add_done_callback(answered)
+        if not futures:
+            combined.set_result(None)
+        return combined
+
+    def wait_idle(self):
+        """Return a CommandFuture that resolves once everything sent so far
+        has been answered and Grbl reports that it is Idle"""
+        future = CommandFuture("Idle")
+        if self.serial:
+            self.queue.put((None, future))
+            self._wakeup()
+        else:
+            future.set_exception(CommandCancelled(future.command))
+        return future
+
+    def _send_gcode(self, command):
+        """Send GRBL a Gcode/command line, see send()"""
+        return self.send(command)
+
+    def _send_realtime(self, command):
+        """Send GRBL a realtime command byte, ahead of everything else"""
+        logger.debug("Called Sender._send_realtime() with %r", command)
+        if self.serial:
+            self.realtime.append(command)
+            self._wakeup()
+
+    def _wakeup(self):
+        """Wake the I/O thread so that it sees new work right away"""
+        if self._wake_w is None:
+            return
+        try:
+            os.write(self._wake_w, b"\0")
+        except OSError:
+            # The pipe is full, so the thread has plenty of wakeups pending
+            pass
+
+    def _start_job(self, lines):
+        """Start streaming a job
+
+        lines is a GcodeParser.WireBuffer or any iterable of gcode lines. The
+        I/O thread pulls lines from it only as GRBL's buffer has room."""
+        job = JobSource(lines)
+        logger.info("Lines to send: %s", job.total or "unknown")
+        self.max_size = float(job.total) if job.total else float("inf")
+        self.progress = 0.0
+        self.starved = 0
+        self.starved_time = 0.0
+        self._primed = False
+        self.latency.reset()
+        self._job = job
+        self._wakeup()
+
+    def _start_file(self, gcodefile):
+        """Start streaming a GcodeParser.GcodeFile"""
+        self._start_job(gcodefile.wire_buffer())
 
     def _empty_queue(self):
         """Clear the queue"""
@@ -200,10 +700,11 @@ class Sender(object):
         while self.queue.qsize() > 0:
             logger.debug("Current qsize: %s", self.queue.qsize())
             try:
-                self.queue.get_nowait()
+                command, future = self.queue.get_nowait()
             except Empty:
                 logger.debug("Emptying Queue, qsize == 0")
                 break
+            future.set_exception(CommandCancelled(command))
 
     def _init_run(self):
         """Initialize a gcode run"""
@@ -221,7 +722,6 @@ class Sender(object):
         logger.info("Initializing run")
         self.max_size = 0.0
         self.progress = 0.0
-        time.sleep(1) # Give everything a bit of time
 
     def _pause(self):
         """Pause run"""
@@ -237,8 +737,7 @@ class Sender(object):
         else:
             logger.debug("_paused==False, so pausing")
             logger.info("Pausing run")
-            self.serial.write(b"!")
-            self.serial.flush()
+            self._send_realtime(b"!")
             self._paused = True
         logger.debug(("pause, post", {"_serial": self.serial,
                                       "_pause": self._paused,
@@ -253,8 +752,7 @@ class Sender(object):
         if self.serial is None:
             return
         logger.info("Resuming run")
-        self.serial.write(b"~")
-        self.serial.flush()
+        self._send_realtime(b"~")
         self._paused = False
         logger.debug(("resume, post", {"_serial": self.serial,
                                        "_pause": self._paused,
@@ -273,17 +771,74 @@ class Sender(object):
         code = int(code)
         if msg == "ALARM":
             short_msg, long_msg = ALARM_CODES[code]
+            # Grbl won't go Idle until it is unlocked
+            self.__fail_idle_waiters(GrblError(code, alarm=True))
         elif msg == "ERROR":
             short_msg, long_msg = ERROR_CODES[code]
         self.error.put((msg, code, long_msg))
         #self.log.put("{} {}".format(alarm, short_msg))
         self.log = "{} {}".format(alarm, short_msg)
 
-    def __parse_position(self, field):
-        """Sets self.pos tuple with machine position"""
-        position = SPLITPOS.split(field)
-        self.pos = tuple(float(f) for f in position[1:])
-        logger.debug("Position: %s", self.pos)
+    def __parse_buffer(self, field):
+        """Tune flow control from the Bf: field of a status report
+
+        Grbl reports the planner blocks and RX buffer bytes it has free. The
+        RX bytes size the buffer (see CharCounter.learn()), and the planner
+        fill is used to catch starvation and to decide how far ahead to
+        stream."""
+        blocks, rx_free = (int(f) for f in SPLITPOS.split(field)[1:3])
+        self.buffer_state = (blocks, rx_free)
+        flow = self._flow
+        flow.learn(rx_free)
+        self.planner_size = max(self.planner_size, blocks)
+        t_curr = time.time()
+        streaming = self.max_size > 0 and not self._paused
+        if streaming and blocks < self.planner_size:
+            self._primed = True
+        if streaming and self._primed and blocks == self.planner_size:
+            # The planner is empty in the middle of a job
+            if self._t_status is not None:
+                self.starved_time += t_curr-self._t_status
+            else:
+                self.starved += 1
+                logger.warning("Planner starved (%d times this run)",
+                               self.starved)
+            self._t_status = t_curr
+            flow.throttle(False)
+        else:
+            self._t_status = None
+            flow.throttle(blocks == 0)
+
+    def __parse_overrides(self, field):
+        """Sets self.overrides from the Ov: field of a status report"""
+        if time.time()-self._t_override < OVERRIDE_SETTLE:
+            return # Steps are still in flight, so the report is stale
+        feed, rapid, spindle = (int(f) for f in SPLITPOS.split(field)[1:4])
+        overrides = dict(feed=feed, rapid=rapid, spindle=spindle)
+        if overrides != self.overrides:
+            self.overrides = overrides
+            self.changes.put("overrides", dict(overrides))
+            logger.debug("Overrides: %s", self.overrides)
+
+    def __override_steps(self, t_curr):
+        """Return the next realtime commands towards the override targets
+
+        Grbl merges repeats of a command that arrive between two of its
+        realtime checks, so only one step per override is sent each call."""
+        steps = bytearray()
+        for override, target in list(self._override_targets.items()):
+            current = self.overrides[override]
+            if current == target:
+                if self._override_targets.get(override) == target:
+                    del self._override_targets[override]
+                continue
+            command, current = override_step(override, current, target)
+            self.overrides[override] = current
+            steps += command
+            self._t_override = t_curr
+        if steps:
+            self.changes.put("overrides", dict(self.overrides))
+        return steps
 
     def __process_messages(self, message):
         """Master message processing"""
@@ -291,17 +846,42 @@ class Sender(object):
             logger.debug("Status message received: %s", message)
             status_msg = message[1:-1]
             status_fields = status_msg.split("|")
+            previous = self.state
+            state = MachineState.from_report(status_fields, previous,
+                                             time.time(), self.progress)
+            self.state = state # Published in one go
+            self.changes.put("state", state)
             #self.log.put(status_fields[0])
-            self.log = status_fields[0]
+            self.log = state.status
+            if state.mpos is not None:
+                self.pos = state.mpos
+                if state.mpos != previous.mpos:
+                    self.history.append(state.time, state.mpos)
+            self._reports += 1
+            if not self._grbl_ready.is_set():
+                # Up without a reset, e.g. no DTR on the port
+                self.__grbl_up()
+            if status_fields[0] in ("Idle", "Alarm"):
+                self.__resolve_idle_waiters(status_fields[0])
             if "error" in status_fields[0].lower():
                 logger.error("Grbl Error: %s", message)
             elif "alarm" in status_fields[0].lower():
                 logger.error("Grbl Alarm: %s", message)
             for field in status_fields[1:]:
-                if "MPos:" in field:
-                    self.__parse_position(field)
+                if "Bf:" in field:
+                    self.__parse_buffer(field)
+                elif "Ov:" in field:
+                    self.__parse_overrides(field)
         elif any(item in message.upper() for item in ["ALARM", "ERROR"]):
             self.__parse_alarm(message.upper())
+        elif message.startswith("Grbl "):
+            logger.info("Grbl started: %s", message)
+            self.__grbl_up()
+            # A reset puts every override back to 100%
+            self.overrides = dict(feed=100, rapid=100, spindle=100)
+            self.changes.put("overrides", dict(self.overrides))
+            self._override_targets.clear()
+            self._reports = self._polls # Polls lost to the reset
         elif "MSG" in message:
             recv_msg = message[1:-1]
             logger.info("Grbl %s", recv_msg)
@@ -312,88 +892,229 @@ class Sender(object):
             logger.error("Unexpected output: %s", message)
 
 
+    def __grbl_up(self):
+        """Grbl is ready for lines again"""
+        self._hold_until = 0.0
+        self._grbl_ready.set()
+        self._wakeup()
+
+    def __job_done(self, job, reset=False):
+        """Called by the I/O thread once all of job has been acknowledged,
+        or thrown away by a reset"""
+        if job is None:
+            return
+        if reset:
+            logger.info("Job aborted by reset")
+        else:
+            logger.info("Job sent, planner starved %d times for %.2fs",
+                        self.starved, self.starved_time)
+        logger.info("Round trips: %s", self.latency.summary())
+        if self._job is job:
+            self._job = None
+            self.max_size = 0.0
+            self.progress = 0.0
+
+    def __acknowledge(self, entry, t_curr, response="ok"):
+        """Record the round trip of a line GRBL has responded to, and
+        resolve its future"""
+        if entry is None:
+            return
+        line, t_sent, source, future = entry
+        self.latency.record(t_curr-t_sent, source, line)
+        if future is None:
+            return
+        if response == "ok":
+            future.set_result(response)
+            return
+        try:
+            code = int(response.split(":")[1])
+        except (IndexError, ValueError):
+            code = None
+        future.set_exception(GrblError(code, command=future.command))
+
+    def __arm_idle_waiters(self):
+        """Start polling for Idle for the waiters whose lines have all been
+        answered, return whether there were any"""
+        armed = False
+        for waiter in self._idle_waiters:
+            if waiter[1] is None and self._flow.popped >= waiter[0]:
+                waiter[1] = self._polls # Needs the answer to a later poll
+                armed = True
+        return armed
+
+    def __resolve_idle_waiters(self, state):
+        """Resolve the waiters armed before the poll just answered"""
+        waiting = []
+        for waiter in self._idle_waiters:
+            if waiter[1] is not None and self._reports > waiter[1]:
+                if state == "Idle":
+                    waiter[2].set_result(state)
+                else: # Not going to be Idle until unlocked
+                    waiter[2].set_exception(CommandCancelled(state))
+            else:
+                waiting.append(waiter)
+        self._idle_waiters = waiting
+
+    def __fail_idle_waiters(self, exception):
+        """Fail every idle waiter with exception"""
+        waiters, self._idle_waiters = self._idle_waiters, []
+        for waiter in waiters:
+            waiter[2].set_exception(exception)
+
+    def __cancel_sent(self, entries, exception):
+        """Fail the futures of lines Grbl will never answer"""
+        for entry in entries:
+            if entry[3] is not None:
+                entry[3].set_exception(exception)
+
     def _serial_io(self):
         """Process to perform I/O on GRBL
 
-        This is borrowed heavily from stream.py of the GRBL project"""
+        Sleeps in select() on the serial port and the wakeup pipe, so it only
+        runs when Grbl sent something, there is new work to send, or a status
+        poll is due. Flow control is borrowed heavily from stream.py of the
+        GRBL project"""
         # pylint: disable=too-many-statements,too-many-branches
-        # TODO: reduce number of statements
-        # TODO: reduce number of branches (somehow...)
         logger.debug("serial_io started")
-        line_count = 0
-        error_count = 0
-        gcode_count = 0
-        char_line = deque()
-        sent_line = deque()
-        line = None
-        done = False
-        t_poll = time.time()
-
-        while self.thread: # pylint: disable=too-many-nested-blocks
-            # TODO: reduce number of nested blocks
-            t_curr = time.time()
-            # Poll status if enough time has passed
-            if t_curr-t_poll > SERIAL_POLL:
-                self.serial.write("?")
-                t_poll = t_curr
-            # Get other commands from queue
-            try:
-                line = self.queue.get_nowait()
-            except Empty:
-                line = None
-            logger.debug(("serial_io dur DEBUG:", {"line": line}))
-            if isinstance(line, tuple):
-                if line[0] == "DONE":
-                    done = True
-                line = None
-            if line is not None:
-                line_count += 1
-                if self.max_size > 0:
-                    self.progress = line_count / self.max_size
-                # Reformat line to be ASCII and remove all spaces, comments
-                # and newline characters. We want each line to be as short as
-                # possible.
-                line = line.encode("ascii", "replace").strip()
-                line_block = re.sub(r"\s|\(.*?\)", "", line).upper()
-                # Track number of characters in the Grbl buffer
-                char_line.append(len(line_block)+1)
-                sent_line.append(line_block)
-                while (sum(char_line) >= RX_BUFFER_SIZE-1
-                       or self.serial.in_waiting > 0):
-                    out_temp = self.serial.readline().strip()
-                    if len(out_temp) > 0:
-                        if out_temp.find("ok") >= 0:
-                            gcode_count += 1
-                            # The following try-except block seems to be mostly
-                            # because sending "$H\n" (aka, homing) to Grbl
-                            # triggers Grbl to send back two "ok".
-                            try:
-                                logger.debug("Removing most recent command")
-                                char_line.popleft()
-                                sent_line.popleft()
-                            except IndexError:
-                                logger.debug("char_line already empty")
+        try:
+            serial_fd = self.serial.fileno()
+        except (AttributeError, ValueError):
+            # Not every serial_for_url() handler has a file descriptor, so
+            # fall back to polling those every SERIAL_TIMEOUT
+            logger.info("Serial device has no fileno(), polling it instead")
+            serial_fd = None
+        wake_fd = self._wake_r
+        flow = self._flow
+        batch = bytearray()
+        rx_data = bytearray()
+        line = None # Waiting for room in the buffer
+        line_job = None # The JobSource line came from, if any
+        line_future = None # The CommandFuture of line, if any
+        source = None
+        t_poll = 0.0
+        t_override = 0.0
+
+        try:
+            while self.thread:
+                # Realtime bytes, including the status poll if enough time
+                # has passed, go out first
+                t_curr = time.time()
+                if self.__arm_idle_waiters():
+                    t_poll = 0.0 # Ask for the status right away
+                if t_curr-t_poll >= SERIAL_POLL:
+                    batch += b"?"
+                    self._polls += 1
+                    t_poll = t_curr
+                while self.realtime:
+                    batch += self.realtime.popleft()
+                if self._override_targets and \
+                   t_curr-t_override >= OVERRIDE_INTERVAL:
+                    batch += self.__override_steps(t_curr)
+                    t_override = t_curr
+                if batch:
+                    self.serial.write(batch)
+                    if b"\x18" in batch:
+                        # Grbl throws away everything it had, and so do we
+                        reset = CommandCancelled("Soft reset")
+                        self.__cancel_sent(flow.clear(), reset)
+                        if line_future is not None:
+                            line_future.set_exception(reset)
+                        line = line_job = line_future = None
+                        self.__fail_idle_waiters(reset)
+                        self.__job_done(self._job, reset=True)
+                        self._hold_until = t_curr + RESET_TIMEOUT
+                    del batch[:]
+                # Pack as many lines as Grbl has room for into a single
+                # write: queued commands first, then the job
+                job = self._job
+                if line_job is not None and line_job is not job:
+                    line = line_job = None # The job was stopped
+                # Realtime bytes queued meanwhile, like a reset, have to go
+                # out before any more lines
+                while t_curr >= self._hold_until and not self.realtime:
+                    if line is None:
+                        try:
+                            command, line_future = self.queue.get_nowait()
+                        except Empty:
+                            entry = job.next_line() if job else None
+                            if entry is None:
+                                break
+                            line, source = entry
+                            line_job = job
                         else:
-                            self.__process_messages(out_temp)
-                self.serial.write(line_block + "\n")
-            else:
-                out_temp = self.serial.readline().strip()
-                if len(out_temp) > 0:
+                            if command is None:
+                                # From wait_idle(), nothing to send
+                                self._idle_waiters.append(
+                                    [flow.pushed, None, line_future])
+                                line_future = None
+                                continue
+                            line, source = to_wire(command), None
+                    # Track number of characters in the Grbl buffer
+                    if not flow.fits(len(line)):
+                        break
+                    flow.push(line, t_curr, source, line_future)
+                    batch += line
+                    line = line_job = line_future = None
+                if batch:
+                    self.serial.write(batch)
+                    del batch[:]
+                if job is not None:
+                    self.progress = job.progress()
+                    if job.exhausted and len(flow) == 0:
+                        self.__job_done(job)
+                # Wait for Grbl, new work, the next status poll, or the end
+                # of a reset
+                t_next = t_poll+SERIAL_POLL
+                if self._hold_until > t_curr:
+                    t_next = min(t_next, self._hold_until)
+                if self._override_targets:
+                    t_next = min(t_next, t_override+OVERRIDE_INTERVAL)
+                timeout = max(0.0, t_next-time.time())
+                wait_fds = [wake_fd]
+                if serial_fd is None:
+                    timeout = min(timeout, SERIAL_TIMEOUT)
+                else:
+                    wait_fds.append(serial_fd)
+                try:
+                    ready = select.select(wait_fds, [], [], timeout)[0]
+                except select.error:
+                    continue # Interrupted by a signal
+                if wake_fd in ready:
+                    try:
+                        os.read(wake_fd, 4096)
+                    except OSError:
+                        pass
+                waiting = self.serial.in_waiting
+                if serial_fd in ready or waiting > 0:
+                    # read() raises SerialException if the device is gone
+                    rx_data += self.serial.read(max(waiting, 1))
+                t_curr = time.time()
+                while True:
+                    newline = rx_data.find(b"\n")
+                    if newline < 0:
+                        break
+                    out_temp = bytes(rx_data[:newline])
+                    del rx_data[:newline+1]
+                    out_temp = out_temp.decode("ascii", "replace").strip()
+                    if len(out_temp) == 0:
+                        continue
                     if out_temp.find("ok") >= 0:
-                        gcode_count += 1
-                        try:
-                            logger.debug("Removing most recent command")
-                            char_line.popleft()
-                            sent_line.popleft
-                        except IndexError:
-                            logger.debug("char_line already empty")
+                        self.__acknowledge(flow.pop(), t_curr)
+                    elif out_temp.lower().startswith("error:"):
+                        # An error takes the place of the line's ok
+                        self.__acknowledge(flow.pop(), t_curr, out_temp)
+                        self.__process_messages(out_temp)
                     else:
                         self.__process_messages(out_temp)
-                if done and (line_count == gcode_count or not self.running):
-                    self.max_size = 0.0
-                    self.progress = 0.0
-                    done = False
-                    line_count = 0
+        except serial.SerialException:
+            logger.exception("Serial I/O failed")
+        # Nothing still waiting will ever get an answer
+        closed = CommandCancelled("Serial closed")
+        self.__cancel_sent(flow.clear(), closed)
+        if line_future is not None:
+            line_future.set_exception(closed)
+        self.__fail_idle_waiters(closed)
+        self._empty_queue()
         logger.info("Closing down serial_io")
 
 
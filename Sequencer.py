@@ -0,0 +1,164 @@
+#!/usr/bin/env python2
+# coding=UTF-8
+"""Multi-step sequences that never block the thread running them
+
+Tk runs everything on one thread, so a handler that sleeps between two
+commands freezes the window and holds up realtime actions like pause. A
+Sequence instead runs its steps from Tk's after(), moving on as soon as
+whatever it is waiting for has happened:
+
+    Sequence(root.after, [
+        self._soft_reset,
+        WaitFor(lambda: self.log == "Idle", timeout=2),
+        lambda: self.send("G0X0Y0"),  # Waits for Grbl's answer
+        Delay(0.25),
+        self._home,
+    ]).start()
+
+A step is a Delay, a WaitFor, or a callable. A callable that returns a
+CommandFuture is waited on, and one that returns a Delay or WaitFor has it
+run next."""
+
+__author__ = "Dylan Armitage"
+__email__ = "d.armitage89@gmail.com"
+
+####---- Imports ----####
+from collections import deque
+
+import time
+import logging
+
+from Sender import CommandFuture
+
+logger = logging.getLogger(__name__) #pylint: disable=invalid-name
+
+####---- Variables ----####
+POLL_MS = 10 # How often to check what a step is waiting for
+
+
+####---- Classes ----####
+class StepTimeout(Exception):
+    """A WaitFor gave up"""
+
+
+class SequenceCancelled(Exception):
+    """Sequence.cancel() was called before the last step"""
+
+
+class Delay(object):
+    """Step: carry on after seconds"""
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+
+class WaitFor(object):
+    """Step: carry on once condition is true
+
+    condition is a callable, or a CommandFuture that has to resolve without
+    an error. After timeout seconds the sequence fails with StepTimeout,
+    unless optional, in which case it carries on anyway."""
+    def __init__(self, condition, timeout=None, optional=False):
+        self.condition = condition
+        self.timeout = timeout
+        self.optional = optional
+
+    def ready(self):
+        """Return whether the condition is met, raise if it never will be"""
+        if isinstance(self.condition, CommandFuture):
+            if not self.condition.done():
+                return False
+            if self.condition.exception() is not None:
+                raise self.condition.exception()
+            return True
+        return bool(self.condition())
+
+
+class Sequence(object):
+    """Steps run one after the other through after(ms, callback)
+
+    after is usually the after() of a Tk widget, so every step runs on the
+    Tk thread. on_done(sequence) is called at the end, when error is None
+    unless a step raised, a WaitFor timed out, or cancel() was called."""
+    def __init__(self, after, steps, name="sequence", on_done=None):
+        self.after = after
+        self.steps = deque(steps)
+        self.name = name
+        self.on_done = on_done
+        self.done = False
+        self.error = None
+        self._waiting = None # (WaitFor, give up time)
+
+    def start(self):
+        """Run the first step soon, return self"""
+        logger.debug("Starting %s", self.name)
+        self.after(0, self._step)
+        return self
+
+    def cancel(self):
+        """Stop before the next step"""
+        self._finish(SequenceCancelled(self.name))
+
+    def _wait(self, wait_for):
+        """Start waiting for a WaitFor"""
+        give_up = None
+        if wait_for.timeout is not None:
+            give_up = time.time() + wait_for.timeout
+        self._waiting = (wait_for, give_up)
+
+    def _step(self):
+        """Run steps until one has to wait"""
+        if self.done:
+            return
+        if self._waiting is not None:
+            wait_for, give_up = self._waiting
+            try:
+                ready = wait_for.ready()
+            except Exception as ex: # pylint: disable=broad-except
+                if not wait_for.optional:
+                    self._finish(ex)
+                    return
+                logger.warning("%s carried on after %r", self.name, ex)
+                ready = True
+            if not ready:
+                if give_up is None or time.time() < give_up:
+                    self.after(POLL_MS, self._step)
+                    return
+                if not wait_for.optional:
+                    self._finish(StepTimeout(self.name))
+                    return
+                logger.warning("%s carried on after a timeout", self.name)
+            self._waiting = None
+        while self.steps:
+            step = self.steps.popleft()
+            if callable(step) and not isinstance(step, (Delay, WaitFor)):
+                try:
+                    step = step()
+                except Exception as ex: # pylint: disable=broad-except
+                    logger.exception("Step of %s failed", self.name)
+                    self._finish(ex)
+                    return
+                if isinstance(step, CommandFuture):
+                    step = WaitFor(step)
+            if isinstance(step, Delay):
+                self.after(int(step.seconds*1000), self._step)
+                return
+            if isinstance(step, WaitFor):
+                self._wait(step)
+                self.after(0, self._step)
+                return
+        self._finish(None)
+
+    def _finish(self, error):
+        """End the sequence"""
+        if self.done:
+            return
+        self.done = True
+        self.error = error
+        self.steps.clear()
+        self._waiting = None
+        if error is not None:
+            logger.error("%s failed: %r", self.name, error)
+        else:
+            logger.debug("%s done", self.name)
+        if self.on_done is not None:
+            self.on_done(self)
@@ -0,0 +1,633 @@
+#!/usr/bin/env python2
+# coding=UTF-8
+"""Serial broker: keeps GRBL's serial port open between GUI runs
+
+Opening the serial port toggles DTR, which resets the Arduino and loses the
+machine position. The broker opens the port once and owns it, along with
+the Sender streaming to it, and serves that Sender on a Unix socket:
+
+    python SerialBroker.py /dev/ttyAMA0
+
+lasercontrol2 then talks to it through RemoteSender, so restarting the GUI
+is instant, and a job keeps running if the GUI goes away.
+
+The socket is in BROKER_DIR, which only the broker's user can write to,
+and RemoteSender only talks to a broker run by its own user or root.
+
+The protocol is one JSON object per line. Clients send
+{"id": 1, "method": "send", "args": ["G0X10"]}. The broker answers with
+{"id": 1, "result": "ok"} or {"id": 1, "error": [name, message, code]}
+once Grbl has, and pushes {"status": {...}, "errors": [...]} to every client
+each SERIAL_POLL."""
+
+__author__ = "Dylan Armitage"
+__email__ = "d.armitage89@gmail.com"
+
+####---- Imports ----####
+from threading import Thread, Lock
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+import os
+import json
+import time
+import errno
+import fcntl
+import select
+import signal
+import socket
+import struct
+import logging
+import argparse
+import itertools
+import functools
+
+from ControllerManager import JobCache
+from GcodeParser import parse_pool
+from MachineState import MachineState
+from ParseCache import ParseCache
+from Sender import Sender, CommandFuture, GrblError, CommandCancelled, \
+                   override_target, SERIAL_POLL
+
+logger = logging.getLogger(__name__) #pylint: disable=invalid-name
+
+####---- Variables ----####
+BROKER_DIR = "/run/lasercontrol" # Where the sockets go, only we can write it
+# Linux's, which Python 2 doesn't have
+SO_PEERCRED = getattr(socket, "SO_PEERCRED", 17)
+PEERCRED = struct.Struct("3i") # pid, uid, gid
+# Sender attributes pushed to the clients
+STATUS_FIELDS = ("log",
+                 "pos",
+                 "progress",
+                 "max_size",
+                 "running",
+                 "_paused",
+                 "buffer_state",
+                 "planner_size",
+                 "overrides",
+                 "starved",
+                 "starved_time",
+                )
+
+
+def broker_path(device):
+    """Return the path of the socket of the broker for device"""
+    return os.path.join(BROKER_DIR, "lasercontrol-{}.sock".format(
+        os.path.basename(device)))
+
+def _private_dir(directory):
+    """Make directory if need be, and make sure nobody else can put a
+    socket in it or replace ours"""
+    try:
+        os.makedirs(directory, 0o700)
+    except OSError as ex:
+        if ex.errno != errno.EEXIST:
+            raise
+    stat = os.lstat(directory)
+    if not os.path.isdir(directory) or os.path.islink(directory) or \
+       stat.st_uid != os.geteuid() or stat.st_mode & 0o022:
+        raise OSError(errno.EPERM, "Not a private directory", directory)
+
+def _trusted(sock):
+    """Whether the process at the other end of sock is us, or root"""
+    uid = PEERCRED.unpack(sock.getsockopt(socket.SOL_SOCKET, SO_PEERCRED,
+                                          PEERCRED.size))[1]
+    return uid in (os.geteuid(), 0)
+
+def _nonblocking_pipe():
+    """Return a pipe whose ends never block"""
+    fds = os.pipe()
+    for pipe_fd in fds:
+        flags = fcntl.fcntl(pipe_fd, fcntl.F_GETFL)
+        fcntl.fcntl(pipe_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+    return fds
+
+def _error_reply(exception):
+    """Return the error field of a reply for exception"""
+    return [type(exception).__name__, str(exception),
+            getattr(exception, "code", None), getattr(exception, "alarm", False)]
+
+def _reply_error(error):
+    """Return the exception for the error field of a reply"""
+    name, message, code, alarm = error
+    if name == "GrblError":
+        return GrblError(code, alarm=alarm)
+    if name == "CommandCancelled":
+        return CommandCancelled(message)
+    return RuntimeError(message)
+
+
+####---- Classes ----####
+class Broker(object):
+    """Owns the serial port of device and serves its Sender on a socket"""
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, device, path=None, parse_pool=None):
+        self.device = device
+        self.path = path or broker_path(device)
+        self.sender = Sender()
+        self.jobs = JobCache(parse_cache=ParseCache(), parse_pool=parse_pool)
+        self._listener = None
+        self._clients = {} # socket : [received bytearray, to send bytearray]
+        self._replies = Queue() # (client, reply) from future callbacks
+        self._starting = None # GcodeLoader of a job to start once streamable
+        self._wake_r = self._wake_w = None
+        self._running = False
+
+    def serve_forever(self):
+        """Open the serial port and serve clients until stop()"""
+        _private_dir(os.path.dirname(self.path))
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+            except socket.error as ex:
+                if ex.args[0] != errno.ECONNREFUSED:
+                    raise
+                os.unlink(self.path) # Left over from a broker that died
+            else:
+                raise RuntimeError("A broker is already serving {}".format(
+                    self.path))
+            finally:
+                probe.close()
+        self._wake_r, self._wake_w = _nonblocking_pipe()
+        self.sender._open_serial(self.device) # pylint: disable=protected-access
+        self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._listener.bind(self.path)
+        self._listener.listen(5)
+        self._listener.setblocking(False)
+        logger.info("Serving %s on %s", self.device, self.path)
+        self._running = True
+        t_status = 0.0
+        try:
+            while self._running:
+                readers = [self._listener, self._wake_r] + list(self._clients)
+                writers = [client for client, (_, out_data)
+                           in self._clients.items() if out_data]
+                timeout = max(0.0, t_status+SERIAL_POLL-time.time())
+                try:
+                    readable, writable = select.select(readers, writers, [],
+                                                       timeout)[:2]
+                except select.error:
+                    continue # Interrupted by a signal
+                for ready in readable:
+                    if ready is self._listener:
+                        self._accept()
+                    elif ready == self._wake_r:
+                        try:
+                            os.read(self._wake_r, 4096)
+                        except OSError:
+                            pass
+                    else:
+                        self._receive(ready)
+                self._queue_replies()
+                self._start_loaded()
+                for client in writable:
+                    self._transmit(client)
+                if time.time()-t_status >= SERIAL_POLL:
+                    t_status = time.time()
+                    self._push_status()
+        finally:
+            self.close()
+
+    def stop(self):
+        """Make serve_forever() return"""
+        self._running = False
+        self._wakeup()
+
+    def close(self):
+        """Drop every client and close the socket and serial port"""
+        for client in list(self._clients):
+            self._drop(client)
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+        self.sender._close_serial() # pylint: disable=protected-access
+        for pipe_fd in (self._wake_r, self._wake_w):
+            if pipe_fd is not None:
+                os.close(pipe_fd)
+        self._wake_r = self._wake_w = None
+        logger.info("Broker closed")
+
+    def _wakeup(self):
+        """Wake serve_forever() up"""
+        if self._wake_w is None:
+            return
+        try:
+            os.write(self._wake_w, b"\0")
+        except OSError:
+            pass
+
+    ####---- Clients ----####
+    def _accept(self):
+        """Take a new client"""
+        try:
+            client = self._listener.accept()[0]
+        except socket.error:
+            return
+        client.setblocking(False)
+        self._clients[client] = [bytearray(), bytearray()]
+        logger.info("Client connected (%d now)", len(self._clients))
+        self._push_status(client)
+
+    def _drop(self, client):
+        """Forget a client, whatever it had in flight"""
+        self._clients.pop(client, None)
+        client.close()
+        logger.info("Client disconnected (%d left)", len(self._clients))
+
+    def _receive(self, client):
+        """Read from a client and act on every complete request"""
+        try:
+            data = client.recv(65536)
+        except socket.error as ex:
+            if ex.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = b""
+        if not data:
+            self._drop(client)
+            return
+        in_data = self._clients[client][0]
+        in_data += data
+        while True:
+            newline = in_data.find(b"\n")
+            if newline < 0:
+                break
+            line = bytes(in_data[:newline])
+            del in_data[:newline+1]
+            try:
+                request = json.loads(line.decode("utf-8"))
+            except ValueError:
+                logger.error("Bad request: %r", line)
+                continue
+            self._handle(client, request)
+
+    def _transmit(self, client):
+        """Send a client as much as it takes of what is waiting for it"""
+        if client not in self._clients:
+            return # Dropped since select() said it could take more
+        out_data = self._clients[client][1]
+        try:
+            sent = client.send(bytes(out_data))
+        except socket.error as ex:
+            if ex.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            self._drop(client)
+            return
+        del out_data[:sent]
+
+    def _reply(self, client, message):
+        """Queue message for client"""
+        if client in self._clients:
+            self._clients[client][1] += json.dumps(message).encode("utf-8") \
+                                        + b"\n"
+
+    def _queue_replies(self):
+        """Move the answers from future callbacks to their clients"""
+        while True:
+            try:
+                client, message = self._replies.get_nowait()
+            except Empty:
+                return
+            self._reply(client, message)
+
+    def _status(self):
+        """Return the status of the Sender as a dict"""
+        status = dict((field, getattr(self.sender, field))
+                      for field in STATUS_FIELDS)
+        status["ready"] = self.sender.wait_ready(0)
+        status["state"] = self.sender.state.as_dict()
+        return status
+
+    def _push_status(self, client=None):
+        """Send the status, and any errors, to client or every client"""
+        if not self._clients:
+            return # Errors stay queued until somebody can see them
+        errors = []
+        while True:
+            try:
+                errors.append(self.sender.error.get_nowait())
+            except Empty:
+                break
+        message = dict(status=self._status(), errors=errors)
+        for each in [client] if client is not None else list(self._clients):
+            self._reply(each, message)
+
+    def _start_loaded(self):
+        """Start streaming the job start_file asked for, once it can be"""
+        loader = self._starting
+        if loader is None or not loader.wire_ready.is_set():
+            return
+        self._starting = None
+        try:
+            gcodefile = loader.streamable()
+        except Exception as ex: # pylint: disable=broad-except
+            self.sender.running = False
+            self.sender.error.put(("Load", os.path.basename(loader.path),
+                                   str(ex)))
+            return
+        self.sender._start_file(gcodefile) # pylint: disable=protected-access
+
+    ####---- Requests ----####
+    def _handle(self, client, request):
+        """Call what request asks for, and answer it"""
+        request_id = request.get("id")
+        method = getattr(self, "_rpc_" + str(request.get("method")), None)
+        try:
+            if method is None:
+                raise ValueError("No method {}".format(request.get("method")))
+            result = method(*request.get("args", []))
+        except Exception as ex: # pylint: disable=broad-except
+            logger.exception("Request %s failed", request)
+            self._reply(client, dict(id=request_id, error=_error_reply(ex)))
+            return
+        if isinstance(result, CommandFuture):
+            # Answer from the I/O thread once Grbl has
+            def answered(future):
+                """Pass the answer on to serve_forever()"""
+                if future.exception() is not None:
+                    reply = dict(id=request_id,
+                                 error=_error_reply(future.exception()))
+                else:
+                    reply = dict(id=request_id, result=future.result())
+                self._replies.put((client, reply))
+                self._wakeup()
+            result.add_done_callback(answered)
+        elif request_id is not None:
+            self._reply(client, dict(id=request_id, result=result))
+
+    # pylint: disable=protected-access,missing-docstring
+    def _rpc_send(self, command):
+        return self.sender.send(command)
+
+    def _rpc_wait_idle(self):
+        return self.sender.wait_idle()
+
+    def _rpc_realtime(self, command):
+        self.sender._send_realtime(command.encode("latin-1"))
+
+    def _rpc_override(self, override, action):
+        self.sender.override(override, action)
+
+    def _rpc_set_override(self, override, percent):
+        return self.sender.set_override(override, percent)
+
+    def _rpc_start_file(self, path):
+        # Loading can take a while, and this loop serves everybody, so
+        # serve_forever() starts it once the first chunk is in
+        self._starting = self.jobs.load(path)
+        self.sender.running = True
+        self._start_loaded()
+        return self.sender.max_size
+
+    def _rpc_start_job(self, lines):
+        self._starting = None
+        self.sender.running = True
+        self.sender._start_job(lines)
+        return self.sender.max_size
+
+    def _rpc_stop_run(self):
+        self._starting = None
+        self.sender._stop_run()
+
+    def _rpc_pause(self):
+        self.sender._pause()
+
+    def _rpc_resume(self):
+        self.sender._resume()
+
+    def _rpc_status(self):
+        return self._status()
+
+
+def _brokered(method):
+    """Make method of RemoteSender go to the Sender one of the same name
+    while it isn't connected to a broker"""
+    direct = getattr(Sender, method.__name__)
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        """Through the broker, or straight to the port"""
+        if self.remote:
+            return method(self, *args, **kwargs)
+        return direct(self, *args, **kwargs)
+    return wrapper
+
+
+class RemoteSender(Sender):
+    """Sender whose serial port is owned by a Broker, if there is one
+
+    _open_serial() connects to the broker of the device instead of opening
+    it, so Grbl isn't reset, and commands, jobs and realtime bytes go to the
+    broker's Sender. Its status is mirrored in the usual attributes. If no
+    broker answers for the device, it opens the port itself, as a Sender."""
+    def __init__(self):
+        Sender.__init__(self)
+        self.remote = False # Whether connected to a broker
+        self._socket = None
+        self._send_lock = Lock()
+        self._pending = {} # request id : CommandFuture
+        self._ids = itertools.count(1)
+
+    def _open_serial(self, device):
+        """Connect to the broker of device, or open it if there is none"""
+        logger.info("Connecting to the broker of %s", device)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(broker_path(device))
+        except socket.error as ex:
+            sock.close()
+            if ex.errno not in (errno.ENOENT, errno.ECONNREFUSED):
+                raise
+            # No broker, or a dead one that left its socket behind
+            logger.info("No broker for %s, opening it directly", device)
+            self.remote = False
+            self.stop_on_close = Sender.stop_on_close
+            return Sender._open_serial(self, device)
+        if not _trusted(sock):
+            sock.close()
+            raise socket.error(errno.EACCES, "The broker of {} isn't run by "
+                               "this user or root".format(device))
+        self.remote = True
+        self.stop_on_close = False # The broker carries on with the job
+        self._socket = self.serial = sock
+        self._grbl_ready.clear()
+        self.thread = Thread(target=self._remote_io, name="BrokerIOThread")
+        self.thread.start()
+        logger.info("I/O thread started: %s", self.thread.name)
+        return True
+
+    @_brokered
+    def _close_serial(self, stop=True):
+        """Disconnect from the broker, which carries on without us"""
+        logger.info("Disconnecting from the broker")
+        if self._socket is None:
+            return
+        sock, self._socket = self._socket, None
+        self.serial = None
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        sock.close()
+        self.thread.join()
+        self.thread = None
+        return True
+
+    def _call(self, method, *args):
+        """Ask the broker to call method, return a CommandFuture for it"""
+        future = CommandFuture(args[0] if args else method)
+        sock = self._socket
+        if sock is None:
+            future.set_exception(CommandCancelled(future.command))
+            return future
+        request_id = next(self._ids)
+        self._pending[request_id] = future
+        request = json.dumps(dict(id=request_id, method=method,
+                                  args=list(args)))
+        try:
+            with self._send_lock:
+                sock.sendall(request.encode("utf-8") + b"\n")
+        except socket.error as ex:
+            self._pending.pop(request_id, None)
+            future.set_exception(CommandCancelled(str(ex)))
+        return future
+
+    def _remote_io(self):
+        """Read answers and status from the broker"""
+        in_data = bytearray()
+        sock = self._socket
+        while self._socket is sock:
+            try:
+                data = sock.recv(65536)
+            except socket.error:
+                break
+            if not data:
+                break
+            in_data += data
+            while True:
+                newline = in_data.find(b"\n")
+                if newline < 0:
+                    break
+                message = json.loads(bytes(in_data[:newline]).decode("utf-8"))
+                del in_data[:newline+1]
+                self._from_broker(message)
+        logger.info("Broker connection closed")
+        self._socket = self.serial = None
+        pending, self._pending = self._pending, {}
+        for future in pending.values():
+            future.set_exception(CommandCancelled("Broker disconnected"))
+
+    def _from_broker(self, message):
+        """Act on a message from the broker"""
+        if "status" in message:
+            status = message["status"]
+            if status.get("overrides") != self.overrides:
+                self.changes.put("overrides", status.get("overrides"))
+            for field in STATUS_FIELDS:
+                value = status.get(field)
+                setattr(self, field,
+                        tuple(value) if isinstance(value, list) else value)
+            if status.get("state"):
+                self.__mirror_state(MachineState.from_dict(status["state"]))
+            if status.get("ready"):
+                self._grbl_ready.set()
+            for error in message.get("errors", []):
+                self.error.put(tuple(error))
+            return
+        future = self._pending.pop(message.get("id"), None)
+        if future is None:
+            return
+        if "error" in message:
+            future.set_exception(_reply_error(message["error"]))
+        else:
+            future.set_result(message.get("result"))
+
+    def __mirror_state(self, state):
+        """Publish the broker's latest MachineState as ours"""
+        if state.seq == self.state.seq:
+            return # No report since the last push
+        previous, self.state = self.state, state
+        self.changes.put("state", state)
+        if state.mpos is not None and state.mpos != previous.mpos:
+            self.history.append(state.time, state.mpos)
+
+    ####---- Sender, through the broker ----####
+    @_brokered
+    def send(self, command):
+        return self._call("send", command)
+
+    @_brokered
+    def wait_idle(self):
+        return self._call("wait_idle")
+
+    @_brokered
+    def _send_realtime(self, command):
+        self._call("realtime", command.decode("latin-1"))
+
+    @_brokered
+    def override(self, override, action):
+        self._call("override", override, action)
+
+    @_brokered
+    def set_override(self, override, percent):
+        self._call("set_override", override, percent)
+        return override_target(override, percent)
+
+    @_brokered
+    def _init_run(self):
+        self.running = True
+
+    @_brokered
+    def _start_file(self, gcodefile):
+        return self._call("start_file", os.path.abspath(gcodefile.file))
+
+    @_brokered
+    def _start_job(self, lines):
+        text = []
+        for line in lines:
+            if isinstance(line, memoryview):
+                line = line.tobytes().decode("ascii")
+            text.append(line)
+        return self._call("start_job", text)
+
+    @_brokered
+    def _stop_run(self):
+        self.progress = 0.0
+        self.max_size = 0.0
+        return self._call("stop_run")
+
+    @_brokered
+    def _pause(self):
+        return self._call("pause")
+
+    @_brokered
+    def _resume(self):
+        return self._call("resume")
+
+
+####---- MAIN ----####
+def main():
+    """Run a broker until interrupted"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("device", help="serial port or pyserial URL")
+    parser.add_argument("--socket", default=None,
+                        help="Unix socket to serve on")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    pool = parse_pool() # Before the Sender's threads, see parse_pool()
+    broker = Broker(args.device, args.socket, parse_pool=pool)
+    for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+        signal.signal(signum, lambda *_: broker.stop())
+    try:
+        broker.serve_forever()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+if __name__ == "__main__":
+    main()
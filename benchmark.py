@@ -0,0 +1,265 @@
+#!/usr/bin/env python2
+# coding=UTF-8
+"""Streaming and parsing benchmarks
+
+Generates synthetic jobs, times how long GcodeFile takes to load them and
+how fast Sender streams them to a GrblSim, and writes the results as JSON so
+runs from different versions can be compared:
+
+    python benchmark.py --sizes 1000 100000 --out before.json
+"""
+from __future__ import print_function, division
+
+__author__ = "Dylan Armitage"
+__email__ = "d.armitage89@gmail.com"
+__license__ = "MIT"
+
+####---- Imports ----####
+import os
+import sys
+import math
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import subprocess
+
+try:
+    import tracemalloc
+except ImportError: # Python 2
+    tracemalloc = None
+import resource
+
+from GcodeParser import GcodeFile
+from GrblSim import GrblSim
+from Sender import Sender
+
+logger = logging.getLogger(__name__) #pylint: disable=invalid-name
+
+####---- Variables ----####
+SIZES = (1000, 10000, 100000, 1000000, 10000000)
+STREAM_MAX = 10000 # Only stream jobs up to this many lines
+STREAM_TIMEOUT = 600 # seconds
+JOG_EVERY = 1.0 # seconds between jogs while streaming
+SIM_SPEED = 200.0 # Run the simulated motion this much faster than real time
+
+
+####---- Job generators ----####
+def spiral_gcode(lines):
+    """Spiral of very short segments, like serial_stress_test.gcode"""
+    yield "G21"
+    yield "G90"
+    yield "M4 S1000"
+    yield "G1 F10000"
+    for step in range(lines-5):
+        angle = step * 0.05
+        radius = 1 + 0.0005 * step
+        yield "G1 X{:.4f} Y{:.4f}".format(150 + radius*math.cos(angle) % 140,
+                                          100 + radius*math.sin(angle) % 90)
+    yield "M5 S0"
+
+
+def raster_gcode(lines):
+    """Back and forth scanlines changing power every 0.1mm"""
+    yield "G21"
+    yield "G90"
+    yield "M4 S0"
+    yield "G1 F6000"
+    row = 0
+    count = 4
+    while count < lines-1:
+        y_pos = 10 + (row * 0.1) % 180
+        yield "G0 X10 Y{:.2f}".format(y_pos)
+        count += 1
+        for pixel in range(min(1000, lines-1-count)):
+            x_pos = 10 + pixel*0.1 if row % 2 == 0 else 110 - pixel*0.1
+            power = int(500 * (1 + math.sin(pixel*0.2 + row)) / 2)
+            yield "G1 X{:.1f} S{}".format(x_pos, power)
+            count += 1
+        row += 1
+    yield "M5 S0"
+
+
+def vector_gcode(lines):
+    """Long straight cuts between rapid moves"""
+    yield "G21"
+    yield "G90"
+    yield "G1 F1200"
+    count = 3
+    shape = 0
+    while count < lines-1:
+        x_pos, y_pos = 20 + (shape * 7) % 200, 20 + (shape * 3) % 120
+        yield "G0 X{} Y{}".format(x_pos, y_pos)
+        yield "M3 S800"
+        for corner in ((50, 0), (50, 50), (0, 50), (0, 0)):
+            yield "G1 X{} Y{}".format(x_pos+corner[0], y_pos+corner[1])
+        yield "M5"
+        count += 7
+        shape += 1
+    yield "M5 S0"
+
+GENERATORS = dict(spiral=spiral_gcode,
+                  raster=raster_gcode,
+                  vector=vector_gcode,
+                 )
+
+
+def write_job(path, generator, lines):
+    """Write lines of generator to path, return its size in bytes"""
+    with open(path, "w") as out_file:
+        chunk = []
+        for line in generator(lines):
+            chunk.append(line)
+            if len(chunk) >= 10000:
+                out_file.write("\n".join(chunk) + "\n")
+                chunk = []
+        out_file.write("\n".join(chunk) + "\n")
+    return os.path.getsize(path)
+
+
+####---- Measurements ----####
+def measure_parse(path):
+    """Time loading path the way the GUI does, return a result dict"""
+    if tracemalloc is not None:
+        tracemalloc.start()
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    t_start = time.time()
+    gcodefile = GcodeFile(path, lazy=True)
+    wire = gcodefile.wire_buffer()
+    t_wire = time.time()
+    gcodefile.bounding_box_coords()
+    t_done = time.time()
+    if tracemalloc is not None:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    else:
+        # Only grows, so it underestimates everything after the biggest job
+        peak = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss -
+                rss_before) * 1024
+    result = dict(seconds=t_done-t_start,
+                  wire_seconds=t_wire-t_start,
+                  peak_bytes=peak,
+                  lines=len(wire),
+                  wire_bytes=len(wire.data),
+                  lines_per_s=len(wire) / max(t_done-t_start, 1e-9),
+                 )
+    gcodefile.close()
+    return result
+
+
+def measure_stream(path, baudrate, speed, timeout=STREAM_TIMEOUT):
+    """Stream path to a GrblSim, return a result dict"""
+    gcodefile = GcodeFile(path, lazy=True)
+    wire = gcodefile.wire_buffer()
+    sim = GrblSim(baudrate=baudrate, speed=speed)
+    sim.start()
+    sender = Sender()
+    sender._open_serial(sim.port) # pylint: disable=protected-access
+    sender.wait_ready(5)
+    try:
+        sender._init_run() # pylint: disable=protected-access
+        sim.reset_stats()
+        jogs_sent = []
+        t_start = time.time()
+        sender._start_job(wire) # pylint: disable=protected-access
+        while sender.max_size > 0 and time.time()-t_start < timeout:
+            if not jogs_sent or time.time()-jogs_sent[-1] >= JOG_EVERY:
+                jogs_sent.append(time.time())
+                sender.jog(x=1, speed=1000)
+            time.sleep(0.01)
+        t_sent = time.time()
+        finished = sender.max_size == 0
+        jog_latency = [received-sent for sent, received
+                       in zip(jogs_sent, sim.jog_times)]
+        result = dict(finished=finished,
+                      seconds=t_sent-t_start,
+                      lines=sim.stats["lines"],
+                      bytes=sim.stats["bytes"],
+                      lines_per_s=sim.stats["lines"] / (t_sent-t_start),
+                      bytes_per_s=sim.stats["bytes"] / (t_sent-t_start),
+                      sim_starved_seconds=sim.stats["starved"] / speed,
+                      sender_starved=sender.starved,
+                      sender_starved_seconds=sender.starved_time,
+                      rx_overflows=sim.stats["overflows"],
+                      jogs_sent=len(jogs_sent),
+                      jog_latency=jog_latency,
+                      jog_latency_max=max(jog_latency or [None]),
+                     )
+    finally:
+        sender._close_serial() # pylint: disable=protected-access
+        sim.stop()
+        gcodefile.close()
+    return result
+
+
+def git_version():
+    """Return the current git revision, or None"""
+    try:
+        return subprocess.check_output(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+####---- MAIN ----####
+def main():
+    """Run the benchmarks asked for on the command line"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES,
+                        help="job sizes in lines")
+    parser.add_argument("--jobs", nargs="+", default=sorted(GENERATORS),
+                        choices=sorted(GENERATORS))
+    parser.add_argument("--stream-max", type=int, default=STREAM_MAX,
+                        help="largest job to stream, 0 to skip streaming")
+    parser.add_argument("--baud", type=int, default=115200,
+                        help="simulated link speed, 0 for unlimited")
+    parser.add_argument("--speed", type=float, default=SIM_SPEED,
+                        help="simulated motion speed-up over real time")
+    parser.add_argument("--workdir", default=None,
+                        help="where to write the jobs (default: temp dir)")
+    parser.add_argument("--out", default=None,
+                        help="JSON file for the results (default: stdout)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="k40bench")
+    report = dict(version=git_version(),
+                  python=platform.python_version(),
+                  machine=platform.machine(),
+                  date=time.strftime("%Y-%m-%dT%H:%M:%S"),
+                  baudrate=args.baud,
+                  sim_speed=args.speed,
+                  results=[],
+                 )
+    try:
+        for job in args.jobs:
+            for size in args.sizes:
+                path = os.path.join(workdir, "{}-{}.gcode".format(job, size))
+                file_bytes = write_job(path, GENERATORS[job], size)
+                print("{} {} lines ({} bytes)".format(job, size, file_bytes),
+                      file=sys.stderr)
+                result = dict(job=job, size=size, file_bytes=file_bytes,
+                              parse=measure_parse(path))
+                if size <= args.stream_max:
+                    result["stream"] = measure_stream(path, args.baud or None,
+                                                      args.speed)
+                report["results"].append(result)
+                if not args.workdir:
+                    os.remove(path)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.out:
+        with open(args.out, "w") as out_file:
+            out_file.write(output + "\n")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
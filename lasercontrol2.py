@@ -22,22 +22,32 @@ import logging
 import logging.config
 import coloredlogs
 
-from threading import enumerate as thread_enum, active_count
+from threading import Thread, enumerate as thread_enum, active_count
 import yaml
 
-from Sender import Sender
+from Sender import CLOSE_TIMEOUT
+from SerialBroker import RemoteSender
+from Sequencer import Sequence, Delay, WaitFor
 from NFCcontrol import initialize_nfc_reader, get_uid_noblock, verify_uid
 from NFCcontrol import get_user_uid, get_user_realname, is_current_user
 from GPIOcontrol import gpio_setup, disable_relay, relay_state
-from GPIOcontrol import switch_pin, toggle_pin
-from GcodeParser import GcodeFile
+from GPIOcontrol import switch_pin, TOGGLE_TIME
+from ControllerManager import ControllerManager, JobCache
+from GcodeParser import LoadCancelled, parse_pool
+from GrblCodes import LIMITS, ERROR_CODES
+from GcodeCheck import check_lines
+from ParseCache import ParseCache
+from GdirWatcher import GdirWatcher, watch_pool
+from JobPicker import JobPicker
 # Variable imports
 from GPIOcontrol import OUT_PINS
 
 try:
+    import Tkinter as tk
     import tkMessageBox as messagebox
     import tkFileDialog as filedialog
 except ImportError:
+    import tkinter as tk
     import tkinter.messagebox as messagebox
     import tkinter.filedialog as filedialog
 import pygubu
@@ -61,24 +71,42 @@ GCODE_EXT = (".gcode",
 
 # GRBL serial port
 GRBL_SERIAL = "/dev/ttyAMA0"
+# How often the window shows what changed
+UI_FPS = 10
+ERRORS_SHOWN = 50 # Most errors kept in the error panel
+LIMIT_LINES_LISTED = 10 # Off-limits lines named when asking to run
 
 
 ####---- Classes ----####
-class MainWindow(Sender):
+class MainWindow(RemoteSender):
     """Main window"""
     # pylint: disable=too-many-ancestors,too-many-instance-attributes,too-few-public-methods
-    def __init__(self):
-        ## Sender methods
-        Sender.__init__(self)
-        ## Main window
+    def __init__(self, device=GRBL_SERIAL, manager=None, fps=UI_FPS,
+                 watcher=None, master=None):
+        ## Sender methods, through the serial broker of device when one is
+        ## running, so Grbl isn't reset
+        RemoteSender.__init__(self)
+        ## Machines sharing this process, and their parsed files
+        self.device = device
+        self.manager = manager if manager is not None else new_manager()
+        self.watcher = watcher # GdirWatcher getting jobs ready, if any
+        self.manager.add(device, device, sender=self)
+        ## Main window, a Toplevel of master (the hidden root of main()), or
+        ## the root itself without one
         self.builder = builder = pygubu.Builder()
         builder.add_from_file(os.path.join(CURRENT_DIR, "MainWindow.ui"))
-        self.mainwindow = builder.get_object("mainwindow")
+        self.mainwindow = builder.get_object("mainwindow", master)
+        if len(self.manager.machines) > 1 or device != GRBL_SERIAL:
+            self.mainwindow.title("Laser Control ({})".format(device))
         self.mainwindow.protocol("WM_DELETE_WINDOW", self.__shutdown)
         builder.connect_callbacks(self)
         ## Variables & Buttons
         self.file = []
         self.gcodefile = None
+        self.loader = None # GcodeLoader of the file picked
+        self._streaming_loader = None # Loader a run started before it was done
+        self.frame_ms = int(1000 / fps)
+        self._shown = {} # What each variable was last set to
         self.var = {}
         variable_list = ["status",
                          "connect_b",
@@ -94,13 +122,16 @@ class MainWindow(Sender):
                          "wpos_y",
                          "wpos_z",
                          "percent_done",
+                         "ov_feed",
+                         "ov_power",
+                         "ov_rapid",
                         ]
         for var in variable_list:
             try:
                 self.var[var] = builder.get_variable(var)
             except BaseException:
                 logger.warning("Variable not defined: %s", var)
-        self.var["status"].set("Not Authorized")
+        self._show("status", "Not Authorized")
         self.var["connect_b"].set("Connect")
         self.buttons = {}
         button_list = ["button_conn",
@@ -132,6 +163,15 @@ class MainWindow(Sender):
                        "jog_dl",
                        "jog_dr",
                        "jog_cancel",
+                       "ov_feed_down",
+                       "ov_feed_reset",
+                       "ov_feed_up",
+                       "ov_power_down",
+                       "ov_power_reset",
+                       "ov_power_up",
+                       "ov_rapid_25",
+                       "ov_rapid_50",
+                       "ov_rapid_100",
                       ]
         for button in button_list:
             try:
@@ -142,6 +182,8 @@ class MainWindow(Sender):
         other_objects = ["spinbox_power_level",
                          "dist_box",
                          "speed_box",
+                         "listbox_errors",
+                         "button_cancel_load",
                         ]
         for obj in other_objects:
             try:
@@ -205,7 +247,7 @@ class MainWindow(Sender):
                 self._activate_buttons()
                 self._relay_states()
                 logger.info("user %s authorized", username)
-                self.var["status"].set("Authorized, not connected")
+                self._show("status", "Authorized, not connected")
                 messagebox.showinfo("Done",
                                     "Everything is setup, {}".format(realname))
             else:
@@ -251,9 +293,23 @@ class MainWindow(Sender):
         switch_pin(pin)
 
     def _hard_reset(self):
-        toggle_pin(OUT_PINS["grbl"])
+        """Pulse the reset pin of Grbl without blocking the window"""
+        pin = OUT_PINS["grbl"]
+        logger.info("Toggling pin %d", pin)
+        Sequence(self.mainwindow.after,
+                 [lambda: switch_pin(pin), Delay(TOGGLE_TIME),
+                  lambda: switch_pin(pin)],
+                 name="hard reset").start()
 
     def _select_filepath(self):
+        """Pick a job from GDIR, or any file if GDIR isn't watched"""
+        if self.watcher is None:
+            self._browse_filepath()
+            return
+        JobPicker(self.mainwindow, self.watcher, self._read_file,
+                  browse=self._browse_filepath)
+
+    def _browse_filepath(self):
         """Use tkfiledialog to select the appropriate file"""
         valid_files = [("GCODE", ("*.gc",
                                   "*.gcode",
@@ -271,14 +327,74 @@ class MainWindow(Sender):
         self._read_file(filepath)
 
     def _read_file(self, filepath):
-        """Take filepath, set filename StringVar"""
+        """Take filepath, set filename StringVar, and load it in the
+        background"""
+        if not filepath:
+            return # Dialog cancelled
         self.var["filename"].set(os.path.basename(filepath))
-        logger.debug("Reading %s into list", filepath)
-        self.gcodefile = GcodeFile(filepath)
-        self.file = self.gcodefile.gcode
+        logger.debug("Loading %s", filepath)
+        # Moves need the bounding box, so they wait for the whole file
+        self.gcodefile = None
+        self.file = []
+        try:
+            self.loader = self.manager.jobs.load(filepath)
+        except (IOError, OSError) as ex:
+            # Gone since it was picked, or never there
+            self.loader = None
+            self.objects["button_cancel_load"].state(["disabled"])
+            self._show("file_found", "Loading failed")
+            self._show_error("Load", os.path.basename(filepath), ex)
+            return
+        self.objects["button_cancel_load"].state(["!disabled"])
+        self._watch_load(self.loader)
+
+    def _watch_load(self, loader):
+        """Show how far loader has got, until it is done"""
+        if loader is not self.loader:
+            return # Another file was picked since
+        if not loader.done.is_set():
+            if loader.stage == "analyzing":
+                self._show("file_found", "Analyzing {} lines".format(
+                    loader.lines))
+            else:
+                self._show("file_found", "Loading {:.0f}% ({} lines)".format(
+                    loader.progress()*100, loader.lines))
+            self.mainwindow.after(self.frame_ms,
+                                  lambda: self._watch_load(loader))
+            return
+        self.objects["button_cancel_load"].state(["disabled"])
+        if isinstance(loader.error, LoadCancelled):
+            self._show("file_found", "Loading cancelled")
+        elif loader.error is not None:
+            self._show("file_found", "Loading failed")
+            self._show_error("Load", os.path.basename(loader.path),
+                             loader.error)
+        else:
+            seconds = int(loader.gcodefile.statistics()["seconds"])
+            self._show("file_found", "{} lines, about {}:{:02d}:{:02d}".format(
+                loader.lines, seconds // 3600, seconds // 60 % 60, seconds % 60))
+            self.gcodefile = loader.gcodefile
+            self.file = self.gcodefile.gcode
+            if self._streaming_loader is loader and self.running:
+                # Started before it could be checked, so check it now
+                problem = self._off_limits(self.gcodefile)
+                if problem is not None and messagebox.askyesno(
+                        "Off the bed", problem + "\n\nStop the job?",
+                        icon="warning"):
+                    self._stop_run()
+
+    def _cancel_load(self):
+        """Stop loading the file, and any run already streaming it"""
+        loader = self.loader
+        if loader is None or loader.done.is_set():
+            return
+        loader.cancel()
+        if self._streaming_loader is loader and self.running:
+            self._stop_run() # It would end where the loading stopped
 
-    def _open(self, device=GRBL_SERIAL):
+    def _open(self, device=None):
         """Open serial device"""
+        device = device or self.device
         try:
             status = self._open_serial(device)
             logger.info("Opened serial: %s", status)
@@ -293,27 +409,64 @@ class MainWindow(Sender):
         return False
 
     def _close(self):
-        """Close serial device"""
+        """Close serial device, once the run is stopped"""
         logger.info("Closing serial")
-        self._close_serial()
-        self.buttons["button_conn"].configure(command=lambda: self._open(GRBL_SERIAL))
-        self.var["status"].set("Not Connected")
+        self.var["connect_b"].set("Disconnecting")
+        def stop():
+            """Stop the run, and wait until Grbl is unlocked"""
+            if self.stop_on_close:
+                return WaitFor(self._stop_run(), CLOSE_TIMEOUT, optional=True)
+            return None
+        Sequence(self.mainwindow.after,
+                 [stop, lambda: self._close_serial(stop=False), self._closed],
+                 name="close").start()
+
+    def _closed(self):
+        """Show that the serial device is closed"""
+        self.buttons["button_conn"].configure(command=self._open)
+        self._show("status", "Not Connected")
         self.var["connect_b"].set("Connect")
 
+    def _show(self, name, value):
+        """Set the variable name to value, if that changes it"""
+        if self._shown.get(name) != value:
+            self._shown[name] = value
+            self.var[name].set(value)
+
+    def _show_error(self, response, code, message):
+        """Add an error to the error panel, newest first"""
+        errors = self.objects["listbox_errors"]
+        errors.insert(0, "{} {}: {}".format(response, code, message))
+        errors.delete(ERRORS_SHOWN, "end")
+        logger.debug("Showing error %s %s", response, code)
+
+    def _clear_errors(self):
+        """Empty the error panel"""
+        errors = self.objects["listbox_errors"]
+        errors.delete(0, "end")
+
     def _update_status(self):
-        msg = self.log
-        self.var["status"].set(msg)
-        if self.error.qsize() > 0:
-            response, code, message = self.error.get_nowait()
-            messagebox.showerror("{} {}".format(response, code),
-                                 message)
-        if isinstance(self.pos, tuple):
-            self.var["pos_x"].set(self.pos[0])
-            self.var["pos_y"].set(self.pos[1])
-            self.var["pos_z"].set(self.pos[2])
-        if self.max_size != 0:
-            self.var["percent_done"].set(self.progress*100.0)
-        self.mainwindow.after(250, self._update_status)
+        """Show whatever the I/O thread changed since the last frame"""
+        if self.device not in self.manager.machines:
+            return # Window closed
+        changes = self.changes.drain()
+        state = changes.get("state")
+        if state is not None:
+            self._show("status", state.status)
+            if state.mpos is not None:
+                for axis, mpos, wpos in zip("xyz", state.mpos, state.wpos):
+                    self._show("pos_" + axis, mpos)
+                    self._show("wpos_" + axis, wpos)
+            if self.max_size != 0 and state.progress is not None:
+                self._show("percent_done", round(state.progress*100.0, 1))
+        overrides = changes.get("overrides")
+        if overrides is not None:
+            self._show("ov_feed", overrides["feed"])
+            self._show("ov_power", overrides["spindle"])
+            self._show("ov_rapid", overrides["rapid"])
+        while self.error.qsize() > 0:
+            self._show_error(*self.error.get_nowait())
+        self.mainwindow.after(self.frame_ms, self._update_status)
 
     def _run(self):
         """Send gcode file to the laser"""
@@ -322,22 +475,96 @@ class MainWindow(Sender):
             messagebox.showerror("Serial Error", "GRBL is not connected")
             logger.error("Serial device not set!")
             return
+        gcodefile = self.gcodefile
+        self._streaming_loader = None
+        if gcodefile is None and self.loader is not None and \
+           self.loader.wire_ready.is_set() and self.loader.error is None:
+            gcodefile = self.loader.gcodefile # Still loading, but streamable
+            self._streaming_loader = self.loader
+        if gcodefile is None:
+            messagebox.showerror("File", "File must be loaded first")
+            return
+        if self._streaming_loader is not None:
+            self._show_error("Limits", os.path.basename(self.loader.path),
+                             "not checked, still loading")
+            if not messagebox.askokcancel(
+                    "Still loading",
+                    "The job can't be checked against the bed limits until "
+                    "it has loaded, which will be while it runs.\n\n"
+                    "Run anyway?", icon="warning"):
+                self._streaming_loader = None
+                return
+        elif not self._within_limits(gcodefile):
+            return
         self._init_run()
-        logger.info("Lines to send: %d", len(self.file))
-        self.max_size = float(len(self.file))
-        for line in self.file:
-            if line is not None and len(line) > 0:
-                logger.debug("Queued line: %s", line)
-                self.queue.put(line)
-        self.queue.put(("DONE",))
+        self._start_file(gcodefile)
+
+    def _off_limits(self, gcodefile):
+        """List the lines of the job that go off the bed, from where the
+        work coordinates are now, in the error panel; return a description
+        of them, or None if there aren't any"""
+        lines = gcodefile.off_limits(LIMITS, self.state.wco[:2])
+        if not lines:
+            return None
+        for line in reversed(lines[:ERRORS_SHOWN]):
+            self._show_error("Limits", "line {}".format(line),
+                             "goes off the bed")
+        shown = ", ".join(str(line) for line in lines[:LIMIT_LINES_LISTED])
+        if len(lines) > LIMIT_LINES_LISTED:
+            shown += "..."
+        return "{} lines go outside X {}-{}, Y {}-{} (lines {}).".format(
+            len(lines), LIMITS["X"][0], LIMITS["X"][1],
+            LIMITS["Y"][0], LIMITS["Y"][1], shown)
+
+    def _within_limits(self, gcodefile):
+        """Check the job stays on the bed, return whether to run it"""
+        problem = self._off_limits(gcodefile)
+        return problem is None or messagebox.askokcancel(
+            "Off the bed", problem + "\n\nRun anyway?", icon="warning")
+
+    def _toggle_checkmode(self):
+        """Check the loaded job the way Grbl's check mode ($C) would, but
+        locally, rather than streaming it all to Grbl"""
+        button = self.buttons["check_checkmode"]
+        button.state(["!selected"])
+        if self.gcodefile is None:
+            messagebox.showerror("File", "File must be loaded first")
+            return
+        wire = self.gcodefile.wire_buffer()
+        errors = []
+        thread = Thread(target=lambda: errors.extend(
+            check_lines(wire, wire.sources)), name="GcodeCheck")
+        thread.daemon = True
+        thread.start()
+        button.state(["disabled"])
+        self._watch_check(thread, errors, len(wire))
+
+    def _watch_check(self, thread, errors, lines):
+        """Show the errors a check found, once it is done"""
+        if thread.is_alive():
+            self.mainwindow.after(self.frame_ms, lambda: self._watch_check(
+                thread, errors, lines))
+            return
+        self.buttons["check_checkmode"].state(["!disabled"])
+        for line, code in reversed(errors[:ERRORS_SHOWN]):
+            self._show_error("error:{}".format(code), "line {}".format(line),
+                             ERROR_CODES[code][0])
+        if errors:
+            messagebox.showwarning(
+                "Check", "{} of {} lines would be rejected, first line {}"
+                .format(len(errors), lines, errors[0][0]))
+        else:
+            messagebox.showinfo("Check", "All {} lines are fine".format(lines))
 
     def _move(self, direction="origin"):
-        """Send appropriate Gcode to move the laser according to direction"""
+        """Send appropriate Gcode to move the laser according to direction
+
+        Returns a CommandFuture for the move, or None if nothing was sent"""
         logger.info("Moving %s", direction)
         if direction != "origin":
             if not self.file:
                 messagebox.showerror("File", "File must be loaded first")
-                return
+                return None
             else:
                 self.gcodefile.bounding_box_coords()
         if self.serial:
@@ -349,10 +576,9 @@ class MainWindow(Sender):
                 commands = ["G21", "G90", "G0X0Y0"]
             else:
                 commands = self.gcodefile.corner_gcode(direction)
-            for line in commands:
-                self._send_gcode(line)
-        else:
-            messagebox.showerror("Device", "Please connect first")
+            return self.send_all(commands)
+        messagebox.showerror("Device", "Please connect first")
+        return None
 
 
     def _move_ul(self):
@@ -374,12 +600,31 @@ class MainWindow(Sender):
         self._move("box")
 
     def _move_mc(self):
-        """Mark all outer corners of workpiece"""
-        level = float(self.objects["spinbox_power_level"].get())/100 * 500
+        """Mark all outer corners of workpiece
+
+        Each move to a corner is only sent once Grbl accepted the firing at
+        the one before, and the firing once it accepted the move, so the
+        laser isn't fired where a move was rejected."""
+        if not self.file:
+            messagebox.showerror("File", "File must be loaded first")
+            return
+        if not self.serial:
+            messagebox.showerror("Device", "Please connect first")
+            return
+        self.gcodefile.bounding_box_coords()
+        fire = self._fire_gcode()
+        steps = []
         for corner in ("ul", "ur", "dr", "dl"):
-            self._move(corner)
-            self._test_fire()
-        self._move("00")
+            steps += [self.gcodefile.corner_gcode(corner), fire]
+        steps.append(self.gcodefile.corner_gcode("00"))
+        def mark_next(future=None):
+            """Send the next move or firing if the last one went fine"""
+            if future is not None and future.exception() is not None:
+                logger.error("Marking corners stopped: %s",
+                             future.exception())
+            elif steps:
+                self.send_all(steps.pop(0)).add_done_callback(mark_next)
+        mark_next()
 
     def _jog_u(self):
         sped = float(self.objects["speed_box"].get())
@@ -421,38 +666,103 @@ class MainWindow(Sender):
         dist = float(self.objects["dist_box"].get())
         self.jog(x=-dist, y=dist, speed=sped)
 
-    def _test_fire(self):
+    def _feed_down(self):
+        self.override("feed", "coarse_minus")
+
+    def _feed_reset(self):
+        self.override("feed", "reset")
+
+    def _feed_up(self):
+        self.override("feed", "coarse_plus")
+
+    def _power_down(self):
+        self.override("spindle", "coarse_minus")
+
+    def _power_reset(self):
+        self.override("spindle", "reset")
+
+    def _power_up(self):
+        self.override("spindle", "coarse_plus")
+
+    def _rapid_25(self):
+        self.set_override("rapid", 25)
+
+    def _rapid_50(self):
+        self.set_override("rapid", 50)
+
+    def _rapid_100(self):
+        self.set_override("rapid", 100)
+
+    def _fire_gcode(self):
+        """Return the commands to fire the laser at the set power level"""
         percent = int(self.objects["spinbox_power_level"].get())
         level = float(percent)/100 * 500
         logger.info("Test firing @ %d percent of 500 (S%f)", percent, level)
-        fire_list = ["M3 S{}".format(level),
-                     "G1 Z-1 F600",
-                     "M5",
-                     "G0 Z0",
-                    ]
-        for command in fire_list:
-            self._send_gcode(command)
+        return ["M3 S{}".format(level),
+                "G1 Z-1 F600",
+                "M5",
+                "G0 Z0",
+               ]
+
+    def _test_fire(self):
+        return self.send_all(self._fire_gcode())
 
     def __shutdown(self):
         message = """Are you sure you want to close?
         Note: Auth will be lost.
         """
-        if messagebox.askokcancel("Quit?", message):
+        if messagebox.askokcancel("Quit?", message, parent=self.mainwindow):
             self.mainwindow.update_idletasks()
-            self._close()
+            self.manager.remove(self.device) # Stops the run and disconnects
+            if not self.manager.machines:
+                # The last machine, so mainloop() can return
+                self.mainwindow.quit()
             self.mainwindow.destroy()
-            shutdown()
 
-    def run(self):
-        """Mainloop run method"""
+    def start(self):
+        """Start updating the window"""
         self.mainwindow.after(0, self._update_status)
+
+    def run(self):
+        """Mainloop run method, until the last machine is closed"""
+        self.start()
         self.mainwindow.mainloop()
+        shutdown()
 
 ####---- MAIN ----####
-def main():
-    """Main function"""
-    root = MainWindow()
-    root.run()
+def new_manager(pool=None):
+    """Return a ControllerManager that keeps compiled files on disk, and
+    compiles big ones across the workers of pool, if given one"""
+    return ControllerManager(JobCache(parse_cache=ParseCache(),
+                                      parse_pool=pool))
+
+def main(devices=None):
+    """Main function, with a window for each GRBL serial device"""
+    # Forked once there are threads, a worker can hang on a lock one of
+    # them held, so the pools come before anything starts a thread
+    pool = parse_pool()
+    # New exports are got ready in processes of their own, at low priority
+    watch_workers = watch_pool() if os.path.isdir(GDIR) else None
+    manager = new_manager(pool)
+    watcher = None
+    if watch_workers is not None:
+        watcher = GdirWatcher(GDIR, manager.jobs.parse_cache,
+                              GCODE_EXT, pool=watch_workers).start()
+    # Closing the root would close every window, so it stays hidden, and
+    # each machine gets a Toplevel of its own
+    root = tk.Tk()
+    root.withdraw()
+    for device in devices or [GRBL_SERIAL]:
+        MainWindow(device, manager, watcher=watcher, master=root).start()
+    root.mainloop()
+    if watcher is not None:
+        watcher.stop()
+    root.destroy()
+    for workers in (pool, watch_workers):
+        if workers is not None:
+            workers.terminate()
+            workers.join()
+    shutdown()
 
 def shutdown():
     """Shutdown commands"""
@@ -499,4 +809,4 @@ if __name__ == '__main__':
     signal.signal(signal.SIGTERM, handler_cli)
     logger.debug("CLI signal handlers set up")
 
-    main()
+    main(sys.argv[1:])
@@ -0,0 +1,62 @@
+# coding=UTF-8
+"""Tests of GcodeChecker against the checks of Grbl 1.1's gcode.c"""
+
+__author__ = "Dylan Armitage"
+__email__ = "d.armitage89@gmail.com"
+
+####---- Imports ----####
+import unittest
+
+from GcodeCheck import GcodeChecker, check_lines
+
+
+####---- Classes ----####
+class CheckTest(unittest.TestCase):
+    """Error codes of single blocks, and of blocks after others"""
+    def check(self, *lines):
+        """Return the code of the last of lines, checked in turn"""
+        checker = GcodeChecker()
+        for line in lines[:-1]:
+            checker.check(line)
+        return checker.check(lines[-1])
+
+    def test_g80_axis_words(self):
+        # "Even non-modal commands or TLO that use axis words will throw
+        # this strict error"
+        self.assertEqual(self.check("G80G92X1"), 31)
+        self.assertEqual(self.check("G80", "G92X1"), 31)
+        self.assertEqual(self.check("G80", "G10L20P1X0"), 31)
+        self.assertEqual(self.check("G80", "G92.1"), 0)
+
+    def test_g10_value_words(self):
+        # bit_isfalse(value_words, P|L): only both missing is error 28
+        self.assertEqual(self.check("G10X0"), 28)
+        self.assertEqual(self.check("G10L20X0"), 0)
+        self.assertEqual(self.check("G10L2X0"), 0)
+        # A missing L is 0, which isn't 2 or 20
+        self.assertEqual(self.check("G10P1X0"), 20)
+        self.assertEqual(self.check("G10L20P7X0"), 29)
+        self.assertEqual(self.check("G10L2P1R1X0"), 20)
+        self.assertEqual(self.check("G10L20P1"), 26)
+
+    def test_g10_l20_without_p_sets_position(self):
+        checker = GcodeChecker()
+        checker.check("G0X10")
+        self.assertEqual(checker.check("G10L20X3"), 0)
+        self.assertEqual(checker.position[0], 3.0)
+
+    def test_tool_length_offset(self):
+        # G49 takes any .x, G43 only .1
+        self.assertEqual(self.check("G49.1"), 0)
+        self.assertEqual(self.check("G49"), 0)
+        self.assertEqual(self.check("G43.1Z1"), 0)
+        self.assertEqual(self.check("G43Z1"), 20)
+        self.assertEqual(self.check("G43.1X1"), 37)
+
+    def test_check_lines(self):
+        self.assertEqual(check_lines(["G21", "G80G92X1", "G49.1", "G10X0"]),
+                         [(2, 31), (4, 28)])
+
+
+if __name__ == "__main__":
+    unittest.main()
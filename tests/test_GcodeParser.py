@@ -0,0 +1,55 @@
+# coding=UTF-8
+"""Tests of GcodeFile's limit check"""
+
+__author__ = "Dylan Armitage"
+__email__ = "d.armitage89@gmail.com"
+
+####---- Imports ----####
+import os
+import shutil
+import tempfile
+import unittest
+
+from GcodeParser import GcodeFile
+
+####---- Variables ----####
+LIMITS = dict(X=(1, 300), Y=(1, 200))
+
+
+####---- Classes ----####
+class OffLimitsTest(unittest.TestCase):
+    """GcodeFile.off_limits()"""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def gcodefile(self, lines):
+        """Return a lazy GcodeFile of lines"""
+        path = os.path.join(self.directory, "job.gcode")
+        with open(path, "w") as gcode_file:
+            gcode_file.write("\n".join(lines) + "\n")
+        gcodefile = GcodeFile(path, lazy=True)
+        self.addCleanup(gcodefile.close)
+        return gcodefile
+
+    def test_g92_origin_shift(self):
+        gcodefile = self.gcodefile(["G90", "G0X250Y10", "G92X0",
+                                    "G1X40F100M3S10", "G1X100", "M5"])
+        # X290, then X350
+        self.assertEqual(gcodefile.off_limits(LIMITS), [5])
+
+    def test_g92_origin_shift_with_offset(self):
+        gcodefile = self.gcodefile(["G90", "G0X250Y10", "G92X0",
+                                    "G1X40F100M3S10", "M5"])
+        self.assertEqual(gcodefile.off_limits(LIMITS), [])
+        self.assertEqual(gcodefile.off_limits(LIMITS, (20.0, 0.0)), [4])
+
+    def test_g53_ignores_offset(self):
+        gcodefile = self.gcodefile(["G0X10Y10", "G53G0X290Y10", "G0X20"])
+        self.assertEqual(gcodefile.off_limits(LIMITS, (100.0, 0.0)), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+# coding=UTF-8
+"""Tests of MoveTable's handling of the non-modal commands"""
+
+__author__ = "Dylan Armitage"
+__email__ = "d.armitage89@gmail.com"
+
+####---- Imports ----####
+import unittest
+
+from MoveTable import MoveTable, MOTION_RAPID, MOTION_LINE, FRAME_WORK, \
+                      FRAME_MACHINE, FRAME_STORED
+
+####---- Variables ----####
+X_RANGE, Y_RANGE = (1, 300), (1, 200)
+
+
+####---- Classes ----####
+class NonModalTest(unittest.TestCase):
+    """G10, G28/G30, G53 and G92 lines"""
+    def test_g92_isnt_a_move(self):
+        table = MoveTable.from_lines(["G0X250Y10", "G92X0", "G1X100F100"])
+        self.assertEqual(table.line.tolist(), [1, 3])
+
+    def test_g92_shifts_what_follows(self):
+        table = MoveTable.from_lines(["G0X250Y10", "G92X0",
+                                      "G1X100F100M3S10"])
+        self.assertEqual(table.x0[1], 250.0)
+        self.assertEqual(table.x1[1], 350.0)
+        self.assertEqual(table.line[table.outside(X_RANGE, Y_RANGE)].tolist(),
+                         [3])
+
+    def test_g92_relative_and_cleared(self):
+        table = MoveTable.from_lines(["G0X10Y10", "G92X0Y0", "G91", "G0X5",
+                                      "G90", "G0X1", "G92.1", "G0X1"])
+        self.assertEqual(table.x1.tolist(), [10.0, 15.0, 11.0, 1.0])
+        self.assertEqual(table.y1.tolist(), [10.0] * 4)
+
+    def test_g10_isnt_a_move(self):
+        table = MoveTable.from_lines(["G0X10Y10", "G10L20P1X5Y5", "G0X20"])
+        self.assertEqual(table.line.tolist(), [1, 3])
+        self.assertEqual(table.x0[1], 10.0)
+
+    def test_g28_is_rapid_through_intermediate(self):
+        table = MoveTable.from_lines(["G1X10Y10F100M3S10", "G28X5Y5",
+                                      "X20"])
+        self.assertEqual(table.line.tolist(), [1, 2, 2, 3])
+        self.assertEqual(table.motion.tolist(), [MOTION_LINE, MOTION_RAPID,
+                                                 MOTION_RAPID, MOTION_LINE])
+        self.assertEqual(table.frame.tolist(), [FRAME_WORK, FRAME_WORK,
+                                                FRAME_STORED, FRAME_WORK])
+        self.assertEqual((table.x1[1], table.y1[1]), (5.0, 5.0))
+        self.assertEqual(table.power[1:3].tolist(), [0.0, 0.0])
+        stats = table.statistics()
+        self.assertEqual((stats["rapids"], stats["cuts"]), (2, 2))
+
+    def test_g30_without_axes(self):
+        table = MoveTable.from_lines(["G0X10Y10", "G30"])
+        self.assertEqual(table.frame.tolist(), [FRAME_WORK, FRAME_STORED])
+        self.assertEqual(table.motion.tolist(), [MOTION_RAPID] * 2)
+
+    def test_stored_positions_arent_checked(self):
+        table = MoveTable.from_lines(["G0X10Y10", "G28"])
+        self.assertEqual(table.outside(X_RANGE, Y_RANGE).tolist(), [])
+
+    def test_g53_is_in_machine_coordinates(self):
+        table = MoveTable.from_lines(["G0X10Y10", "G91", "G53G0X290Y5",
+                                      "G90G1X20F100"])
+        self.assertEqual(table.frame.tolist(), [FRAME_WORK, FRAME_MACHINE,
+                                                FRAME_WORK])
+        self.assertEqual((table.x1[1], table.y1[1]), (290.0, 5.0))
+        self.assertEqual(table.outside(X_RANGE, Y_RANGE, (50, 0)).tolist(),
+                         [])
+        self.assertEqual(table.outside(X_RANGE, Y_RANGE, (285, 0)).tolist(),
+                         [2])
+
+    def test_bounds_are_work_moves(self):
+        table = MoveTable.from_lines(["G1X10Y10F100", "G53G1X290Y5",
+                                      "G1X20Y20"])
+        self.assertEqual(table.bounds(), (10.0, 10.0, 20.0, 20.0))
+
+
+if __name__ == "__main__":
+    unittest.main()